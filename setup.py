@@ -45,6 +45,9 @@ setup(
             "WebTest",
             "zc.buildout"
             ],
+        "inotify": [
+            "pyinotify",
+            ],
         },
 
     entry_points = """
@@ -63,6 +66,7 @@ concat = pwt.jinja2js.wsgi:ConcatResources
 
 [console_scripts]
 jinja2js = pwt.jinja2js.cli:main
+jinja2js-benchmark = pwt.jinja2js.benchmark:main
 """,
 
     include_package_data = True,
@@ -0,0 +1,304 @@
+"""
+Measure how fast templates compile.
+
+A synthetic corpus of templates is written to a temporary directory, then
+the parsing, the scope analysis (`JSFrame.inspect`) and the code generation
+of every template is timed separately for each writer. The results are
+saved as JSON so that runs on different revisions can be compared.
+"""
+import json
+import optparse
+import os
+import os.path
+import platform
+import random
+import shutil
+import sys
+import tempfile
+import timeit
+
+import jinja2
+import jinja2.nodes
+
+import cli
+import environment
+import jscompiler
+
+# filters and the arguments we call them with.
+FILTERS = [
+    "default('none')",
+    "truncate(10)",
+    "capitalize",
+    "length",
+    "replace('a', 'b')",
+    "round(2)",
+    "escape",
+    ]
+
+
+class CorpusGenerator(object):
+    """
+    Generate templates with a controlled shape.
+
+    * `macros` - number of macros per template.
+    * `loop_depth` - how deeply the for loops in each macro are nested.
+    * `filter_density` - fraction of the variables that are filtered.
+    * `imports` - number of library templates every template imports.
+    * `size` - number of output lines in the body of each loop.
+    """
+
+    def __init__(self, macros = 10, loop_depth = 2, filter_density = 0.3,
+                 imports = 2, size = 5, seed = 0):
+        self.macros = macros
+        self.loop_depth = loop_depth
+        self.filter_density = filter_density
+        self.imports = imports
+        self.size = size
+        self.random = random.Random(seed)
+
+    def variable(self, name):
+        if self.random.random() < self.filter_density:
+            return "{{ %s|%s }}" %(name, self.random.choice(FILTERS))
+        return "{{ %s }}" % name
+
+    def output(self, names, indent):
+        lines = []
+        for idx in range(self.size):
+            name = self.random.choice(names)
+            lines.append('%s<li class="item%d">%s: %s</li>' %(
+                indent, idx, name, self.variable(name + ".title")))
+        return lines
+
+    def loop(self, names, depth, indent):
+        if depth == self.loop_depth:
+            return self.output(names, indent)
+
+        target = "item%d" % depth
+        lines = ["%s{%% for %s in %s.children %%}" %(
+            indent, target, names[-1])]
+        lines.append('%s<ul data-index="{{ loop.index }}">' %(indent + "  "))
+        lines.extend(self.loop(names + [target], depth + 1, indent + "    "))
+        lines.append("%s</ul>" %(indent + "  "))
+        lines.append("%s{%% endfor %%}" % indent)
+        return lines
+
+    def library(self, idx):
+        return "\n".join([
+            "{%% namespace bench.lib%d %%}" % idx,
+            "",
+            "{% macro link(url, title) %}",
+            '<a href="{{ url }}">{{ title }}</a>',
+            "{% endmacro %}",
+            ])
+
+    def template(self, idx):
+        lines = ["{%% namespace bench.t%d %%}" % idx, ""]
+        for lib in range(self.imports):
+            lines.append("{%% import 'lib%d.jinja2' as lib%d %%}" %(lib, lib))
+        lines.append("")
+
+        for macro in range(self.macros):
+            lines.append("{%% macro macro%d(data, title = '') %%}" % macro)
+            lines.append("<h1>{{ title }}</h1>")
+            if self.imports:
+                lib = self.random.randrange(self.imports)
+                lines.append(
+                    "{{ lib%d.link(url = data.url, title = data.title) }}" % lib)
+            if self.loop_depth:
+                lines.extend(self.loop(["data"], 0, "  "))
+            else:
+                lines.extend(self.output(["data"], "  "))
+            lines.append("{% endmacro %}")
+            lines.append("")
+
+        return "\n".join(lines)
+
+    def write(self, directory, templates):
+        """
+        Write the library templates and `templates` templates to `directory`
+        and return the names of the templates to compile.
+        """
+        for lib in range(self.imports):
+            open(os.path.join(directory, "lib%d.jinja2" % lib), "w").write(
+                self.library(lib))
+
+        names = []
+        for idx in range(templates):
+            name = "t%d.jinja2" % idx
+            open(os.path.join(directory, name), "w").write(
+                self.template(idx))
+            names.append(name)
+        return names
+
+
+def timings(func, repeat):
+    times = []
+    for i in range(repeat):
+        start = timeit.default_timer()
+        func()
+        times.append(timeit.default_timer() - start)
+    return {
+        "min": min(times),
+        "mean": sum(times) / len(times),
+        "total": sum(times),
+        }
+
+
+def inspect(env, node, name):
+    # The same scope analysis CodeGenerator.visit_Template does.
+    eval_ctx = jinja2.nodes.EvalContext(env, name)
+    eval_ctx.namespace = ""
+    frame = jscompiler.JSFrame(env, eval_ctx)
+    frame.inspect(node.body)
+
+
+def benchmark_writer(directory, names, writer, repeat):
+    env = environment.create_environment(
+        directories = [directory], writer = cli.writerclasses[writer])
+
+    sources = []
+    for name in names:
+        source, filename, uptodate = env.loader.get_source(env, name)
+        node = env._parse(source, name, filename)
+        sources.append((name, filename, source, node))
+
+    def parse():
+        for name, filename, source, node in sources:
+            env._parse(source, name, filename)
+
+    def scope():
+        for name, filename, source, node in sources:
+            inspect(env, node, name)
+
+    output = {}
+    def codegen():
+        for name, filename, source, node in sources:
+            output[name] = jscompiler.generate(node, env, name, filename)
+
+    # warm up the namespace index so that we time the steady state
+    codegen()
+
+    return {
+        "parse": timings(parse, repeat),
+        "inspect": timings(scope, repeat),
+        "codegen": timings(codegen, repeat),
+        "source_bytes": sum(len(source) for n, f, source, node in sources),
+        "output_bytes": sum(len(js) for js in output.values()),
+        }
+
+
+def run(templates = 20, repeat = 5, writers = None, **corpus):
+    """
+    Generate a corpus and benchmark it with every writer in `writers`, by
+    default all the code styles the command line interface supports. The
+    other keyword arguments are passed to `CorpusGenerator`.
+    """
+    if writers is None:
+        writers = sorted(cli.writerclasses)
+
+    generator = CorpusGenerator(**corpus)
+    directory = tempfile.mkdtemp()
+    try:
+        names = generator.write(directory, templates)
+        results = {}
+        for writer in writers:
+            results[writer] = benchmark_writer(
+                directory, names, writer, repeat)
+    finally:
+        shutil.rmtree(directory)
+
+    parameters = dict(
+        templates = templates,
+        repeat = repeat,
+        macros = generator.macros,
+        loop_depth = generator.loop_depth,
+        filter_density = generator.filter_density,
+        imports = generator.imports,
+        size = generator.size,
+        )
+
+    return {
+        "parameters": parameters,
+        "python": platform.python_version(),
+        "jinja2": jinja2.__version__,
+        "results": results,
+        }
+
+
+def compare(old, new, output):
+    """
+    Write the change in the minimum times between two sets of results.
+    """
+    for writer in sorted(new["results"]):
+        if writer not in old["results"]:
+            continue
+        for phase in ("parse", "inspect", "codegen"):
+            before = old["results"][writer][phase]["min"]
+            after = new["results"][writer][phase]["min"]
+            change = before and (after - before) / before * 100 or 0
+            output.write("%-14s %-8s %10.4fs %10.4fs %+7.1f%%\n" %(
+                writer, phase, before, after, change))
+
+
+def main(args = None, output = None):
+    if output is None:
+        output = sys.stdout
+
+    parser = optparse.OptionParser()
+    parser.add_option(
+        "--templates", dest = "templates", default = 20, type = "int",
+        help = "Number of templates to generate.")
+    parser.add_option(
+        "--macros", dest = "macros", default = 10, type = "int",
+        help = "Number of macros in every template.")
+    parser.add_option(
+        "--loopDepth", dest = "loop_depth", default = 2, type = "int",
+        help = "How deeply loops are nested inside each macro.")
+    parser.add_option(
+        "--filterDensity", dest = "filter_density", default = 0.3,
+        type = "float",
+        help = "Fraction of the output variables that are filtered.")
+    parser.add_option(
+        "--imports", dest = "imports", default = 2, type = "int",
+        help = "Number of templates that every template imports.")
+    parser.add_option(
+        "--size", dest = "size", default = 5, type = "int",
+        help = "Number of output lines inside every loop.")
+    parser.add_option(
+        "--repeat", dest = "repeat", default = 5, type = "int",
+        help = "Number of times to time every phase.")
+    parser.add_option(
+        "--output", dest = "output",
+        help = "File to save the JSON results in.",
+        metavar = "OUTPUT")
+    parser.add_option(
+        "--compare", dest = "compare",
+        help = "JSON results of a previous run to compare against.",
+        metavar = "COMPARE")
+
+    options, args = parser.parse_args(args)
+
+    results = run(
+        templates = options.templates,
+        repeat = options.repeat,
+        macros = options.macros,
+        loop_depth = options.loop_depth,
+        filter_density = options.filter_density,
+        imports = options.imports,
+        size = options.size)
+
+    if options.output:
+        json.dump(results, open(options.output, "w"),
+                  indent = 1, sort_keys = True)
+    else:
+        json.dump(results, output, indent = 1, sort_keys = True)
+        output.write("\n")
+
+    if options.compare:
+        compare(json.load(open(options.compare)), results, output)
+
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,10 +1,26 @@
+import hashlib
+import json
+import multiprocessing
 import optparse
+import os
 import os.path
 import string
 import sys
+import time
+
+import pkg_resources
+
+try:
+    import pyinotify
+except ImportError:
+    pyinotify = None
+
+import jinja2
 
 import environment
 import jscompiler
+import profiler
+import sourcemap
 
 def get_output_filename(output_format, filename):
     filename_template = string.Template(output_format)
@@ -22,12 +38,497 @@ def get_output_filename(output_format, filename):
 writerclasses = {
     "stringbuilder": "pwt.jinja2js.jscompiler.StringBuilder",
     "concat": "pwt.jinja2js.jscompiler.Concat",
+    "join": "pwt.jinja2js.jscompiler.Join",
+    "templateliteral": "pwt.jinja2js.jscompiler.TemplateLiteral",
     }
 
 
-def main(args = None, output = None):
+class CompileResult(object):
+    # The outcome of compiling one template file. Only one of `output` or
+    # `error` is set.
+
+    def __init__(self, filename, output = None, error = None, imports = (),
+                 source_map = None, stats = None):
+        self.filename = filename
+        self.output = output
+        self.error = error
+        # names of the templates imported by this template
+        self.imports = list(imports)
+        # `sourcemap.SourceMap` of the output
+        self.source_map = source_map
+        # statistics of the compilation, see `compile_stats`
+        self.stats = stats
+
+
+def measured(env):
+    # The time spent in each phase so far and the number of escape calls
+    # generated, if the environment has a profiler.
+    if env.profiler is None:
+        return None
+    return (dict(env.profiler.exclusive.get("phases", {})),
+            env.profiler.counts.get("escapes", 0))
+
+
+def compile_stats(before, after, sources, output):
+    """
+    Return the statistics of compiling the `(source, node)` pairs in
+    `sources` into the `output`. `before` and `after` are what `measured`
+    returned before parsing and after generating the code.
+    """
+    def elapsed(phase):
+        return after[0].get(phase, 0.0) - before[0].get(phase, 0.0)
+
+    if isinstance(output, unicode):
+        output = output.encode("utf-8")
+
+    return {
+        "parse_time": elapsed("parse"),
+        "scope_analysis_time": elapsed("inspect") + elapsed("find_undeclared"),
+        "codegen_time": elapsed("generate"),
+        "source_bytes": sum([len(source) for source, node in sources]),
+        "output_bytes": len(output),
+        "macros": sum([
+            len(list(node.find_all(jinja2.nodes.Macro)))
+            for source, node in sources]),
+        "imports": sum([
+            len(jscompiler.find_imports(node)) for source, node in sources]),
+        "escapes": after[1] - before[1],
+        }
+
+
+def compile_file(env, filename):
+    name = os.path.basename(filename)
+    source_map = sourcemap.SourceMap()
+    try:
+        source = open(filename).read()
+        before = measured(env)
+        node = env._parse(source, name, filename)
+        with jscompiler.measure(env, "phases", "generate"):
+            output = jscompiler.generate(node, env, name, filename, source_map)
+    except Exception as err:
+        return CompileResult(
+            filename, error = "%s: %s" %(err.__class__.__name__, err))
+
+    stats = None
+    if before is not None:
+        stats = compile_stats(
+            before, measured(env), [(source, node)], output)
+
+    source_map.add_content(name, source.decode("utf-8"))
+    return CompileResult(
+        filename, output = output, imports = jscompiler.find_imports(node),
+        source_map = source_map, stats = stats)
+
+
+def write_output(output_filename, output, source_map = None, filenames = {}):
+    """
+    Write the `output` to `output_filename`. If there is a `source_map` it
+    is written next to the output, as `output_filename` with a `.map`
+    extension, and the output points to it. `filenames` are the paths of
+    the templates in the source map, by name.
+    """
+    if source_map is not None:
+        map_filename = output_filename + ".map"
+        directory = os.path.dirname(os.path.abspath(map_filename))
+        paths = dict([
+            (name, os.path.relpath(os.path.abspath(path), directory))
+            for name, path in filenames.items()])
+
+        source_map.file = os.path.basename(output_filename)
+        open(map_filename, "w").write(source_map.dumps(paths))
+        output += "\n//# sourceMappingURL=%s\n" % os.path.basename(
+            map_filename)
+
+    open(output_filename, "w").write(output)
+
+
+def write_result(compiled, output_filename, source_map = False):
+    if source_map:
+        write_output(
+            output_filename, compiled.output, compiled.source_map,
+            {os.path.basename(compiled.filename): compiled.filename})
+    else:
+        write_output(output_filename, compiled.output)
+
+
+def write_stats(stats_filename, results, bundle = None):
+    """
+    Write the statistics of the compiled `results`, and of the `bundle` they
+    were compiled into if any, as JSON to `stats_filename`.
+    """
+    files = {}
+    for result in results:
+        if result.error is not None:
+            files[result.filename] = {"error": result.error}
+        else:
+            files[result.filename] = result.stats
+
+    data = {"files": files}
+    if bundle is not None:
+        data["bundle"] = bundle
+    json.dump(data, open(stats_filename, "w"), indent = 1, sort_keys = True)
+
+
+def source_hash(source):
+    if isinstance(source, unicode):
+        source = source.encode("utf-8")
+    return hashlib.sha1(source).hexdigest()
+
+
+class Manifest(object):
+    """
+    Record of a previous build, used to only recompile the templates that
+    have changed since then.
+
+    For every input file we store the hash of its content, the output file
+    and the hash of every template it imports. A file needs recompiling if
+    its content, one of its imports or the compiler options changed, or if
+    its output file is missing.
+    """
+
+    def __init__(self, filename, options):
+        # A manifest without a filename is only kept in memory.
+        self.filename = filename
+        self.options = options
+        self.files = {}
+
+        if filename is not None:
+            self.load()
+
+    def load(self):
+        try:
+            data = json.load(open(self.filename))
+        except (IOError, ValueError):
+            return
+
+        if data.get("options") == self.options:
+            self.files = data.get("files", {})
+
+    def import_hashes(self, env, imports):
+        # The hashes come from the namespace index, so the imports are only
+        # parsed again when they change.
+        index = jscompiler.get_namespace_index(env)
+        hashes = {}
+        for name in imports:
+            try:
+                hashes[name] = index.get(name).checksum
+            except jinja2.TemplateError:
+                # missing, or the compile will fail anyway
+                hashes[name] = None
+        return hashes
+
+    def is_dirty(self, env, filename, output_filename):
+        entry = self.files.get(filename)
+        if entry is None or entry["output"] != output_filename:
+            return True
+
+        if not os.path.exists(output_filename):
+            return True
+
+        if entry["hash"] != source_hash(open(filename).read()):
+            return True
+
+        return entry["imports"] != self.import_hashes(
+            env, sorted(entry["imports"]))
+
+    def update(self, env, result, output_filename):
+        if result.error is not None:
+            self.files.pop(result.filename, None)
+            return
+
+        self.files[result.filename] = {
+            "hash": source_hash(open(result.filename).read()),
+            "output": output_filename,
+            "imports": self.import_hashes(env, result.imports),
+            }
+
+    def save(self):
+        if self.filename is None:
+            return
+
+        data = {"options": self.options, "files": self.files}
+        json.dump(data, open(self.filename, "w"), indent = 1, sort_keys = True)
+
+
+# The environment of a worker process in the --jobs pool. It is created once
+# per process by `init_worker`.
+worker_env = None
+
+
+def init_worker(env_options):
+    global worker_env
+    worker_env = environment.create_environment(**env_options)
+
+
+def compile_worker(filename):
+    return compile_file(worker_env, filename)
+
+
+def compile_files(env_options, files, jobs = 1):
+    """
+    Compile the template `files`, using a pool of `jobs` processes if more
+    then one job is requested.
+
+    Returns a list of the `compile_file` results in the same order as
+    `files`.
+    """
+    if jobs > 1 and len(files) > 1:
+        pool = multiprocessing.Pool(
+            min(jobs, len(files)), init_worker, (env_options,))
+        try:
+            return pool.map(compile_worker, files)
+        finally:
+            pool.close()
+            pool.join()
+
+    env = environment.create_environment(**env_options)
+    return [compile_file(env, filename) for filename in files]
+
+
+# The statistics of the templates in a bundle, the rest is only known for
+# the bundle as a whole.
+BUNDLED_STATS = ("parse_time", "source_bytes", "macros", "imports")
+
+
+def bundle(env, files, bundle_filename, errors, source_map = False,
+           stats_filename = None):
+    """
+    Compile all the `files` into the one `bundle_filename`, with a source
+    map if `source_map` is true. The statistics of the compilation are
+    written to `stats_filename` if given. Compile errors are written to
+    the `errors` stream.
+    """
+    result = 0
+    templates = []
+    results = []
+    sources = []
+    start = measured(env)
+    for filename in files:
+        name = os.path.basename(filename)
+        try:
+            source = open(filename).read()
+            before = measured(env)
+            node = env._parse(source, name, filename)
+        except Exception as err:
+            error = "%s: %s" %(err.__class__.__name__, err)
+            errors.write("%s: %s\n" %(filename, error))
+            results.append(CompileResult(filename, error = error))
+            result = 1
+        else:
+            templates.append((node, name, filename))
+            sources.append((source, node))
+            stats = None
+            if before is not None:
+                stats = compile_stats(
+                    before, measured(env), [(source, node)], "")
+                stats = dict([(key, stats[key]) for key in BUNDLED_STATS])
+            results.append(CompileResult(filename, stats = stats))
+
+    if result:
+        if stats_filename:
+            write_stats(stats_filename, results)
+        return result
+
+    mappings = None
+    if source_map:
+        mappings = sourcemap.SourceMap()
+        for node, name, filename in templates:
+            mappings.add_content(name, open(filename).read().decode("utf-8"))
+
+    try:
+        with jscompiler.measure(env, "phases", "generate"):
+            source = jscompiler.generateBundle(
+                templates, env, source_map = mappings)
+    except Exception as err:
+        errors.write("%s: %s: %s\n" %(
+            getattr(err, "filename", None) or bundle_filename,
+            err.__class__.__name__, err))
+        if stats_filename:
+            write_stats(stats_filename, results)
+        return 1
+
+    if stats_filename:
+        write_stats(
+            stats_filename, results,
+            dict(compile_stats(start, measured(env), sources, source),
+                 filename = bundle_filename))
+
+    write_output(bundle_filename, source, mappings, dict(
+        [(name, filename) for node, name, filename in templates]))
+    return 0
+
+
+def build(env, files, output_format, manifest, output, source_map = False,
+          stats_filename = None, errors = None):
+    """
+    Compile the `files` that the `manifest` reports as changed, writing the
+    output and recording the new state in the `manifest`. The files that
+    are compiled are listed on the `output` stream and the compile errors
+    on the `errors` stream, stderr by default. Returns 1 if any template
+    failed to compile.
+    """
+    if errors is None:
+        errors = sys.stderr
+    result = 0
+    results = []
+    for filename in files:
+        output_filename = get_output_filename(output_format, filename)
+        if not manifest.is_dirty(env, filename, output_filename):
+            continue
+
+        compiled = compile_file(env, filename)
+        results.append(compiled)
+        manifest.update(env, compiled, output_filename)
+        if compiled.error is not None:
+            errors.write("%s: %s\n" %(filename, compiled.error))
+            result = 1
+            continue
+
+        write_result(compiled, output_filename, source_map)
+        output.write("%s -> %s\n" %(filename, output_filename))
+
+    manifest.save()
+    if stats_filename:
+        write_stats(stats_filename, results)
+    return result
+
+
+def watch_roots(env_options, files):
+    # The directories containing the templates we compile and all the
+    # templates they can import.
+    roots = list(env_options.get("directories", []))
+    for package in env_options.get("packages", []):
+        package = package.split(":")
+        if len(package) == 1:
+            # the default of jinja2.PackageLoader
+            package.append("templates")
+        roots.append(pkg_resources.resource_filename(*package))
+    for filename in files:
+        roots.append(os.path.dirname(os.path.abspath(filename)))
+
+    unique = []
+    for root in roots:
+        root = os.path.abspath(root)
+        if root not in unique:
+            unique.append(root)
+    return unique
+
+
+class PollingWatcher(object):
+    # Detect changes by comparing the modification times of every file
+    # under the roots.
+
+    def __init__(self, roots, interval = 0.5):
+        self.roots = roots
+        self.interval = interval
+        self.mtimes = self.scan()
+
+    def scan(self):
+        mtimes = {}
+        for root in self.roots:
+            for dirpath, dirnames, filenames in os.walk(root):
+                for name in filenames:
+                    path = os.path.join(dirpath, name)
+                    try:
+                        mtimes[path] = os.path.getmtime(path)
+                    except OSError:
+                        # deleted since we listed the directory
+                        pass
+        return mtimes
+
+    def wait(self, timeout = None):
+        """
+        Return the set of paths that changed since the last call, waiting up
+        to `timeout` seconds for something to change.
+        """
+        if timeout is None:
+            timeout = self.interval
+        time.sleep(timeout)
+
+        mtimes = self.scan()
+        changed = set(
+            path for path in set(mtimes) | set(self.mtimes)
+            if mtimes.get(path) != self.mtimes.get(path))
+        self.mtimes = mtimes
+        return changed
+
+
+class InotifyWatcher(object):
+    # Same interface as the PollingWatcher but uses inotify.
+
+    mask = 0
+    if pyinotify is not None:
+        mask = pyinotify.IN_CLOSE_WRITE | pyinotify.IN_CREATE | \
+               pyinotify.IN_DELETE | pyinotify.IN_MOVED_TO | \
+               pyinotify.IN_MOVED_FROM
+
+    def __init__(self, roots, interval = 0.5):
+        self.roots = roots
+        self.interval = interval
+        self.changed = set()
+
+        changed = self.changed
+        class Handler(pyinotify.ProcessEvent):
+            def process_default(self, event):
+                changed.add(event.pathname)
+
+        self.manager = pyinotify.WatchManager()
+        self.notifier = pyinotify.Notifier(self.manager, Handler())
+        for root in roots:
+            self.manager.add_watch(root, self.mask, rec = True, auto_add = True)
+
+    def wait(self, timeout = None):
+        if timeout is None:
+            timeout = self.interval
+        if self.notifier.check_events(int(timeout * 1000)):
+            self.notifier.read_events()
+            self.notifier.process_events()
+
+        changed = set(self.changed)
+        self.changed.clear()
+        return changed
+
+
+def create_watcher(roots):
+    if pyinotify is not None:
+        return InotifyWatcher(roots)
+    return PollingWatcher(roots)
+
+
+def watch(env, files, output_format, manifest, output, watcher,
+          debounce = 0.2, source_map = False, stats_filename = None,
+          errors = None):
+    """
+    Keep the output of `files` up to date until interrupted. Only the
+    templates affected by a change are compiled again.
+    """
+    build(env, files, output_format, manifest, output, source_map,
+          stats_filename, errors)
+
+    try:
+        while True:
+            if not watcher.wait():
+                continue
+
+            # Editors and version control tend to write several files at
+            # once, so wait for things to settle down before compiling.
+            while watcher.wait(debounce):
+                pass
+
+            build(
+                env, files, output_format, manifest, output, source_map,
+                stats_filename, errors)
+    except KeyboardInterrupt:
+        pass
+
+    return 0
+
+
+def main(args = None, output = None, errors = None):
     if output is None:
         output = sys.stdout
+    if errors is None:
+        errors = sys.stderr
 
     parser = optparse.OptionParser()
     # closure template options that we support
@@ -49,33 +550,165 @@ def main(args = None, output = None):
         metavar = "PACKAGE")
 
     parser.add_option(
-        "--codeStyle", choices = ["stringbuilder", "concat"],
+        "--codeStyle", choices = sorted(writerclasses),
         dest = "codeStyle", default = "concat", type = "choice",
-        help = "The code style to use when generating JS code. Either `stringbuilder` or `concat` styles.")
+        help = "The code style to use when generating JS code. One of the `stringbuilder`, `concat`, `join` or `templateliteral` styles.")
+
+    parser.add_option(
+        "--define", dest = "defines",
+        default = [], action = "append",
+        help = "Compile time constant, as name=value. The value is read as JSON, or else used as a string. Can be given more then once.",
+        metavar = "NAME=VALUE")
+
+    parser.add_option(
+        "--inlineThreshold", dest = "inline_threshold",
+        default = 0, type = "int",
+        help = "Inline calls to macros in the same template whose body has at most this many nodes. 0, the default, never inlines.",
+        metavar = "NODES")
+
+    parser.add_option(
+        "--minify", dest = "minify", default = False, action = "store_true",
+        help = "Leave out the whitespace in the generated code and give the local variables short names.")
+
+    parser.add_option(
+        "--instrument", dest = "instrument", default = False,
+        action = "store_true",
+        help = "Count the calls, the time spent in and the length of the output of every macro at run time, in the global jinja2jsStats object.")
+
+    parser.add_option(
+        "--sourceMap", dest = "source_map", default = False,
+        action = "store_true",
+        help = "Write a source map next to each output file, named after the output file with a .map extension.")
+
+    parser.add_option(
+        "--cacheDir", dest = "cache_dir",
+        help = "Directory to cache the parsed templates in. Unchanged templates are not parsed again on later runs.",
+        metavar = "CACHE_DIR")
+    parser.add_option(
+        "--jobs", dest = "jobs", default = 1, type = "int",
+        help = "Number of processes to compile the templates with.",
+        metavar = "JOBS")
+    parser.add_option(
+        "--manifest", dest = "manifest",
+        help = "File to record the state of the build in. When it exists only the templates that changed, or import a template that changed, are compiled.",
+        metavar = "MANIFEST")
+    parser.add_option(
+        "--bundle", dest = "bundle",
+        help = "Compile all the templates into this one file, ordered so that imported templates come first.",
+        metavar = "BUNDLE")
+    parser.add_option(
+        "--profile", dest = "profile", default = False, action = "store_true",
+        help = "Report the time spent parsing, in the scope analysis and generating every type of node and macro. The templates are compiled in this process, ignoring --jobs.")
+    parser.add_option(
+        "--stats", dest = "stats",
+        help = "Write the parse, scope analysis and code generation times, the size of the source and output, and the number of macros, imports and escape calls of every template to this file as JSON.",
+        metavar = "FILE")
+    parser.add_option(
+        "--watch", dest = "watch", default = False, action = "store_true",
+        help = "Keep running and compile the templates again when they, or any template in the template directories and packages, change.")
 
     options, files = parser.parse_args(args)
 
+    try:
+        defines = environment.parse_defines(options.defines)
+    except ValueError as err:
+        errors.write("%s\n" % err)
+        return 1
+
     outputPathFormat = options.output_format
-    if not outputPathFormat:
+    if not outputPathFormat and not options.bundle:
         parser.print_help(output)
         return 1
 
-    env = environment.create_environment(
+    parse_cache = None
+    if options.cache_dir:
+        if not os.path.isdir(options.cache_dir):
+            os.makedirs(options.cache_dir)
+        parse_cache = environment.FileSystemParseCache(options.cache_dir)
+
+    compile_profiler = None
+    jobs = options.jobs
+    if options.profile:
+        compile_profiler = profiler.Profiler()
+        # the workers can't report back what they measured
+        jobs = 1
+    elif options.stats:
+        # only the phases are needed for the statistics
+        compile_profiler = profiler.Profiler(categories = ("phases",))
+
+    env_options = dict(
         packages = options.packages,
         directories = options.directories,
-        writer = writerclasses[options.codeStyle])
+        writer = writerclasses[options.codeStyle],
+        defines = defines,
+        inline_threshold = options.inline_threshold,
+        minify = options.minify,
+        instrument = options.instrument,
+        parse_cache = parse_cache,
+        profiler = compile_profiler)
 
-    for filename in files:
-        name = os.path.basename(filename)
-        node = env._parse(open(filename).read(), name, filename)
+    if options.bundle:
+        result = bundle(
+            environment.create_environment(**env_options),
+            files, options.bundle, errors, options.source_map, options.stats)
+        if options.profile:
+            compile_profiler.report(output)
+        return result
 
-        output = jscompiler.generate(node, env, name, filename)
+    # everything that changes the generated code
+    manifest_options = dict(
+        env_options, output_format = outputPathFormat,
+        source_map = options.source_map)
+    del manifest_options["parse_cache"]
+    del manifest_options["profiler"]
 
-        output_filename = get_output_filename(options.output_format, filename)
+    if options.watch:
+        env = environment.create_environment(**env_options)
+        return watch(
+            env, files, outputPathFormat,
+            Manifest(options.manifest, manifest_options),
+            output,
+            create_watcher(watch_roots(env_options, files)),
+            source_map = options.source_map, stats_filename = options.stats,
+            errors = errors)
 
-        open(output_filename, "w").write(output)
+    manifest = None
+    if options.manifest:
+        env = environment.create_environment(**env_options)
+        manifest = Manifest(options.manifest, manifest_options)
+        files = [
+            filename for filename in files
+            if manifest.is_dirty(
+                env, filename,
+                get_output_filename(outputPathFormat, filename))
+            ]
 
-    return 0
+    result = 0
+    results = compile_files(env_options, files, jobs)
+    for compiled in results:
+        output_filename = get_output_filename(
+            outputPathFormat, compiled.filename)
+
+        if manifest is not None:
+            manifest.update(env, compiled, output_filename)
+
+        if compiled.error is not None:
+            errors.write("%s: %s\n" %(compiled.filename, compiled.error))
+            result = 1
+            continue
+
+        write_result(compiled, output_filename, options.source_map)
+
+    if manifest is not None:
+        manifest.save()
+
+    if options.stats:
+        write_stats(options.stats, results)
+
+    if options.profile:
+        compile_profiler.report(output)
+
+    return result
 
 
 if __name__ == "__main__":
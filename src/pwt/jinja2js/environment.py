@@ -2,9 +2,115 @@
 XXX - remove this and just use an unmodified Jinja2 environment. This
 would keep things simple.
 """
+import hashlib
+import json
+import os
+import os.path
+import tempfile
+
+try:
+    import cPickle as pickle
+except ImportError:
+    import pickle
+
 import jinja2
 import jinja2.environment
 import jinja2.utils
+import pkg_resources
+
+try:
+    VERSION = pkg_resources.get_distribution("pwt.jinja2js").version
+except pkg_resources.DistributionNotFound:
+    # Running from a checkout that isn't installed
+    VERSION = "dev"
+
+# The environment settings that change how a template is lexed, the same
+# ones that Jinja2 uses to cache its lexers.
+LEXER_SETTINGS = (
+    "block_start_string",
+    "block_end_string",
+    "variable_start_string",
+    "variable_end_string",
+    "comment_start_string",
+    "comment_end_string",
+    "line_statement_prefix",
+    "line_comment_prefix",
+    "trim_blocks",
+    "lstrip_blocks",
+    "newline_sequence",
+    "keep_trailing_newline",
+    )
+
+
+class FileSystemParseCache(object):
+    """
+    Store the parsed node tree of templates on the file system so that
+    unchanged templates don't need to be lexed and parsed again.
+
+    Similar to Jinja2's `FileSystemBytecodeCache`, each tree is stored in
+    its own file in `directory`, named after a hash of the source, the
+    Jinja2 and pwt.jinja2js versions, the extensions loaded into the
+    environment and the environment settings that change the parse tree.
+    """
+
+    def __init__(self, directory, pattern = "__jinja2js_%s.cache"):
+        self.directory = directory
+        self.pattern = pattern
+
+    def get_cache_key(self, environment, source):
+        if isinstance(source, unicode):
+            source = source.encode("utf-8")
+        key = hashlib.sha1(jinja2.__version__)
+        key.update("|%s|" % VERSION)
+        key.update("|".join(sorted(environment.extensions)))
+        key.update("|")
+        # Older versions of Jinja2 don't have all the settings
+        key.update(repr([getattr(environment, name, None)
+                         for name in LEXER_SETTINGS]))
+        key.update("|")
+        key.update(source)
+        return key.hexdigest()
+
+    def get_cache_filename(self, key):
+        return os.path.join(self.directory, self.pattern % key)
+
+    def load(self, environment, source):
+        filename = self.get_cache_filename(
+            self.get_cache_key(environment, source))
+        try:
+            f = open(filename, "rb")
+        except IOError:
+            return None
+
+        try:
+            unpickler = pickle.Unpickler(f)
+            # The environment isn't stored with the nodes
+            unpickler.persistent_load = lambda pid: environment
+            try:
+                return unpickler.load()
+            except Exception:
+                # Corrupt or stale cache file, so just parse the source
+                return None
+        finally:
+            f.close()
+
+    def dump(self, environment, source, node):
+        filename = self.get_cache_filename(
+            self.get_cache_key(environment, source))
+
+        # Write to a temporary file and rename it so that concurrent
+        # builds never see a partially written tree.
+        fd, tmpname = tempfile.mkstemp(dir = self.directory)
+        f = os.fdopen(fd, "wb")
+        try:
+            pickler = pickle.Pickler(f, pickle.HIGHEST_PROTOCOL)
+            pickler.persistent_id = \
+                lambda obj: obj is environment and "environment" or None
+            pickler.dump(node)
+        finally:
+            f.close()
+        os.rename(tmpname, filename)
+
 
 class Environment(jinja2.Environment):
 
@@ -17,9 +123,37 @@ class Environment(jinja2.Environment):
         self.strip_html_whitespace = kwargs.pop(
             "strip_html_whitespace", False)
         self.js_indentation = kwargs.pop("js_indentation", "    ")
+        self.parse_cache = kwargs.pop("parse_cache", None)
+        # compile time constants
+        self.defines = kwargs.pop("defines", {})
+        # largest macro, in number of nodes, to inline. 0 turns it off.
+        self.inline_threshold = kwargs.pop("inline_threshold", 0)
+        # compact the generated code and shorten the local variables
+        self.minify = kwargs.pop("minify", False)
+        # count the calls, time and output of the macros in the browser
+        self.instrument = kwargs.pop("instrument", False)
+        # `profiler.Profiler` to time the compilation with
+        self.profiler = kwargs.pop("profiler", None)
 
         super(Environment, self).__init__(*args, **kwargs)
 
+    def _parse(self, source, name, filename):
+        if self.profiler is not None and \
+               "phases" in self.profiler.categories:
+            with self.profiler.measure("phases", "parse"):
+                return self._parse_cached(source, name, filename)
+        return self._parse_cached(source, name, filename)
+
+    def _parse_cached(self, source, name, filename):
+        if self.parse_cache is None:
+            return super(Environment, self)._parse(source, name, filename)
+
+        node = self.parse_cache.load(self, source)
+        if node is None:
+            node = super(Environment, self)._parse(source, name, filename)
+            self.parse_cache.dump(self, source, node)
+        return node
+
 
 def create_environment(packages = [], directories = [],
                        autoescape = [], extensions = [],
@@ -81,6 +215,44 @@ def create_environment(packages = [], directories = [],
         )
 
 
+def encode_strings(value):
+    # JSON gives us unicode strings but we output byte strings
+    if isinstance(value, unicode):
+        return value.encode("utf-8")
+    if isinstance(value, list):
+        return [encode_strings(item) for item in value]
+    if isinstance(value, dict):
+        return dict([(encode_strings(key), encode_strings(item))
+                     for key, item in value.items()])
+    return value
+
+
+def parse_defines(defines):
+    """
+    Parse a list of `name=value` strings into a dictionary of compile time
+    constants. Values are read as JSON, anything that isn't valid JSON is a
+    string.
+    """
+    result = {}
+    for define in defines:
+        if "=" not in define:
+            raise ValueError("Invalid define %r, expected name=value" % define)
+        name, value = define.split("=", 1)
+        try:
+            value = json.loads(value)
+        except ValueError:
+            pass
+        result[name.strip()] = encode_strings(value)
+    return result
+
+
+def asbool(value):
+    # Read a boolean option from a Paste config, where it is a string
+    if isinstance(value, basestring):
+        return value.strip().lower() in ("true", "yes", "on", "1")
+    return bool(value)
+
+
 def parse_environment(config):
     return create_environment(
         packages = config.get("packages", "").split(),
@@ -89,5 +261,12 @@ def parse_environment(config):
         writer = config.get("writer", "pwt.jinja2js.jscompiler.StringBuilder"),
         add_compiler_annotations = bool(config.get(
             "add_compiler_annotations", False)),
-        strip_html_whitespace = bool(config.get("strip_html_whitespace", False))
+        strip_html_whitespace = bool(config.get("strip_html_whitespace", False)),
+        # one define per line, JSON values can contain spaces
+        defines = parse_defines([
+            line.strip() for line in config.get("defines", "").splitlines()
+            if line.strip()]),
+        inline_threshold = int(config.get("inline_threshold", 0)),
+        minify = asbool(config.get("minify", False)),
+        instrument = asbool(config.get("instrument", False)),
         )
@@ -1,13 +1,17 @@
+import copy
+import hashlib
 import re
 
 from cStringIO import StringIO
 
-from jinja2.visitor import NodeVisitor
+from jinja2.visitor import NodeVisitor, NodeTransformer
 import jinja2.nodes
 import jinja2.compiler
+import jinja2.environment
 import jinja2.ext
 from jinja2.utils import escape
 
+import minify
 import nodes
 
 try:
@@ -17,6 +21,30 @@ except NameError:
         return it.next()
 
 
+class _NotMeasured(object):
+
+    def __enter__(self):
+        pass
+
+    def __exit__(self, *exc_info):
+        return False
+
+_not_measured = _NotMeasured()
+
+def measure(environment, category, name):
+    # Time the `with` block if the environment has a `profiler.Profiler`
+    profiler = getattr(environment, "profiler", None)
+    if profiler is None or category not in profiler.categories:
+        return _not_measured
+    return profiler.measure(category, name)
+
+def count(environment, name):
+    # Count some of the generated code if the environment has a profiler
+    profiler = getattr(environment, "profiler", None)
+    if profiler is not None:
+        profiler.count(name)
+
+
 class Namespace(jinja2.ext.Extension):
     """
     [Token(1, 'name', 'examples'),
@@ -58,6 +86,102 @@ OPERATORS = {
     }
 
 
+def find_imports(node):
+    """
+    Return the names of the templates imported by the template `node`, in
+    the order they are imported.
+    """
+    names = []
+    for imp in node.find_all(jinja2.nodes.Import):
+        if isinstance(imp.template, jinja2.nodes.Const) and \
+               imp.template.value not in names:
+            names.append(imp.template.value)
+    return names
+
+
+class NamespaceEntry(object):
+
+    def __init__(self, name, filename, namespace, imports, uptodate,
+                 checksum = None):
+        self.name = name
+        self.filename = filename
+        self.namespace = namespace
+        self.imports = imports
+        self.uptodate = uptodate
+        # SHA1 of the source of the template
+        self.checksum = checksum
+
+    def is_up_to_date(self):
+        if self.uptodate is None:
+            return True
+        return self.uptodate()
+
+
+class NamespaceIndex(object):
+    """
+    Map template names to the namespace they declare and the templates
+    they import.
+
+    Templates are only parsed the first time they are looked up or after
+    the loaders `uptodate` callback reports that they have changed. The
+    entries are kept in the same kind of cache as the compiled templates of
+    the environment, so a long running process only keeps the most recently
+    used `cache_size` of them.
+    """
+
+    def __init__(self, environment):
+        self.environment = environment
+        self.entries = jinja2.environment.copy_cache(
+            getattr(environment, "cache", {}))
+
+    def get(self, name):
+        entry = None
+        if self.entries is not None:
+            entry = self.entries.get(name)
+        if entry is not None and entry.is_up_to_date():
+            return entry
+
+        source, filename, uptodate = self.environment.loader.get_source(
+            self.environment, name)
+        node = self.environment._parse(source, name, filename)
+
+        namespace = list(node.find_all(nodes.NamespaceNode))
+        if len(namespace) != 1:
+            raise jinja2.compiler.TemplateAssertionError(
+                "You must supply one namespace for your template",
+                0,
+                name,
+                filename)
+
+        if isinstance(source, unicode):
+            source = source.encode("utf-8")
+        entry = NamespaceEntry(
+            name, filename, namespace[0].namespace, find_imports(node),
+            uptodate, hashlib.sha1(source).hexdigest())
+        if self.entries is not None:
+            self.entries[name] = entry
+        return entry
+
+    def get_namespace(self, name):
+        return self.get(name).namespace
+
+    def get_imports(self, name):
+        return self.get(name).imports
+
+    def clear(self):
+        if self.entries is not None:
+            self.entries.clear()
+
+
+def get_namespace_index(environment):
+    # One index per environment. Plain Jinja2 environments get one the
+    # first time they are used to compile a template.
+    index = getattr(environment, "namespace_index", None)
+    if index is None:
+        index = environment.namespace_index = NamespaceIndex(environment)
+    return index
+
+
 class JSFrameIdentifierVisitor(jinja2.compiler.FrameIdentifierVisitor):
 
     def __init__(self, identifiers, environment, ctx):
@@ -95,19 +219,7 @@ class JSFrameIdentifierVisitor(jinja2.compiler.FrameIdentifierVisitor):
 
         # Need to find namespace
         name = node.template.value
-        source, filename, uptodate = self.environment.loader.get_source(
-            self.environment, name)
-        fromnode = self.environment._parse(source, name, filename)
-
-        # Need to find the namespace
-        namespace = list(fromnode.find_all(nodes.NamespaceNode))
-        if len(namespace) != 1:
-            raise jinja2.compiler.TemplateAssertionError(
-                "You must supply one namespace for your template",
-                0,
-                name,
-                filename)
-        namespace = namespace[0].namespace
+        namespace = get_namespace_index(self.environment).get_namespace(name)
 
         self.identifiers.imports[node.target] = namespace.encode("utf-8")
 
@@ -157,6 +269,17 @@ class JSFrame(jinja2.compiler.Frame):
         # Name of variable prefix containing the variables.
         self.parameter_prefix = "opt"
 
+        # parameters with a default value are copied into local variables,
+        # this maps the parameter name to the variable.
+        self.parameter_locals = {}
+
+        # attribute chains, like ("user", "profile", "url"), that are cached
+        # in local variables inside a for loop.
+        self.hoisted_names = {}
+
+        # macros defined in the template, by name
+        self.macros = {}
+
     def inspect(self, nodes):
         """Walk the node and check for identifiers.  If the scope is hard (eg:
         enforce on a python level) overrides from outer scopes are tracked
@@ -164,15 +287,45 @@ class JSFrame(jinja2.compiler.Frame):
         """
         visitor = JSFrameIdentifierVisitor(
             self.identifiers, self.environment, self.eval_ctx)
-        for node in nodes:
-            visitor.visit(node)
+        with measure(self.environment, "phases", "inspect"):
+            for node in nodes:
+                visitor.visit(node)
 
     def inner(self):
         frame = JSFrame(self.environment, self.eval_ctx, self)
         frame.identifiers.imports = self.identifiers.imports
+        frame.macros = self.macros
         return frame
 
 
+# Defines `jinja2jsInstrument`, which wraps a macro to count its calls, the
+# time spent in it and the length of its output in `jinja2jsStats`.
+INSTRUMENT_HELPER = [
+    (0, "if (typeof jinja2jsStats == 'undefined') { var jinja2jsStats = {}; }"),
+    (0, "if (typeof jinja2jsInstrument == 'undefined') {"),
+    (1, "var jinja2jsInstrument = function(name, macro) {"),
+    (2, "var now = typeof performance != 'undefined' && performance.now ?"),
+    (3, "function() { return performance.now(); } :"),
+    (3, "function() { return Date.now(); };"),
+    (2, "var stats = jinja2jsStats[name] = {calls: 0, time: 0, length: 0};"),
+    (2, "return function(opt_data, opt_sb, opt_caller) {"),
+    (3, "var length = opt_sb && opt_sb.getLength ? opt_sb.getLength() : 0;"),
+    (3, "var start = now();"),
+    (3, "var output = macro(opt_data, opt_sb, opt_caller);"),
+    (3, "stats.time += now() - start;"),
+    (3, "stats.calls++;"),
+    (3, "if (output != null) {"),
+    (4, "stats.length += String(output).length;"),
+    (3, "} else if (opt_sb && opt_sb.getLength) {"),
+    (4, "stats.length += opt_sb.getLength() - length;"),
+    (3, "}"),
+    (3, "return output;"),
+    (2, "};"),
+    (1, "};"),
+    (0, "}"),
+    ]
+
+
 class StringBuilder(object):
 
     def __init__(self, environment=None):
@@ -185,9 +338,19 @@ class StringBuilder(object):
         self.debug_info = []
         self._write_debug_info = None
 
+        # (stream offset, template line number, template name) for every
+        # marked node, used to build the source map.
+        self.mappings = []
+        self._write_mapping = None
+        # name of the template the code is generated from
+        self.source = None
+
         # the number of new lines before the next write()
         self._new_lines = 0
 
+        # how deep we are inside dynamic values of the output
+        self._value_depth = 0
+
         # the line number of the last written statement
         self._last_line = 0
 
@@ -200,6 +363,29 @@ class StringBuilder(object):
         # the character(s) to display as a single indent
         self._indentation_text = getattr(environment, 'js_indentation', '    ')
 
+        # namespaces already provided and required. When several templates
+        # share a writer each namespace is only set up once.
+        self.provided = set()
+        self.required = set()
+
+        # Stream positions used to merge consecutive output statements. They
+        # are only valid until the next call to write().
+        # - start of the literal of the last constant written
+        self._last_const = None
+        # - start of the end of the last output statement, with the constant
+        #   that ended it if any.
+        self._append_end = None
+        self._append_const = None
+        # - constant to fuse with the next constant written after reopening
+        #   an output statement.
+        self._const_merge = None
+
+        # true while the output of a macro is written as one expression
+        self.expression = False
+
+        # true once the helper counting the macro calls is written
+        self.instrumented = False
+
     # Copied
     def indent(self):
         """Indent by one."""
@@ -213,6 +399,8 @@ class StringBuilder(object):
     # Modified
     def write(self, x, node = None):
         """Write a string into the output stream."""
+        self._last_const = self._append_end = None
+        self._append_const = self._const_merge = None
         self.mark(node)
         if self._new_lines:
             if not self._first_write:
@@ -225,7 +413,12 @@ class StringBuilder(object):
             self._first_write = False
             self.stream.write(self._indentation_text * self._indentation)
             self._new_lines = 0
+        if self._write_mapping is not None:
+            self.mappings.append(
+                (self.stream.tell(), self._write_mapping, self.source))
+            self._write_mapping = None
         self.stream.write(x)
+        self.code_lineno += x.count("\n")
 
     # Copied
     def writeline(self, x, node=None, extra=0):
@@ -233,10 +426,40 @@ class StringBuilder(object):
         self.newline(node, extra)
         self.write(x)
 
+    def write_code(self, code, writer = None):
+        """
+        Write the `code` generated by an other `writer`, keeping the debug
+        information and the source mappings of the writer.
+        """
+        self.write("")
+        start = self.stream.tell()
+        code_lineno = self.code_lineno
+        self.write(code)
+        if writer is None:
+            return
+        for lineno, line in writer.debug_info:
+            self.debug_info.append((lineno, code_lineno + line - 1))
+        for offset, lineno, source in writer.mappings:
+            self.mappings.append((start + offset, lineno, source))
+
+    def set_source(self, source):
+        # The code written from now on is generated from the template named
+        # `source`.
+        self.source = source
+        self._last_line = 0
+
+    def truncate(self, position):
+        # Remove the output after `position`, along with its mappings.
+        self.stream.seek(position)
+        self.stream.truncate()
+        while self.mappings and self.mappings[-1][0] > position:
+            self.mappings.pop()
+
     def mark(self, node):
         # Mark the current output to correspond to the node.
         if node is not None and node.lineno != self._last_line:
             self._write_debug_info = node.lineno
+            self._write_mapping = node.lineno
             self._last_line = node.lineno
 
     # Modified
@@ -248,15 +471,42 @@ class StringBuilder(object):
     # special methods that we can override to comform to different code styles
 
     def writeline_provides(self, node, frame, namespace):
+        if namespace in self.provided:
+            return
+        self.provided.add(namespace)
         self.writeline("goog.provide('" + namespace + "');")
 
     def writeline_require(self, node, frame, namespace):
+        if namespace in self.required:
+            return
         self.newline(node)
         self.write_require(node, frame, namespace)
 
     def write_require(self, node, frame, namespace):
+        if namespace in self.required:
+            return
+        self.required.add(namespace)
         self.write("goog.require('%s');" % namespace)
 
+    def writeline_instrument_helper(self, node, frame):
+        if self.instrumented:
+            return
+        self.instrumented = True
+        depth = 0
+        for indent, line in INSTRUMENT_HELPER:
+            while depth < indent:
+                self.indent()
+                depth += 1
+            if depth > indent:
+                self.outdent(depth - indent)
+                depth = indent
+            self.writeline(line, node)
+        self.outdent(depth)
+
+    def writeline_instrument(self, node, frame, name):
+        self.writeline("%s = jinja2jsInstrument('%s', %s);" %(
+            name, name, name), node)
+
     # output formating
 
     def writeline_startoutput(self, node, frame):
@@ -269,14 +519,92 @@ class StringBuilder(object):
             "if (!%s_sb) return output.toString();" % frame.parameter_prefix)
 
     def writeline_outputappend(self, node, frame):
+        if not self.reopen_outputappend(node, frame):
+            self.start_outputappend(node, frame)
+
+    def reopen_outputappend(self, node, frame):
+        # Peephole: if nothing was written since the last output statement
+        # ended, continue that statement instead of starting a new one.
+        if self._append_end is None or not self.can_reopen():
+            return False
+
+        const = self._append_const
+        self.truncate(self._append_end)
+        # the statement carries on from the current line
+        self._new_lines = 0
+        self._write_debug_info = self._write_mapping = None
+        if node is not None:
+            # the source map can still point into the line
+            self._write_mapping = self._last_line = node.lineno
+
+        self.write_outputappend_add(node, frame)
+        if const is not None:
+            self._const_merge = const + (self.stream.tell(),)
+        return True
+
+    def can_reopen(self):
+        # True if the values added to a reopened output statement can't
+        # change the values already in it.
+        return True
+
+    def adds_values(self):
+        # True if the values of an output statement are added together
+        # with `+`, so that the first two can't both be numbers.
+        return False
+
+    def start_outputappend(self, node, frame):
         self.writeline("output.append(", node)
 
     def write_outputappend_add(self, node, frame):
-        self.write(", ")
+        # Inside a value, filters like `capitalize` join two values together
+        # and not two arguments.
+        if self.expression or self._value_depth:
+            self.write_expression_add(node, frame)
+        else:
+            self.write(", ")
 
-    def write_outputappend_end(self, node, frame):
+    def end_outputappend(self, node, frame):
         self.write(");")
 
+    def write_outputappend_end(self, node, frame):
+        const = self._last_const
+        end = self.stream.tell()
+        self.end_outputappend(node, frame)
+        self._append_end = end
+        self._append_const = const
+
+    def write_outputappend_const(self, node, frame, value):
+        merge = self._const_merge
+        if merge is not None and merge[2] == self.stream.tell():
+            # fuse with the constant that ended the reopened statement
+            self.truncate(merge[0])
+            value = merge[1] + value
+        literal = self.literal(value)
+        self.write(literal)
+        self._last_const = (self.stream.tell() - len(literal), value)
+
+    def literal(self, value):
+        return repr(value)
+
+    def write_outputappend_value(self, node, frame):
+        # called before a dynamic value is written to the output
+        self._value_depth += 1
+
+    def write_outputappend_value_end(self, node, frame):
+        self._value_depth -= 1
+
+    def writeline_startexpression(self, node, frame):
+        self.writeline("var output = ", node)
+
+    def write_expression_add(self, node, frame):
+        self.write(" + ")
+
+    def writeline_endexpression(self, node, frame):
+        self.write(";")
+        self.writeline(
+            "if (!%s_sb) return output;" % frame.parameter_prefix)
+        self.writeline("%s_sb.append(output);" % frame.parameter_prefix)
+
     def write_htmlescape(self, node, frame):
         self.write("goog.string.htmlEscape(String(")
 
@@ -286,10 +614,20 @@ class StringBuilder(object):
 
 class Concat(StringBuilder):
 
+    def __init__(self, environment = None):
+        super(Concat, self).__init__(environment)
+
+        # for each operand of the current output statement, true if it is
+        # known to be a string
+        self._operands = []
+
     def writeline_provides(self, node, frame, namespace):
         parts = namespace.split(".")
         for idx, part in enumerate(parts):
             ns = ".".join(parts[:idx + 1])
+            if ns in self.provided:
+                continue
+            self.provided.add(ns)
             self.writeline(
                 "if (typeof %s == 'undefined') { %s%s = {}; }" %(
                     ns, idx == 0 and "var " or "", ns), node)
@@ -310,13 +648,37 @@ class Concat(StringBuilder):
     def writeline_endoutput(self, node, frame):
         self.writeline("return output;", node)
 
-    def writeline_outputappend(self, node, frame):
+    def can_reopen(self):
+        # `output += a + b` adds numbers together, the statement is only
+        # a string if one of its first two operands is a string.
+        return True in self._operands[:2]
+
+    def adds_values(self):
+        return True
+
+    def start_outputappend(self, node, frame):
+        self._operands = []
         self.writeline("output += ", node)
 
+    def write_outputappend_const(self, node, frame, value):
+        self._operands.append(True)
+        super(Concat, self).write_outputappend_const(node, frame, value)
+
+    def write_outputappend_value(self, node, frame):
+        # the output of a call block is the output of a macro
+        self._operands.append(isinstance(node, jinja2.nodes.CallBlock))
+        super(Concat, self).write_outputappend_value(node, frame)
+
     def write_outputappend_add(self, node, frame):
         self.write(" + ")
 
-    def write_outputappend_end(self, node, frame):
+    def end_outputappend(self, node, frame):
+        self.write(";")
+
+    def writeline_startexpression(self, node, frame):
+        self.writeline("return ", node)
+
+    def writeline_endexpression(self, node, frame):
         self.write(";")
 
     def write_htmlescape(self, node, frame):
@@ -326,6 +688,91 @@ class Concat(StringBuilder):
         self.write(")")
 
 
+class Join(Concat):
+    # Collect the output in an array and join it together once at the end
+    # of the macro.
+
+    # output formating
+
+    def writeline_startoutput(self, node, frame):
+        self.writeline("var output = [];", node)
+
+    def writeline_endoutput(self, node, frame):
+        self.writeline("return output.join('');", node)
+
+    def can_reopen(self):
+        return True
+
+    def adds_values(self):
+        return False
+
+    def start_outputappend(self, node, frame):
+        self.writeline("output.push(", node)
+
+    def write_outputappend_add(self, node, frame):
+        if self.expression or self._value_depth:
+            self.write_expression_add(node, frame)
+        else:
+            self.write(", ")
+
+    def end_outputappend(self, node, frame):
+        self.write(");")
+
+
+class TemplateLiteral(Concat):
+    # Write each run of output as one template literal:
+    #
+    #   output += `Hello ${opt_data.name}!`;
+
+    def can_reopen(self):
+        # everything is inside the template literal
+        return True
+
+    def adds_values(self):
+        return False
+
+    def start_outputappend(self, node, frame):
+        self.writeline("output += `", node)
+
+    def write_outputappend_add(self, node, frame):
+        # Inside a substitution we are back to writing JavaScript, where
+        # filters like `capitalize` need to join two values together.
+        if self._value_depth:
+            self.write(" + ")
+
+    def end_outputappend(self, node, frame):
+        self.write("`;")
+
+    def writeline_startexpression(self, node, frame):
+        self.writeline("return `", node)
+
+    def write_expression_add(self, node, frame):
+        self.write_outputappend_add(node, frame)
+
+    def writeline_endexpression(self, node, frame):
+        self.write("`;")
+
+    def literal(self, value):
+        return escape_template_literal(value)
+
+    def write_outputappend_value(self, node, frame):
+        self.write("${")
+        self._value_depth += 1
+
+    def write_outputappend_value_end(self, node, frame):
+        self._value_depth -= 1
+        self.write("}")
+
+
+_template_literal_escapes = re.compile(r"(\\|`|\$\{|\n|\r)")
+
+def escape_template_literal(value):
+    return _template_literal_escapes.sub(
+        lambda match: {"\n": "\\n", "\r": "\\r"}.get(
+            match.group(0), "\\" + match.group(0)),
+        value)
+
+
 class BaseCodeGenerator(NodeVisitor):
 
     def __init__(self, environment, name, filename):
@@ -335,6 +782,17 @@ class BaseCodeGenerator(NodeVisitor):
         self.name = name
         self.filename = filename
 
+        self.profiler = getattr(environment, "profiler", None)
+        if self.profiler is not None and \
+               "nodes" not in self.profiler.categories:
+            self.profiler = None
+
+    def visit(self, node, *args, **kwargs):
+        if self.profiler is None:
+            return super(BaseCodeGenerator, self).visit(node, *args, **kwargs)
+        with self.profiler.measure("nodes", node.__class__.__name__):
+            return super(BaseCodeGenerator, self).visit(node, *args, **kwargs)
+
     def blockvisit(self, nodes, frame):
         """
         Visit a list of noes ad block in a frame. Some times we want to
@@ -375,15 +833,23 @@ class CodeGenerator(BaseCodeGenerator):
         eval_ctx.encoding = "utf-8"
         eval_ctx.namespace = namespace.encode(eval_ctx.encoding)
 
+        self.writer.set_source(self.name)
+
         # process the root
         frame = JSFrame(self.environment, eval_ctx)
         frame.inspect(node.body)
         frame.toplevel = frame.rootlevel = True
+        for child in node.body:
+            if isinstance(child, jinja2.nodes.Macro):
+                frame.macros[child.name] = child
 
         if namespace:
             self.writer.writeline_provides(node, frame, namespace)
         self.writer.writeline_require(node, frame, "goog.string")
         self.writer.writeline_require(node, frame, "goog.string.StringBuffer")
+        if getattr(self.environment, "instrument", False) and \
+               node.find(jinja2.nodes.Macro) is not None:
+            self.writer.writeline_instrument_helper(node, frame)
         self.writer.newline()
 
         self.blockvisit(node.body, frame)
@@ -399,11 +865,27 @@ class CodeGenerator(BaseCodeGenerator):
             self.writer.__class__(self.environment),
             self.name,
             self.filename)
-        generator.visit(node, frame)
-
-        self.writer.write(generator.writer.stream.getvalue())
+        generator.writer.set_source(self.name)
+        name = node.name
+        if frame.eval_ctx.namespace:
+            name = "%s.%s" %(frame.eval_ctx.namespace, name)
+        with measure(self.environment, "macros", name):
+            # this node has already been counted
+            generator.visit_Macro(node, frame)
+
+        output = generator.writer.stream.getvalue()
+        if getattr(self.environment, "minify", False):
+            # the positions inside the macro are lost so only map its start
+            self.writer.mark(node)
+            self.writer.write(minify.minify(output))
+        else:
+            self.writer.write_code(output, generator.writer)
 
     def visit_TemplateData(self, node, frame):
+        if getattr(self.environment, "minify", False) and \
+               not node.data.strip():
+            # the whitespace between macros
+            return
         self.writer.mark(node)
         self.writer.write(node.data)
 
@@ -442,6 +924,10 @@ class MacroCodeGenerator(BaseCodeGenerator):
 
         self.writer = writer
 
+        # number of macro calls inlined so far, used to name the variables
+        # holding the arguments.
+        self.inlined = 0
+
     def visit_Output(self, node, frame):
         # JS is only interested in macros etc, as all of JavaScript
         # is rendered into the global namespace so we need to ignore data in
@@ -449,51 +935,23 @@ class MacroCodeGenerator(BaseCodeGenerator):
         if frame.toplevel:
             return
 
-        finalize = str # unicode
-
-        # try to evaluate as many chunks as possible into a static
-        # string at compile time.
-        body = []
-        for child in node.nodes:
-            try:
-                const = child.as_const(frame.eval_ctx)
-            except jinja2.nodes.Impossible:
-                body.append(child)
-                continue
-
-            # the frame can't be volatile here, becaus otherwise the
-            # as_const() function would raise an Impossible exception
-            # at that point.
-            try:
-                if frame.eval_ctx.autoescape:
-                    if hasattr(const, '__html__'):
-                        const = const.__html__()
-                    else:
-                        const = escape(const)
-                const = finalize(const)
-            except:
-                # if something goes wrong here we evaluate the node
-                # at runtime for easier debugging
-                body.append(child)
-                continue
-
-            if body and isinstance(body[-1], list):
-                body[-1].append(const)
-            else:
-                body.append([const])
+        body = self.inline_calls(self.output_items(node, frame), frame)
 
         start = True
         for item in body:
+            item_frame = frame
+            if isinstance(item, tuple):
+                # output of an inlined macro
+                item, item_frame = item
+
             if isinstance(item, list):
                 if start:
                     self.writer.writeline_outputappend(node, frame)
                     start = False
                 else:
                     self.writer.write_outputappend_add(node, frame)
-                if getattr(self.environment, "strip_html_whitespace", False):
-                    item = [strip_html_whitespace(itemhtml)
-                            for itemhtml in item]
-                self.writer.write(repr("".join(item)))
+                self.writer.write_outputappend_const(
+                    node, frame, self.output_const(item))
             else:
                 # This is a non-data node.
                 # If we are using the string builder then we generate slightly
@@ -517,25 +975,202 @@ class MacroCodeGenerator(BaseCodeGenerator):
                 else:
                     self.writer.write_outputappend_add(item, frame)
 
-                # autoescape, safe, and escape
-                if isinstance(item, jinja2.nodes.Filter):
-                    if item.name == "safe":
-                        self.visit(item.node, frame)
-                        continue
+                self.writer.mark(item)
+                self.writer.write_outputappend_value(item, frame)
+                self.output_value(node, item, item_frame)
+                self.writer.write_outputappend_value_end(item, frame)
 
+        if not start:
+            self.writer.write_outputappend_end(node, frame)
+
+    def inline_calls(self, body, frame):
+        # Replace the calls in the output `body` to macros that can be inlined
+        # with the output of the macro. The arguments are stored in variables
+        # first, and the values of the macro are returned as tuples of the
+        # node and the frame to output them in.
+        result = []
+
+        def add(item):
+            if isinstance(item, list) and result and \
+                   isinstance(result[-1], list):
+                result[-1] = result[-1] + item
+            else:
+                result.append(item)
+
+        for item in body:
+            callee = not isinstance(item, list) and \
+                     self.inline_macro(item, frame)
+            if not callee:
+                add(item)
+                continue
+
+            inline_frame = self.inline_arguments(item, callee, frame)
+            if self.writer.adds_values():
+                # The call returned a string, make sure the inlined values
+                # are still added to a string and not to each other.
+                add([""])
+            for child in self.fold_ifs(callee.body, inline_frame):
+                for value in self.output_items(child, inline_frame):
+                    if isinstance(value, list):
+                        add(value)
+                    else:
+                        add((value, inline_frame))
+
+        return result
+
+    def inline_macro(self, node, frame):
+        # Returns the macro that the call `node` can be replaced with, if any.
+        # Only small macros, defined in this template, that don't call any
+        # other functions and only contain output are inlined.
+        threshold = getattr(self.environment, "inline_threshold", 0)
+        if not threshold or not isinstance(node, jinja2.nodes.Call) or \
+               node.args or node.dyn_args or node.dyn_kwargs or \
+               frame.eval_ctx.autoescape:
+            return None
+
+        if isinstance(node.node, jinja2.nodes.Name):
+            name = node.node.name
+            if self.is_variable(name, frame):
+                return None
+        else:
+            chain = attribute_chain(node.node)
+            if chain is None or \
+                   ".".join(chain[:-1]) != frame.eval_ctx.namespace:
+                return None
+            name = chain[-1]
+
+        callee = frame.macros.get(name)
+        if callee is None or callee.find(jinja2.nodes.Call) is not None:
+            # this also rules out recursion
+            return None
+
+        # the body may only refer to the parameters, other names could be
+        # shadowed by the variables at the call site.
+        params = set([arg.name for arg in callee.args])
+        for child in callee.find_all(jinja2.nodes.Name):
+            if child.name not in params:
+                return None
+
+        for kwarg in node.kwargs:
+            if kwarg.key not in params:
+                return None
+
+        size = 0
+        for child in self.fold_ifs(callee.body, frame):
+            if not isinstance(child, jinja2.nodes.Output):
+                return None
+            size += 1 + len(list(child.find_all(jinja2.nodes.Node)))
+        if size > threshold:
+            return None
+
+        return callee
+
+    def is_variable(self, name, frame):
+        # True if `name` refers to a variable and not a macro
+        return name in frame.identifiers.declared_parameter or \
+               name in frame.reassigned_names or \
+               name in frame.identifiers.declared or \
+               name in frame.identifiers.declared_locally or \
+               name in frame.identifiers.imports or \
+               (frame.parent is not None and
+                name in frame.parent.identifiers.declared_parameter)
+
+    def inline_arguments(self, node, callee, frame):
+        # Write the arguments of the call `node` into local variables and
+        # return the frame to output the body of `callee` in.
+        self.inlined += 1
+        inline_frame = self.function_scoping(
+            callee, frame, parameter_prefix = frame.parameter_prefix)
+
+        kwargs = dict([(kwarg.key, kwarg.value) for kwarg in node.kwargs])
+        defaults = dict(zip(
+            [arg.name for arg in callee.args[len(callee.args) -
+                                             len(callee.defaults):]],
+            callee.defaults))
+
+        for arg in callee.args:
+            if arg.name in kwargs:
+                value, value_frame = kwargs[arg.name], frame
+            elif arg.name in defaults:
+                value, value_frame = defaults[arg.name], inline_frame
+            else:
+                inline_frame.parameter_locals[arg.name] = "undefined"
+                continue
+
+            local = "%s%s%d" %(
+                callee.name, arg.name[:1].upper() + arg.name[1:], self.inlined)
+            self.writer.writeline("var %s = " % local, node)
+            self.visit(value, value_frame)
+            self.writer.write(";")
+            inline_frame.parameter_locals[arg.name] = local
+
+        return inline_frame
+
+    def output_items(self, node, frame, body = None):
+        # Returns the children of the output node, with runs of constant
+        # children evaluated into lists of strings. The items are added to
+        # `body` if given.
+        if body is None:
+            body = []
+
+        finalize = str # unicode
+
+        # try to evaluate as many chunks as possible into a static
+        # string at compile time.
+        for child in node.nodes:
+            try:
+                const = as_const(child, frame.eval_ctx)
+            except jinja2.nodes.Impossible:
+                body.append(child)
+                continue
+
+            # the frame can't be volatile here, becaus otherwise the
+            # as_const() function would raise an Impossible exception
+            # at that point.
+            try:
+                const = js_string(const)
                 if frame.eval_ctx.autoescape:
-                    self.writer.write_htmlescape(node, frame)
-                    escaped_frame = frame.soft()
-                    escaped_frame.escaped = True
+                    if hasattr(const, '__html__'):
+                        const = const.__html__()
+                    else:
+                        const = escape(const)
+                const = finalize(const)
+            except:
+                # if something goes wrong here we evaluate the node
+                # at runtime for easier debugging
+                body.append(child)
+                continue
 
-                    self.visit(item, escaped_frame)
+            if body and isinstance(body[-1], list):
+                body[-1].append(const)
+            else:
+                body.append([const])
 
-                    self.writer.write_htmlescape_end(node, frame)
-                else:
-                    self.visit(item, frame)
+        return body
 
-        if not start:
-            self.writer.write_outputappend_end(node, frame)
+    def output_const(self, item):
+        if getattr(self.environment, "strip_html_whitespace", False):
+            item = [strip_html_whitespace(itemhtml) for itemhtml in item]
+        return "".join(item)
+
+    def output_value(self, node, item, frame):
+        # autoescape, safe, and escape
+        if isinstance(item, jinja2.nodes.Filter):
+            if item.name == "safe":
+                self.visit(item.node, frame)
+                return
+
+        if frame.eval_ctx.autoescape:
+            count(self.environment, "escapes")
+            self.writer.write_htmlescape(node, frame)
+            escaped_frame = frame.soft()
+            escaped_frame.escaped = True
+
+            self.visit(item, escaped_frame)
+
+            self.writer.write_htmlescape_end(node, frame)
+        else:
+            self.visit(item, frame)
 
     def visit_Filter(self, node, frame):
         # safe attribute with autoesacape is handled in visit_Output
@@ -544,6 +1179,7 @@ class MacroCodeGenerator(BaseCodeGenerator):
                 raise Exception("No kwargs")
 
             if not frame.escaped:
+                count(self.environment, "escapes")
                 self.writer.write_htmlescape(node, frame)
                 frame = frame.soft()
                 frame.escaped = True
@@ -625,7 +1261,8 @@ class MacroCodeGenerator(BaseCodeGenerator):
         isparam = False
 
         if name in frame.identifiers.declared_parameter:
-            output = frame.parameter_prefix + "_data." + name
+            output = frame.parameter_locals.get(
+                name, frame.parameter_prefix + "_data." + name)
 
             # neccessary?
             frame.assigned_names.add(frame.parameter_prefix + "_data." + name)
@@ -634,7 +1271,8 @@ class MacroCodeGenerator(BaseCodeGenerator):
                name in frame.parent.identifiers.declared_parameter:
             # Once we have tried any local variables we need to check
             # the parent if we have a declared parameter from there
-            output = frame.parent.parameter_prefix + "_data." + name
+            output = frame.parent.parameter_locals.get(
+                name, frame.parent.parameter_prefix + "_data." + name)
 
             frame.assigned_names.add(
                 frame.parent.parameter_prefix + "_data." + name)
@@ -720,6 +1358,13 @@ class MacroCodeGenerator(BaseCodeGenerator):
                 self.writer.write("%sListLen" % frame.forloop_buffer)
             else:
                 raise AttributeError("loop.%s not defined" % node.attr)
+        elif frame.hoisted_names and \
+                 attribute_chain(node) in frame.hoisted_names:
+            output = frame.hoisted_names[attribute_chain(node)]
+            if dotted_name is None:
+                self.writer.write(output)
+            else:
+                dotted_name.append(output)
         else:
             # write_variable is going to be true if dotted_name is None which
             # implies that we are gathering the variable name together. So
@@ -801,22 +1446,80 @@ class MacroCodeGenerator(BaseCodeGenerator):
 
     def visit_If(self, node, frame):
         if_frame = frame.soft()
+
+        # Only output the branch that is taken if we know the test at
+        # compile time.
+        test = self.const_test(node, frame)
+        if test is not None:
+            self.blockvisit(
+                self.fold_ifs(node.body if test else node.else_, frame),
+                if_frame)
+            return
+
+        body = self.fold_ifs(node.body, frame)
+        else_ = self.fold_ifs(node.else_, frame)
+
+        if not body and not else_ and \
+               not isinstance(node.test, jinja2.nodes.Call) and \
+               not list(node.test.find_all(jinja2.nodes.Call)):
+            # nothing to do
+            return
+
+        if not body and else_:
+            self.writer.writeline("if (!(", node)
+            self.visit(node.test, if_frame)
+            self.writer.write(")) {")
+
+            self.writer.indent()
+            self.blockvisit(else_, if_frame)
+            self.writer.outdent()
+            self.writer.writeline("}")
+            return
+
         self.writer.writeline("if (", node)
         self.visit(node.test, if_frame)
         self.writer.write(") {")
 
         self.writer.indent()
-        self.blockvisit(node.body, if_frame)
+        self.blockvisit(body, if_frame)
         self.writer.outdent()
 
-        if node.else_:
+        if else_:
             self.writer.writeline("} else {")
             self.writer.indent()
-            self.blockvisit(node.else_, if_frame)
+            self.blockvisit(else_, if_frame)
             self.writer.outdent()
 
         self.writer.writeline("}")
 
+    def const_test(self, node, frame):
+        # Returns True or False if the test of the if statement `node` is
+        # known at compile time, else None.
+        try:
+            value = as_const(node.test, frame.eval_ctx)
+        except jinja2.nodes.Impossible:
+            return None
+        # lists and objects are always true in JavaScript
+        if value is None or \
+               isinstance(value, (bool, int, long, float, basestring)):
+            return bool(value)
+        return None
+
+    def fold_ifs(self, nodes, frame):
+        # Replace the if statements in `nodes` whose test is known at
+        # compile time with the nodes of the branch that is taken.
+        folded = []
+        for node in nodes:
+            test = None
+            if isinstance(node, jinja2.nodes.If):
+                test = self.const_test(node, frame)
+            if test is None:
+                folded.append(node)
+            else:
+                folded.extend(self.fold_ifs(
+                    node.body if test else node.else_, frame))
+        return folded
+
     def visit_For(self, node, frame):
         children = node.iter_child_nodes(exclude = ("iter",))
 
@@ -827,8 +1530,9 @@ class MacroCodeGenerator(BaseCodeGenerator):
         # try to figure out if we have an extended loop.  An extended loop
         # is necessary if the loop is in recursive mode or if the special loop
         # variable is accessed in the body.
-        extended_loop = "loop" in jinja2.compiler.find_undeclared(
-            node.iter_child_nodes(only = ("body",)), ("loop",))
+        with measure(self.environment, "phases", "find_undeclared"):
+            extended_loop = "loop" in jinja2.compiler.find_undeclared(
+                node.iter_child_nodes(only = ("body",)), ("loop",))
 
         loop_frame = frame.soft() # JavaScript for loops don't change namespace
 
@@ -861,6 +1565,20 @@ class MacroCodeGenerator(BaseCodeGenerator):
                 "name": node.target.name})
         loop_frame.reassigned_names[node.target.name] = \
                                                      "%sData" % node.target.name
+
+        # Cache attribute chains that are used more then once in the body
+        loop_frame.hoisted_names = dict(frame.hoisted_names)
+        for chain, attr in self.hoisted_attributes(node, loop_frame):
+            # `$` can't appear in a template name so this can't collide
+            # with the loop variables or any other local variable.
+            name = "$".join(chain)
+            if name in loop_frame.hoisted_names.values():
+                continue
+            self.writer.writeline("var %s = " % name)
+            self.visit(attr, loop_frame)
+            self.writer.write(";")
+            loop_frame.hoisted_names[chain] = name
+
         self.blockvisit(node.body, loop_frame)
         self.writer.outdent()
         self.writer.writeline("}")
@@ -873,6 +1591,91 @@ class MacroCodeGenerator(BaseCodeGenerator):
             self.writer.outdent()
             self.writer.writeline("}")
 
+    def hoisted_attributes(self, node, frame):
+        # Returns the attribute chains, with the first Getattr node of each,
+        # that are worth caching at the start of the body of the for loop
+        # `node`. A chain is cached if it is at least two attributes deep,
+        # is used more then once, is always evaluated in the body and its
+        # base variable doesn't change inside the loop.
+        stored = set()
+        for child in node.body:
+            for name in child.find_all(jinja2.nodes.Name):
+                if name.ctx != "load":
+                    stored.add(name.name)
+
+        counts = {}
+        nodes = {}
+        order = []
+        always = set()
+
+        def visit(child, conditional):
+            if isinstance(child, (jinja2.nodes.Macro, jinja2.nodes.CallBlock)):
+                # these compile to functions of their own
+                return
+            if isinstance(child, jinja2.nodes.Getattr):
+                chain = attribute_chain(child)
+                if chain is not None:
+                    if chain not in counts:
+                        counts[chain] = 0
+                        nodes[chain] = child
+                        order.append(chain)
+                    counts[chain] += 1
+                    if not conditional:
+                        always.add(chain)
+                    return
+            if isinstance(child, jinja2.nodes.Call):
+                # caching a method would change `this` when calling it
+                if attribute_chain(child.node) is None:
+                    visit(child.node, conditional)
+                for arg in child.iter_child_nodes(exclude = ("node",)):
+                    visit(arg, conditional)
+                return
+
+            # nodes that only evaluate some of their children
+            if isinstance(child, jinja2.nodes.If):
+                always_fields = ("test",)
+            elif isinstance(child, jinja2.nodes.For):
+                always_fields = ("iter",)
+            elif isinstance(child, jinja2.nodes.CondExpr):
+                always_fields = ("test",)
+            elif isinstance(child, (jinja2.nodes.And, jinja2.nodes.Or)):
+                always_fields = ("left",)
+            elif isinstance(child, (jinja2.nodes.Filter, jinja2.nodes.Test)):
+                always_fields = ("node",)
+            else:
+                always_fields = None
+
+            for field, value in child.iter_fields():
+                if isinstance(value, jinja2.nodes.Node):
+                    value = [value]
+                elif not isinstance(value, list):
+                    continue
+                for item in value:
+                    if isinstance(item, jinja2.nodes.Node):
+                        visit(item, conditional or (
+                            always_fields is not None and
+                            field not in always_fields))
+
+        for child in node.body:
+            visit(child, False)
+
+        hoisted = []
+        for chain in order:
+            base = chain[0]
+            if len(chain) < 3 or counts[chain] < 2 or chain not in always:
+                continue
+            if base in stored or base == "loop" or \
+                   chain in frame.hoisted_names:
+                continue
+            if base not in frame.reassigned_names and \
+                   base not in frame.identifiers.declared_parameter and \
+                   (frame.parent is None or
+                    base not in frame.parent.identifiers.declared_parameter):
+                # only cache chains on the loop variables and parameters
+                continue
+            hoisted.append((chain, nodes[chain]))
+        return hoisted
+
     def function_scoping(self, node, frame, parameter_prefix, children = None):
         if children is None:
             children = node.iter_child_nodes()
@@ -926,44 +1729,97 @@ class MacroCodeGenerator(BaseCodeGenerator):
                 name,
                 frame.parameter_prefix,
                 frame.parameter_prefix,
-                frame.parameter_prefix))
+                frame.parameter_prefix), node)
         self.writer.indent()
         if node.defaults:
-            # We have defaults to work with. Loop over all the default keys
-            # and set the value in opt_data if it is not already set.
-            self.writer.writeline("var defaults = {")
-            start = True
+            # Copy the parameters with defaults into local variables so that
+            # we don't change the callers data:
+            #
+            #   var nameParam = 'name' in opt_data ? opt_data.name : 'World';
             for arg, default in zip(
                     node.args[-len(node.defaults):], node.defaults):
-                # get arg value.
-                if not start:
-                    self.writer.write(", ")
-                isparam = self.visit(arg, frame, [])
-                assert isparam == True, \
+                assert arg.name in frame.identifiers.declared_parameter, \
                        "dosn't make sense, having a non parameter parameter"
-                self.writer.write("%s: " % arg.name)
-                isparam = self.visit(default, frame)
-
-                start = False
-            self.writer.write("};")
-            self.writer.writeline("for (var key in defaults) {")
-            self.writer.indent()
-            self.writer.writeline(
-                "if (!(key in %s_data)) {" % frame.parameter_prefix)
-            self.writer.indent()
-            self.writer.writeline(
-                "%s_data[key] = defaults[key];" % (
-                    frame.parameter_prefix))
-            self.writer.outdent()
-            self.writer.writeline("}")
-            self.writer.outdent()
-            self.writer.writeline("}")
-        self.writer.writeline_startoutput(node, frame)
-        self.blockvisit(node.body, frame)
-        self.writer.writeline_endoutput(node, frame)
+                self.writer.writeline(
+                    "var %sParam = '%s' in %s_data ? %s_data.%s : " %(
+                        arg.name, arg.name, frame.parameter_prefix,
+                        frame.parameter_prefix, arg.name))
+                self.visit(default, frame)
+                self.writer.write(";")
+                frame.parameter_locals[arg.name] = "%sParam" % arg.name
+        body = self.expression_items(node, frame)
+        if body is not None:
+            self.expression_body(node, frame, body)
+        else:
+            self.writer.writeline_startoutput(node, frame)
+            self.blockvisit(node.body, frame)
+            self.writer.writeline_endoutput(node, frame)
         self.writer.outdent()
         self.writer.writeline("};")
 
+    def expression_items(self, node, frame):
+        # If the body of the macro only contains output then return the
+        # items to output, else None.
+        body = []
+        for child in self.fold_ifs(node.body, frame):
+            if not isinstance(child, jinja2.nodes.Output):
+                return None
+            self.output_items(child, frame, body)
+
+        if self.writer.__class__.__name__ == STRINGBUILDER:
+            # macros called with the string builder write to the output.
+            for item in body:
+                if isinstance(item, list) or self.inline_macro(item, frame):
+                    continue
+                if isinstance(item, jinja2.nodes.Call) or \
+                       list(item.find_all(jinja2.nodes.Call)):
+                    return None
+
+        return body
+
+    def expression_body(self, node, frame, body):
+        # Return the output of the macro as a single expression:
+        #
+        #   return 'Hello ' + opt_data.name;
+        body = self.inline_calls(body, frame)
+        if not body or not isinstance(body[0], list):
+            # make sure the expression is a string
+            body.insert(0, [""])
+
+        self.writer.writeline_startexpression(node, frame)
+        self.writer.expression = True
+        start = True
+        for item in body:
+            if not start:
+                self.writer.write_expression_add(node, frame)
+            start = False
+
+            item_frame = frame
+            if isinstance(item, tuple):
+                item, item_frame = item
+
+            if isinstance(item, list):
+                self.writer.write(self.writer.literal(self.output_const(item)))
+                continue
+
+            # comparisons and, with the string builder, conditional
+            # expressions bind looser than the `+` around them.
+            parens = not isinstance(self.writer, TemplateLiteral) and (
+                isinstance(item, jinja2.nodes.Compare) or
+                (isinstance(item, jinja2.nodes.CondExpr) and
+                 not isinstance(self.writer, Concat)))
+
+            self.writer.mark(item)
+            self.writer.write_outputappend_value(item, frame)
+            if parens:
+                self.writer.write("(")
+            self.output_value(node, item, item_frame)
+            if parens:
+                self.writer.write(")")
+            self.writer.write_outputappend_value_end(item, frame)
+        self.writer.expression = False
+        self.writer.writeline_endexpression(node, frame)
+
     def visit_Macro(self, node, frame):
         name = node.name
         if frame.eval_ctx.namespace:
@@ -981,6 +1837,9 @@ class MacroCodeGenerator(BaseCodeGenerator):
         body = self.macro_body(name, node, frame)
         frame.assigned_names.add("%s.%s" %(frame.eval_ctx.namespace, node.name))
 
+        if getattr(self.environment, "instrument", False):
+            self.writer.writeline_instrument(node, frame, name)
+
     def visit_CallBlock(self, node, frame):
         # node.call
         # node.body
@@ -994,16 +1853,19 @@ class MacroCodeGenerator(BaseCodeGenerator):
         # call the macro passing in the caller method
         if self.writer.__class__.__name__ == STRINGBUILDER:
             self.writer.newline(node)
-        elif self.writer.__class__.__name__ == CONCAT:
+            self.visit(node.call, frame, forward_caller = "func_caller")
+            self.writer.write(";")
+        elif isinstance(self.writer, Concat):
             self.writer.writeline_outputappend(node, frame)
+            self.writer.write_outputappend_value(node, frame)
+            self.visit(node.call, frame, forward_caller = "func_caller")
+            self.writer.write_outputappend_value_end(node, frame)
+            self.writer.write_outputappend_end(node, frame)
         else:
             # XXX - we shouldn't get here
             raise jinja2.compiler.TemplateAssertionError(
                 "Unknown writer class", node.lineno, self.name, self.filename)
 
-        self.visit(node.call, frame, forward_caller = "func_caller")
-        self.writer.write(";")
-
     def signature(self, node, frame, forward_caller):
         if node.args and node.kwargs:
             raise jinja2.compiler.TemplateAssertionError(
@@ -1049,7 +1911,7 @@ class MacroCodeGenerator(BaseCodeGenerator):
             self.writer.write(", output")
 
         if forward_caller is not None:
-            if self.writer.__class__.__name__ == CONCAT:
+            if isinstance(self.writer, Concat):
                 # XXX - This is a hack to get around inconsistencies
                 # between the two different styles.
                 self.writer.write(", null")
@@ -1086,7 +1948,7 @@ class MacroCodeGenerator(BaseCodeGenerator):
         self.writer.write(";")
 
     def visit_CondExpr(self, node, frame):
-        if self.writer.__class__.__name__ == CONCAT:
+        if isinstance(self.writer, Concat):
             self.writer.write('(')
         self.visit(node.test, frame)
         self.writer.write(' ? ')
@@ -1100,13 +1962,27 @@ class MacroCodeGenerator(BaseCodeGenerator):
             self.visit(node.expr2, frame)
         else:
             self.writer.write("''")
-        if self.writer.__class__.__name__ == CONCAT:
+        if isinstance(self.writer, Concat):
             self.writer.write(')')
 
 _pre_tag_whitespace = re.compile(r'\s*<')
 _post_tag_whitespace = re.compile(r'>\s*')
 _excess_whitespace = re.compile(r'\s\s+')
 
+def attribute_chain(node):
+    # Returns ("user", "profile", "url") for `user.profile.url` or None if
+    # `node` isn't a chain of attributes on a variable.
+    attrs = []
+    while isinstance(node, jinja2.nodes.Getattr):
+        attrs.append(node.attr)
+        node = node.node
+    if not attrs or not isinstance(node, jinja2.nodes.Name):
+        return None
+    attrs.append(node.name)
+    attrs.reverse()
+    return tuple(attrs)
+
+
 def strip_html_whitespace(value):
     value = _pre_tag_whitespace.sub('<', value)
     value = _post_tag_whitespace.sub('>', value)
@@ -1114,6 +1990,46 @@ def strip_html_whitespace(value):
 
 FILTERS = {}
 
+# The filters implemented in JavaScript that give the same result as the
+# Jinja2 filter, so they can be worked out at compile time.
+CONST_FILTERS = frozenset(["length"])
+
+def as_const(node, eval_ctx):
+    """
+    Evaluate `node` at compile time like `node.as_const` does, but raise
+    `Impossible` if it uses a filter that works differently in JavaScript.
+    """
+    for child in [node] + list(node.find_all(jinja2.nodes.Filter)):
+        if isinstance(child, jinja2.nodes.Filter) and \
+               child.name in FILTERS and child.name not in CONST_FILTERS:
+            raise jinja2.nodes.Impossible()
+    return node.as_const(eval_ctx)
+
+
+def js_string(value):
+    """
+    Returns the constant `value` converted to a string like JavaScript
+    does. Raises a ValueError for values that we don't convert.
+    """
+    if value is None:
+        return "null"
+    if isinstance(value, bool):
+        return value and "true" or "false"
+    if isinstance(value, (int, long)):
+        return str(value)
+    if isinstance(value, float):
+        if value == int(value) and abs(value) < 1e21:
+            return str(int(value))
+        output = repr(value)
+        if "e" in output or "n" in output:
+            # exponents, inf and nan are written differently
+            raise ValueError("Can't convert %r" % value)
+        return output
+    if isinstance(value, basestring):
+        return value
+    raise ValueError("Can't convert %r" % value)
+
+
 class register_filter(object):
 
     def __init__(self, name):
@@ -1197,26 +2113,209 @@ def filter_round(generator, node, frame, precision = jinja2.nodes.Const(0)):
         generator.writer.write(" / %s" % precision)
 
 
-def _generate(node, generator):
+class DefinesTransformer(NodeTransformer):
+    # Replace the variables that are defined at compile time with their
+    # values, unless a macro, loop or import uses the same name.
+
+    def __init__(self, environment, defines):
+        self.environment = environment
+        self.defines = defines
+        self.shadowed = set()
+
+    def scope(self, node, names):
+        shadowed = self.shadowed
+        self.shadowed = shadowed | names
+        try:
+            return self.generic_visit(node)
+        finally:
+            self.shadowed = shadowed
+
+    def stored_names(self, node):
+        return set([name.name for name in node.find_all(jinja2.nodes.Name)
+                    if name.ctx != "load"])
+
+    def visit_Template(self, node):
+        names = set()
+        for child in node.body:
+            if isinstance(child, jinja2.nodes.Assign):
+                names.update(self.stored_names(child))
+            elif isinstance(child, jinja2.nodes.Import):
+                names.add(child.target)
+            elif isinstance(child, jinja2.nodes.FromImport):
+                for name in child.names:
+                    names.add(isinstance(name, tuple) and name[1] or name)
+        return self.scope(node, names)
+
+    def visit_Macro(self, node):
+        return self.scope(node, self.stored_names(node))
+
+    visit_CallBlock = visit_Macro
+
+    def visit_Name(self, node):
+        if node.ctx == "load" and node.name in self.defines and \
+               node.name not in self.shadowed:
+            return const_node(
+                self.defines[node.name], node.lineno, self.environment)
+        return node
+
+    def visit_Getattr(self, node):
+        # Look up keys of defined dictionaries like JavaScript does, and not
+        # like Jinja2 which would find the methods of the dictionary first.
+        node = self.generic_visit(node)
+        if isinstance(node.node, jinja2.nodes.Dict):
+            for pair in node.node.items:
+                if isinstance(pair.key, jinja2.nodes.Const) and \
+                       pair.key.value == node.attr:
+                    return pair.value
+            # a missing key is undefined
+            return jinja2.nodes.Const(
+                None, lineno = node.lineno, environment = self.environment)
+        return node
+
+    def visit_Pair(self, node):
+        # dictionary keys are names, not variables
+        node.value = self.visit(node.value)
+        return node
+
+    def visit_Call(self, node):
+        # leave the name of the function alone
+        target = node.node
+        node = self.generic_visit(node)
+        if isinstance(target, jinja2.nodes.Name):
+            node.node = target
+        return node
+
+
+def const_node(value, lineno, environment):
+    if isinstance(value, (list, tuple)):
+        return jinja2.nodes.List(
+            [const_node(item, lineno, environment) for item in value],
+            lineno = lineno, environment = environment)
+    if isinstance(value, dict):
+        return jinja2.nodes.Dict(
+            [jinja2.nodes.Pair(
+                jinja2.nodes.Const(
+                    key, lineno = lineno, environment = environment),
+                const_node(value[key], lineno, environment),
+                lineno = lineno, environment = environment)
+             for key in sorted(value)],
+            lineno = lineno, environment = environment)
+    return jinja2.nodes.Const(
+        value, lineno = lineno, environment = environment)
+
+
+def apply_defines(node, environment):
+    """
+    Returns a copy of the template `node` with the compile time constants
+    of the environment filled in.
+    """
+    defines = getattr(environment, "defines", None)
+    if not defines:
+        return node
+
+    # the nodes reference the environment which we must not copy
+    node = copy.deepcopy(node, {id(environment): environment})
+    return DefinesTransformer(environment, defines).visit(node)
+
+
+def _generate(node, generator, source_map = None):
     if not isinstance(node, jinja2.nodes.Template):
         raise TypeError("Can't compile non template nodes")
 
+    node = apply_defines(node, generator.environment)
     generator.visit(node)
-    return generator.writer.stream.getvalue()
+    output = generator.writer.stream.getvalue()
+    if source_map is not None:
+        source_map.update(output, generator.writer.mappings)
+    return output
 
 
-def generate(node, environment, name, filename):
-    """Generate the python source for a node tree."""
+def generate(node, environment, name, filename, source_map = None):
+    """
+    Generate the python source for a node tree. The mappings from the
+    generated code back to the template are added to the optional
+    `sourcemap.SourceMap`.
+    """
     generator = CodeGenerator(environment, name, filename)
     generator.writer = environment.writer(environment)
-    return _generate(node, generator)
+    return _generate(node, generator, source_map)
 
 
-def generateClosure(node, environment, name, filename):
+def generateClosure(node, environment, name, filename, source_map = None):
     generator = ClosureCodeGenerator(environment, name, filename)
-    return _generate(node, generator)
+    return _generate(node, generator, source_map)
 
 
-def generateConcat(node, environment, name, filename):
+def generateConcat(node, environment, name, filename, source_map = None):
     generator = ConcatCodeGenerator(environment, name, filename)
-    return _generate(node, generator)
+    return _generate(node, generator, source_map)
+
+
+def order_by_imports(templates, environment):
+    """
+    Order the `(node, name, filename)` tuples in `templates` so that a
+    template comes after the templates providing the namespaces it imports.
+    Otherwise the original order is kept.
+    """
+    index = get_namespace_index(environment)
+
+    providers = {}
+    for template in templates:
+        for namespace in template[0].find_all(nodes.NamespaceNode):
+            providers.setdefault(namespace.namespace, template)
+
+    ordered = []
+    seen = set()
+    def visit(template):
+        if id(template) in seen:
+            # already ordered or an import cycle
+            return
+        seen.add(id(template))
+        for name in find_imports(template[0]):
+            provider = providers.get(index.get_namespace(name))
+            if provider is not None:
+                visit(provider)
+        ordered.append(template)
+
+    for template in templates:
+        visit(template)
+    return ordered
+
+
+def provide_bundle(writer, templates):
+    # Provide all the namespaces of the bundle at the top, they don't need
+    # to be required by the other templates in the bundle.
+    for node, name, filename in templates:
+        for namespace in node.find_all(nodes.NamespaceNode):
+            writer.set_source(name)
+            writer.writeline_provides(node, None, namespace.namespace)
+            writer.required.add(namespace.namespace)
+
+
+def generateBundle(templates, environment, generator = CodeGenerator,
+                   source_map = None):
+    """
+    Generate one script from the `(node, name, filename)` tuples in
+    `templates`, ordered by their imports. All the templates share one
+    writer so namespaces are only provided and required once.
+    """
+    templates = order_by_imports(templates, environment)
+    writer = None
+    for node, name, filename in templates:
+        if not isinstance(node, jinja2.nodes.Template):
+            raise TypeError("Can't compile non template nodes")
+
+        codegen = generator(environment, name, filename)
+        if writer is None:
+            writer = getattr(codegen, "writer", None) or \
+                     environment.writer(environment)
+            provide_bundle(writer, templates)
+        codegen.writer = writer
+        codegen.visit(apply_defines(node, environment))
+
+    if writer is None:
+        return ""
+    output = writer.stream.getvalue()
+    if source_map is not None:
+        source_map.update(output, writer.mappings)
+    return output
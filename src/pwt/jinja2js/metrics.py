@@ -0,0 +1,143 @@
+"""
+Counters and histograms for the WSGI resource applications, written out in
+the Prometheus text exposition format:
+
+  https://prometheus.io/docs/instrumenting/exposition_formats/
+
+Only what the resource applications need is implemented, there are no
+labels or gauges.
+"""
+import threading
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+# Upper bounds, in seconds, of the histogram buckets. Compiling a template
+# usually takes a few milliseconds.
+DEFAULT_BUCKETS = (
+    0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0,
+    10.0)
+
+
+def format_value(value):
+    if isinstance(value, float):
+        if value == float("inf"):
+            return "+Inf"
+        return repr(value)
+    return str(value)
+
+
+class Counter(object):
+
+    type = "counter"
+
+    def __init__(self, name, help):
+        self.name = name
+        self.help = help
+        self.value = 0
+        self._lock = threading.Lock()
+
+    def inc(self, amount = 1):
+        with self._lock:
+            self.value += amount
+
+    def samples(self):
+        return [(self.name, self.value)]
+
+
+class Histogram(object):
+
+    type = "histogram"
+
+    def __init__(self, name, help, buckets = DEFAULT_BUCKETS):
+        self.name = name
+        self.help = help
+        self.buckets = tuple(sorted([float(bound) for bound in buckets])) + (
+            float("inf"),)
+        # number of observations in each bucket, not cumulative
+        self.counts = [0] * len(self.buckets)
+        self.sum = 0.0
+        self._lock = threading.Lock()
+
+    def observe(self, value):
+        for idx, bound in enumerate(self.buckets):
+            if value <= bound:
+                break
+        with self._lock:
+            self.counts[idx] += 1
+            self.sum += value
+
+    def samples(self):
+        with self._lock:
+            counts = list(self.counts)
+            total = self.sum
+
+        samples = []
+        cumulative = 0
+        for bound, count in zip(self.buckets, counts):
+            cumulative += count
+            samples.append((
+                '%s_bucket{le="%s"}' %(self.name, format_value(bound)),
+                cumulative))
+        samples.append(("%s_sum" % self.name, total))
+        samples.append(("%s_count" % self.name, cumulative))
+        return samples
+
+
+class Registry(object):
+
+    def __init__(self):
+        self.metrics = []
+
+    def counter(self, name, help):
+        metric = Counter(name, help)
+        self.metrics.append(metric)
+        return metric
+
+    def histogram(self, name, help, buckets = DEFAULT_BUCKETS):
+        metric = Histogram(name, help, buckets)
+        self.metrics.append(metric)
+        return metric
+
+    def render(self):
+        """
+        Return the current value of every metric in the text format.
+        """
+        lines = []
+        for metric in self.metrics:
+            lines.append("# HELP %s %s" %(metric.name, metric.help))
+            lines.append("# TYPE %s %s" %(metric.name, metric.type))
+            for name, value in metric.samples():
+                lines.append("%s %s" %(name, format_value(value)))
+        return "\n".join(lines) + "\n"
+
+
+class ResourceMetrics(Registry):
+    # The metrics of a `wsgi.ResourcesApp`
+
+    def __init__(self, prefix = "jinja2js"):
+        super(ResourceMetrics, self).__init__()
+
+        self.requests = self.counter(
+            "%s_requests_total" % prefix,
+            "Requests for compiled templates and source maps.")
+        self.request_duration = self.histogram(
+            "%s_request_duration_seconds" % prefix,
+            "Time spent answering a request, including any compilation.")
+        self.not_found = self.counter(
+            "%s_not_found_total" % prefix,
+            "Requests for templates that don't exist.")
+        self.cache_hits = self.counter(
+            "%s_cache_hits_total" % prefix,
+            "Requests answered from the cache of compiled templates.")
+        self.cache_misses = self.counter(
+            "%s_cache_misses_total" % prefix,
+            "Requests for templates that were not cached or out of date.")
+        self.compiles = self.counter(
+            "%s_compiles_total" % prefix,
+            "Templates compiled, including the ones that failed.")
+        self.compile_duration = self.histogram(
+            "%s_compile_duration_seconds" % prefix,
+            "Time spent parsing and compiling a template.")
+        self.output_bytes = self.counter(
+            "%s_output_bytes_total" % prefix,
+            "Bytes of JavaScript generated by the compiler.")
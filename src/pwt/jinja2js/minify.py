@@ -0,0 +1,233 @@
+"""
+Compact the JavaScript generated for a macro.
+
+The code is split into tokens, the whitespace and comments between them are
+dropped and the variables and parameters declared inside the macro are
+renamed to short identifiers. Property names, object keys and every name
+that isn't declared in the macro, like the namespace the macro is assigned
+to, are left alone.
+
+This only understands the code that the writers generate, it is not a
+general purpose JavaScript minifier. In particular there are no regular
+expression literals in the generated code, so a `/` is always division.
+"""
+import re
+
+# Words that can't be used as identifiers
+RESERVED = frozenset("""
+    break case catch class const continue debugger default delete do else
+    enum export extends false finally for function if implements import in
+    instanceof interface let new null package private protected public
+    return static super switch this throw true try typeof var void while
+    with yield undefined arguments eval NaN Infinity
+    """.split())
+
+_tokens = re.compile(r"""
+    (?P<space>\s+)
+  | (?P<comment>//[^\n]*|/\*.*?\*/)
+  | (?P<string>'(?:[^'\\\n]|\\.)*'|"(?:[^"\\\n]|\\.)*")
+  | (?P<number>0[xX][0-9a-fA-F]+|(?:\d+\.?\d*|\.\d+)(?:[eE][+-]?\d+)?)
+  | (?P<name>[A-Za-z_$][\w$]*)
+  | (?P<punctuator>===|!==|==|!=|<=|>=|&&|\|\||\+\+|--|[-+*/%]=|=>|\.\.\.|\S)
+""", re.VERBOSE | re.DOTALL)
+
+# the rest of a template literal up to the next substitution or the end
+_template_chunk = re.compile(r"(?:[^`\\$]|\\.|\$(?!\{))*(?:`|\$\{)", re.DOTALL)
+
+_word = re.compile(r"[\w$]")
+
+
+class Token(object):
+
+    def __init__(self, kind, value):
+        self.kind = kind
+        self.value = value
+
+    def __repr__(self):
+        return "<Token %s %r>" %(self.kind, self.value)
+
+
+def tokenize(source):
+    """
+    Split `source` into a list of tokens, without the whitespace and
+    comments. Template literals are split into `template` tokens holding
+    the text and the tokens of the substitutions in between.
+    """
+    tokens = []
+    # one entry per open brace, true for the braces closing a substitution
+    braces = []
+    pos = 0
+    while pos < len(source):
+        if source[pos] == "`" or \
+               (source[pos] == "}" and braces and braces[-1]):
+            if source[pos] == "}":
+                braces.pop()
+            match = _template_chunk.match(source, pos + 1)
+            if match is None:
+                raise ValueError("Unterminated template literal at %d" % pos)
+            tokens.append(Token("template", source[pos:match.end()]))
+            if match.group().endswith("${"):
+                braces.append(True)
+            pos = match.end()
+            continue
+
+        match = _tokens.match(source, pos)
+        kind = match.lastgroup
+        value = match.group()
+        pos = match.end()
+        if kind in ("space", "comment"):
+            continue
+        if value == "{":
+            braces.append(False)
+        elif value == "}" and braces:
+            braces.pop()
+        tokens.append(Token(kind, value))
+
+    return tokens
+
+
+def is_reference(tokens, idx):
+    # True if the name at `idx` refers to a variable, and isn't a property
+    # or a key in an object literal.
+    if idx > 0 and tokens[idx - 1].value == ".":
+        return False
+    if idx > 0 and tokens[idx - 1].value in ("{", ",") and \
+           idx + 1 < len(tokens) and tokens[idx + 1].value == ":":
+        return False
+    return True
+
+
+class Scope(object):
+    # The names declared in a function, or outside of all functions.
+
+    def __init__(self, parent):
+        self.parent = parent
+        self.names = set()
+
+    def lookup(self, name):
+        scope = self
+        while scope is not None:
+            if name in scope.names:
+                return scope
+            scope = scope.parent
+        return None
+
+
+def resolve_names(tokens):
+    """
+    Returns the indexes of the names in `tokens` that refer to a variable
+    or parameter declared in `tokens`, and the set of the other names.
+    Variables that are assigned without being declared, like `func_caller`
+    in the output of call blocks, are globals and so are in the set of
+    other names, even if a function has a parameter with the same name.
+    """
+    scope = Scope(None)
+    # the function whose parameters or body come next
+    function = None
+    parameters = False
+    # the scope outside of each open brace
+    braces = []
+    references = []
+    for idx, token in enumerate(tokens):
+        if token.value == "function":
+            function = Scope(scope)
+        elif function is not None and token.value == "(":
+            parameters = True
+        elif parameters:
+            if token.value == ")":
+                parameters = False
+            elif token.kind == "name":
+                function.names.add(token.value)
+                references.append((idx, function))
+        elif token.value == "{":
+            braces.append(scope)
+            if function is not None:
+                scope = function
+                function = None
+        elif token.value == "}":
+            if braces:
+                scope = braces.pop()
+        elif token.kind == "name" and token.value not in RESERVED and \
+                 is_reference(tokens, idx):
+            if idx > 0 and tokens[idx - 1].value == "var":
+                scope.names.add(token.value)
+            references.append((idx, scope))
+
+    # variables are declared for the whole function, so only look them up
+    # once all the declarations are known
+    resolved = []
+    free = set()
+    for idx, scope in references:
+        if scope.lookup(tokens[idx].value) is None:
+            free.add(tokens[idx].value)
+        else:
+            resolved.append(idx)
+    return resolved, free
+
+
+def short_names(exclude):
+    """
+    Generate the identifiers a, b, ..., Z, aa, ab, ... skipping reserved
+    words and the names in `exclude`.
+    """
+    first = "abcdefghijklmnopqrstuvwxyzABCDEFGHIJKLMNOPQRSTUVWXYZ"
+    rest = first + "0123456789_$"
+    length = 1
+    while True:
+        for idx in xrange(len(first) * len(rest) ** (length - 1)):
+            name = first[idx % len(first)]
+            idx //= len(first)
+            for i in range(length - 1):
+                name += rest[idx % len(rest)]
+                idx //= len(rest)
+            if name not in RESERVED and name not in exclude:
+                yield name
+        length += 1
+
+
+def rename_locals(tokens):
+    """
+    Rename the variables and parameters declared in `tokens` to short
+    names. The most used names get the shortest identifiers.
+    """
+    resolved, free = resolve_names(tokens)
+
+    counts = {}
+    order = []
+    for idx in resolved:
+        name = tokens[idx].value
+        if name not in counts:
+            counts[name] = 0
+            order.append(name)
+        counts[name] += 1
+
+    order.sort(key = lambda name: -counts[name])
+    mapping = dict(zip(order, short_names(free)))
+
+    for idx in resolved:
+        tokens[idx].value = mapping[tokens[idx].value]
+
+
+def join(tokens):
+    # Write out the tokens with a space only where one is needed to keep
+    # two tokens apart.
+    output = []
+    last = ""
+    for token in tokens:
+        value = token.value
+        if last and ((_word.match(last[-1]) and _word.match(value[0])) or
+                     (last[-1] in "+-" and value[0] == last[-1])):
+            output.append(" ")
+        output.append(value)
+        last = value
+    return "".join(output)
+
+
+def minify(source):
+    """
+    Return the generated JavaScript code in `source` without whitespace and
+    comments, and with the local variables renamed.
+    """
+    tokens = tokenize(source)
+    rename_locals(tokens)
+    return join(tokens)
@@ -0,0 +1,139 @@
+"""
+Find out where the time goes when compiling a template.
+
+Set the `profiler` attribute of the environment to a `Profiler` and the code
+generators record the number of calls and the time spent in every type of
+node, in every macro and in phases like parsing and the scope analysis
+(`JSFrame.inspect`).
+
+For every entry two times are kept:
+
+* `time` - the time spent in the entry itself, without the nodes, macros
+  and phases measured inside it.
+* `total` - the time from start to end, including everything inside it.
+  Nested entries of the same name, like a for loop inside a for loop, are
+  only counted once.
+
+The time spent in an entry without the entries of the same category inside
+it is kept in `exclusive`. For the phases this splits the compilation into
+parts that add up to the total.
+
+The code generators also count some of the code they write, like the calls
+to escape the output, in `counts`.
+"""
+import contextlib
+import timeit
+
+import jscompiler
+
+CATEGORIES = ("phases", "macros", "nodes")
+
+
+class Profiler(object):
+
+    def __init__(self, timer = timeit.default_timer, categories = CATEGORIES):
+        self.timer = timer
+        # the categories to measure, the others aren't timed at all
+        self.categories = categories
+        # category -> name -> [calls, time, total]
+        self.stats = {}
+        # category -> name -> time without the nested entries of the category
+        self.exclusive = {}
+        # name -> number of times counted
+        self.counts = {}
+        # time spent in the entries nested inside each running entry
+        self._children = []
+        # time spent in the entries nested inside each running entry of
+        # the same category, by category
+        self._nested = {}
+        # number of running entries by (category, name)
+        self._running = {}
+
+    @contextlib.contextmanager
+    def measure(self, category, name):
+        key = (category, name)
+        self._running[key] = self._running.get(key, 0) + 1
+        self._children.append(0.0)
+        nested = self._nested.setdefault(category, [])
+        nested.append(0.0)
+        start = self.timer()
+        try:
+            yield
+        finally:
+            elapsed = self.timer() - start
+            children = self._children.pop()
+            if self._children:
+                self._children[-1] += elapsed
+            inside = nested.pop()
+            if nested:
+                nested[-1] += elapsed
+            self._running[key] -= 1
+
+            entry = self.stats.setdefault(category, {}).setdefault(
+                name, [0, 0.0, 0.0])
+            entry[0] += 1
+            entry[1] += elapsed - children
+            if not self._running[key]:
+                entry[2] += elapsed
+            exclusive = self.exclusive.setdefault(category, {})
+            exclusive[name] = exclusive.get(name, 0.0) + elapsed - inside
+
+    def count(self, name):
+        self.counts[name] = self.counts.get(name, 0) + 1
+
+    def as_dict(self):
+        """
+        Return the recorded statistics as a dictionary like:
+
+          {"nodes": {"For": {"calls": 2, "time": 0.001, "total": 0.003}},
+           "macros": {...},
+           "phases": {...}}
+        """
+        result = {}
+        for category in CATEGORIES:
+            result[category] = dict([
+                (name, {"calls": calls, "time": time, "total": total})
+                for name, (calls, time, total)
+                in self.stats.get(category, {}).items()])
+        return result
+
+    def report(self, output):
+        """
+        Write the statistics as a table to the `output` stream, the slowest
+        entries first.
+        """
+        for category in CATEGORIES:
+            stats = self.stats.get(category, {})
+            if not stats:
+                continue
+            output.write("%-30s %8s %10s %10s\n" %(
+                category, "calls", "time", "total"))
+            for name, (calls, time, total) in sorted(
+                    stats.items(), key = lambda item: -item[1][2]):
+                output.write("%-30s %8d %9.4fs %9.4fs\n" %(
+                    name, calls, time, total))
+            output.write("\n")
+
+        if self.counts:
+            output.write("%-30s %8s\n" %("counts", "count"))
+            for name, count in sorted(self.counts.items()):
+                output.write("%-30s %8d\n" %(name, count))
+            output.write("\n")
+
+
+def profile(environment, name):
+    """
+    Compile the template `name` and return the statistics, as returned by
+    `Profiler.as_dict`, of the parsing and the code generation.
+    """
+    profiler = Profiler()
+    previous = getattr(environment, "profiler", None)
+    environment.profiler = profiler
+    try:
+        source, filename, uptodate = environment.loader.get_source(
+            environment, name)
+        node = environment._parse(source, name, filename)
+        jscompiler.generate(node, environment, name, filename)
+    finally:
+        environment.profiler = previous
+    return profiler.as_dict()
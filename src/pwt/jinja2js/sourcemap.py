@@ -0,0 +1,116 @@
+"""
+Source maps, version 3, for the generated JavaScript.
+
+The writers record the offset in the output of every node they mark along
+with the line number of the node in the template. `SourceMap` turns these
+into the line and column in the generated code and encodes them as
+described in the source map revision 3 proposal:
+
+  https://sourcemaps.info/spec.html
+
+Jinja2 only knows the line of each node, so every mapping points at the
+start of a template line.
+"""
+import json
+
+BASE64 = "ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz0123456789+/"
+
+
+def encode_vlq(value):
+    """
+    Encode the integer `value` as a base 64 variable length quantity.
+    """
+    # the sign is stored in the lowest bit
+    value = value < 0 and ((-value) << 1) | 1 or value << 1
+    result = ""
+    while True:
+        digit = value & 31
+        value >>= 5
+        if value:
+            # continuation bit
+            digit |= 32
+        result += BASE64[digit]
+        if not value:
+            return result
+
+
+class SourceMap(object):
+
+    def __init__(self, file = None):
+        # name of the generated file
+        self.file = file
+        # (line, column, template name, template line), all zero based
+        self.mappings = []
+        # content of the templates, by name, to include in the map
+        self.contents = {}
+
+    def update(self, output, mappings):
+        """
+        Add the `(offset, lineno, name)` mappings recorded by a writer for
+        its `output`.
+        """
+        line = 0
+        line_start = 0
+        for offset, lineno, name in mappings:
+            if name is None:
+                # not generated from a template
+                continue
+            newline = output.rfind("\n", line_start, offset)
+            if newline != -1:
+                line += output.count("\n", line_start, offset)
+                line_start = newline + 1
+            # columns count characters, not bytes
+            column = len(output[line_start:offset].decode("utf-8", "replace"))
+            self.mappings.append((line, column, name, lineno - 1))
+
+    def add_content(self, name, source):
+        self.contents[name] = source
+
+    def sources(self):
+        names = []
+        for line, column, name, lineno in self.mappings:
+            if name not in names:
+                names.append(name)
+        return names
+
+    def encode(self, paths = None):
+        """
+        Return the source map as a dictionary. The templates are listed
+        by name, or by their path in the optional `paths` dictionary.
+        """
+        names = self.sources()
+        index = dict([(name, idx) for idx, name in enumerate(names)])
+
+        lines = []
+        # the source and line of the last segment
+        previous = (0, 0)
+        for line, column, name, lineno in sorted(
+                self.mappings, key = lambda mapping: mapping[:2]):
+            while len(lines) <= line:
+                lines.append([])
+                # the generated column starts again on every line
+                last_column = 0
+            lines[-1].append(
+                encode_vlq(column - last_column) +
+                encode_vlq(index[name] - previous[0]) +
+                encode_vlq(lineno - previous[1]) +
+                # the column in the template
+                encode_vlq(0))
+            last_column = column
+            previous = (index[name], lineno)
+
+        result = {
+            "version": 3,
+            "sources": [(paths or {}).get(name, name) for name in names],
+            "names": [],
+            "mappings": ";".join([",".join(segments) for segments in lines]),
+            }
+        if self.file is not None:
+            result["file"] = self.file
+        if self.contents:
+            result["sourcesContent"] = [
+                self.contents.get(name) for name in names]
+        return result
+
+    def dumps(self, paths = None):
+        return json.dumps(self.encode(paths), sort_keys = True)
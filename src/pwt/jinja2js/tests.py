@@ -1,9 +1,15 @@
 from cStringIO import StringIO
+import distutils.spawn
+import gzip
+import itertools
+import json
 import os
 import os.path
 import shutil
+import subprocess
 import tempfile
 import unittest
+import webob
 import webtest
 
 import zc.buildout.testing
@@ -15,8 +21,13 @@ import jinja2.optimizer
 import jinja2.environment
 
 import jscompiler
+import benchmark
 import cli
 import environment
+import metrics
+import minify
+import profiler
+import sourcemap
 import wsgi
 import app
 
@@ -64,6 +75,96 @@ class JSEnvironment(unittest.TestCase):
         self.assertEqual(source[0], "{% namespace example %}\n\n{% macro hello(name) %}\nHello, {{ name }}!\n{% endmacro %}\n")
 
 
+class NamespaceIndexTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+        self.env = environment.create_environment(
+            directories = [self.tempdir])
+
+        self.parsed = []
+        parse = self.env._parse
+        def counting_parse(source, name, filename):
+            self.parsed.append(name)
+            return parse(source, name, filename)
+        self.env._parse = counting_parse
+
+        self.write("lib.jinja2", """{% namespace lib %}
+{% import 'base.jinja2' as base %}
+{% macro hello() %}Hello{% endmacro %}""")
+        self.write("base.jinja2", """{% namespace base %}""")
+
+    def tearDown(self):
+        shutil.rmtree(self.tempdir)
+
+    def write(self, name, source, mtime = None):
+        filename = os.path.join(self.tempdir, name)
+        open(filename, "w").write(source)
+        if mtime is not None:
+            os.utime(filename, (mtime, mtime))
+
+    def test_index1(self):
+        index = jscompiler.get_namespace_index(self.env)
+        self.assert_(index is jscompiler.get_namespace_index(self.env))
+
+        self.assertEqual(index.get_namespace("lib.jinja2"), "lib")
+        self.assertEqual(index.get_imports("lib.jinja2"), ["base.jinja2"])
+        self.assertEqual(self.parsed, ["lib.jinja2"])
+
+    def test_index_invalidate1(self):
+        index = jscompiler.get_namespace_index(self.env)
+        self.assertEqual(index.get_namespace("lib.jinja2"), "lib")
+
+        self.write("lib.jinja2", "{% namespace lib2 %}", mtime = 1)
+        self.assertEqual(index.get_namespace("lib.jinja2"), "lib2")
+        self.assertEqual(index.get_imports("lib.jinja2"), [])
+        self.assertEqual(self.parsed, ["lib.jinja2", "lib.jinja2"])
+
+    def test_index_size1(self):
+        # the index only keeps as many templates as the template cache
+        self.env.cache = jinja2.environment.create_cache(1)
+        self.env.namespace_index = None
+        index = jscompiler.get_namespace_index(self.env)
+        index.get("lib.jinja2")
+        index.get("base.jinja2")
+        index.get("lib.jinja2")
+        self.assertEqual(
+            self.parsed, ["lib.jinja2", "base.jinja2", "lib.jinja2"])
+        self.assertEqual(len(index.entries), 1)
+
+    def test_index_checksum1(self):
+        index = jscompiler.get_namespace_index(self.env)
+        self.assertEqual(
+            index.get("base.jinja2").checksum,
+            cli.source_hash("{% namespace base %}"))
+
+    def test_manifest_uses_index1(self):
+        manifest = cli.Manifest(None, {})
+        for i in range(2):
+            self.assertEqual(
+                manifest.import_hashes(self.env, ["base.jinja2", "x.jinja2"]),
+                {"base.jinja2": cli.source_hash("{% namespace base %}"),
+                 "x.jinja2": None})
+        self.assertEqual(self.parsed, ["base.jinja2"])
+
+    def test_index_missing_namespace1(self):
+        self.write("nonamespace.jinja2", "{% macro hello() %}{% endmacro %}")
+        index = jscompiler.get_namespace_index(self.env)
+        self.assertRaises(
+            jinja2.compiler.TemplateAssertionError,
+            index.get_namespace, "nonamespace.jinja2")
+
+    def test_import_parsed_once1(self):
+        source = """{% namespace page %}
+{% import 'lib.jinja2' as lib %}
+{% macro page() %}{{ lib.hello() }}{% endmacro %}"""
+        for i in range(3):
+            node = self.env._parse(source, "page.jinja2", "page.jinja2")
+            jscompiler.generate(node, self.env, "page.jinja2", "page.jinja2")
+
+        self.assertEqual(self.parsed.count("lib.jinja2"), 1)
+
+
 class JSCompilerTemplateTestCase(JSCompilerTestCase):
 
     def test_missing_namespace1(self):
@@ -76,9 +177,9 @@ Hello, world!
         self.assertEqual(source_code, """goog.require('goog.string');
 goog.require('goog.string.StringBuffer');
 hello = function(opt_data, opt_sb, opt_caller) {
-    var output = opt_sb || new goog.string.StringBuffer();
-    output.append('\\nHello, world!\\n');
-    if (!opt_sb) return output.toString();
+    var output = '\\nHello, world!\\n';
+    if (!opt_sb) return output;
+    opt_sb.append(output);
 };""")
 
     def test_const1(self):
@@ -88,9 +189,9 @@ Hello, world!
         source_code = generateMacro(node, self.env, "const.html", "const.html")
 
         self.assertEqual(source_code, """test.hello = function(opt_data, opt_sb, opt_caller) {
-    var output = opt_sb || new goog.string.StringBuffer();
-    output.append('\\nHello, world!\\n');
-    if (!opt_sb) return output.toString();
+    var output = '\\nHello, world!\\n';
+    if (!opt_sb) return output;
+    opt_sb.append(output);
 };""")
 
     def test_undeclared_var1(self):
@@ -121,9 +222,9 @@ goog.require('goog.string.StringBuffer');
 
 goog.require('goog.color.names'); // needed to use goog.color.names data
 test.hello = function(opt_data, opt_sb, opt_caller) {
-    var output = opt_sb || new goog.string.StringBuffer();
-    output.append('\\n', goog.color.names.aqua, '\\n');
-    if (!opt_sb) return output.toString();
+    var output = '\\n' + goog.color.names.aqua + '\\n';
+    if (!opt_sb) return output;
+    opt_sb.append(output);
 };""")
 
     def test_var1(self):
@@ -134,9 +235,9 @@ test.hello = function(opt_data, opt_sb, opt_caller) {
         source_code = generateMacro(node, self.env, "var1.html", "var1.html")
 
         self.assertEqual(source_code, """test.hello = function(opt_data, opt_sb, opt_caller) {
-    var output = opt_sb || new goog.string.StringBuffer();
-    output.append('\\n', opt_data.name, '\\n');
-    if (!opt_sb) return output.toString();
+    var output = '\\n' + opt_data.name + '\\n';
+    if (!opt_sb) return output;
+    opt_sb.append(output);
 };""")
 
     def test_var1_accessobject1(self):
@@ -148,9 +249,9 @@ test.hello = function(opt_data, opt_sb, opt_caller) {
         source_code = generateMacro(node, self.env, "var1.html", "var1.html")
 
         self.assertEqual(source_code, """test.hello = function(opt_data, opt_sb, opt_caller) {
-    var output = opt_sb || new goog.string.StringBuffer();
-    output.append('\\n', opt_data.properties['name'], '\\n');
-    if (!opt_sb) return output.toString();
+    var output = '\\n' + opt_data.properties['name'] + '\\n';
+    if (!opt_sb) return output;
+    opt_sb.append(output);
 };""")
 
     def test_var1_accessobject2(self):
@@ -163,9 +264,9 @@ test.hello = function(opt_data, opt_sb, opt_caller) {
         source_code = generateMacro(node, self.env, "var1.html", "var1.html")
 
         self.assertEqual(source_code, """test.hello = function(opt_data, opt_sb, opt_caller) {
-    var output = opt_sb || new goog.string.StringBuffer();
-    output.append('\\n', opt_data.properties[opt_data.name], '\\n');
-    if (!opt_sb) return output.toString();
+    var output = '\\n' + opt_data.properties[opt_data.name] + '\\n';
+    if (!opt_sb) return output;
+    opt_sb.append(output);
 };""")
 
     def test_var2(self):
@@ -176,9 +277,9 @@ Hello, {{ name }}!
         source_code = generateMacro(node, self.env, "var2.html", "var2.html")
 
         self.assertEqual(source_code, """test.helloName = function(opt_data, opt_sb, opt_caller) {
-    var output = opt_sb || new goog.string.StringBuffer();
-    output.append('\\nHello, ', opt_data.name, '!\\n');
-    if (!opt_sb) return output.toString();
+    var output = '\\nHello, ' + opt_data.name + '!\\n';
+    if (!opt_sb) return output;
+    opt_sb.append(output);
 };""")
 
     def test_var3(self):
@@ -190,9 +291,9 @@ Hello, {{ name }}!
         source_code = generateMacro(node, self.env, "var2.html", "var2.html")
 
         self.assertEqual(source_code, """test.add = function(opt_data, opt_sb, opt_caller) {
-    var output = opt_sb || new goog.string.StringBuffer();
-    output.append('\\n', (opt_data.num + 200), '\\n');
-    if (!opt_sb) return output.toString();
+    var output = '\\n' + (opt_data.num + 200) + '\\n';
+    if (!opt_sb) return output;
+    opt_sb.append(output);
 };""")
 
     def test_var4(self):
@@ -204,9 +305,9 @@ Hello, {{ name }}!
         source_code = generateMacro(node, self.env, "var2.html", "var2.html")
 
         self.assertEqual(source_code, """test.add = function(opt_data, opt_sb, opt_caller) {
-    var output = opt_sb || new goog.string.StringBuffer();
-    output.append('\\n', (opt_data.num + opt_data.step), '\\n');
-    if (!opt_sb) return output.toString();
+    var output = '\\n' + (opt_data.num + opt_data.step) + '\\n';
+    if (!opt_sb) return output;
+    opt_sb.append(output);
 };""")
 
     def test_var5(self):
@@ -218,9 +319,9 @@ Hello, {{ name }}!
         source_code = generateMacro(node, self.env, "var2.html", "var2.html")
 
         self.assertEqual(source_code, """test.add = function(opt_data, opt_sb, opt_caller) {
-    var output = opt_sb || new goog.string.StringBuffer();
-    output.append('\\n', Math.pow((opt_data.num - opt_data.step), 2), '\\n');
-    if (!opt_sb) return output.toString();
+    var output = '\\n' + Math.pow((opt_data.num - opt_data.step), 2) + '\\n';
+    if (!opt_sb) return output;
+    opt_sb.append(output);
 };""")
 
     def test_var6(self):
@@ -246,9 +347,9 @@ Hello, {{ name }}!
         source_code = generateMacro(node, self.env, "var2.html", "var2.html")
 
         self.assertEqual(source_code, """test.add = function(opt_data, opt_sb, opt_caller) {
-    var output = opt_sb || new goog.string.StringBuffer();
-    output.append('\\n', (opt_data.num - Math.pow(opt_data.step, 2)), '\\n');
-    if (!opt_sb) return output.toString();
+    var output = '\\n' + (opt_data.num - Math.pow(opt_data.step, 2)) + '\\n';
+    if (!opt_sb) return output;
+    opt_sb.append(output);
 };""")
 
     def test_var7(self):
@@ -258,9 +359,9 @@ Hello, {{ name }}!
         source_code = generateMacro(node, self.env, "var2.html", "var2.html", autoescape = True)
 
         self.assertEqual(source_code, """test.add = function(opt_data, opt_sb, opt_caller) {
-    var output = opt_sb || new goog.string.StringBuffer();
-    output.append(goog.string.htmlEscape(String((opt_data.num - Math.pow(opt_data.step, 2)))));
-    if (!opt_sb) return output.toString();
+    var output = '' + goog.string.htmlEscape(String((opt_data.num - Math.pow(opt_data.step, 2))));
+    if (!opt_sb) return output;
+    opt_sb.append(output);
 };""")
 
     def test_var8(self):
@@ -270,9 +371,9 @@ Hello, {{ name }}!
         source_code = generateMacro(node, self.env, "var2.html", "var2.html", autoescape = True)
 
         self.assertEqual(source_code, """test.add = function(opt_data, opt_sb, opt_caller) {
-    var output = opt_sb || new goog.string.StringBuffer();
-    output.append(goog.string.htmlEscape(String((opt_data.num - Math.pow(opt_data.step, 2)))));
-    if (!opt_sb) return output.toString();
+    var output = '' + goog.string.htmlEscape(String((opt_data.num - Math.pow(opt_data.step, 2))));
+    if (!opt_sb) return output;
+    opt_sb.append(output);
 };""")
 
     def test_var9(self):
@@ -282,9 +383,9 @@ Hello, {{ name }}!
         source_code = generateMacro(node, self.env, "var2.html", "var2.html", autoescape = True)
 
         self.assertEqual(source_code, """test.add = function(opt_data, opt_sb, opt_caller) {
-    var output = opt_sb || new goog.string.StringBuffer();
-    output.append(goog.string.htmlEscape(String(((-opt_data.num) + 20))));
-    if (!opt_sb) return output.toString();
+    var output = '' + goog.string.htmlEscape(String(((-opt_data.num) + 20)));
+    if (!opt_sb) return output;
+    opt_sb.append(output);
 };""")
 
     def test_var10(self):
@@ -294,9 +395,9 @@ Hello, {{ name }}!
         source_code = generateMacro(node, self.env, "var2.html", "var2.html", autoescape = True)
 
         self.assertEqual(source_code, """test.add = function(opt_data, opt_sb, opt_caller) {
-    var output = opt_sb || new goog.string.StringBuffer();
-    output.append(goog.string.htmlEscape(String(((+opt_data.num) + 20))));
-    if (!opt_sb) return output.toString();
+    var output = '' + goog.string.htmlEscape(String(((+opt_data.num) + 20)));
+    if (!opt_sb) return output;
+    opt_sb.append(output);
 };""")
 
     def test_var11(self):
@@ -306,9 +407,9 @@ Hello, {{ name }}!
         source_code = generateMacro(node, self.env, "var2.html", "var2.html", autoescape = True)
 
         self.assertEqual(source_code, """test.add = function(opt_data, opt_sb, opt_caller) {
-    var output = opt_sb || new goog.string.StringBuffer();
-    output.append(goog.string.htmlEscape(String((!opt_data.bool))));
-    if (!opt_sb) return output.toString();
+    var output = '' + goog.string.htmlEscape(String((!opt_data.bool)));
+    if (!opt_sb) return output;
+    opt_sb.append(output);
 };""")
 
     def test_var12(self):
@@ -320,15 +421,10 @@ Hello {{ name }}!
         source_code = generateMacro(node, self.env, "var2.html", "var2.html")
 
         self.assertEqual(source_code, """test.hello = function(opt_data, opt_sb, opt_caller) {
-    var defaults = {name: 'World'};
-    for (var key in defaults) {
-        if (!(key in opt_data)) {
-            opt_data[key] = defaults[key];
-        }
-    }
-    var output = opt_sb || new goog.string.StringBuffer();
-    output.append('Hello ', opt_data.name, '!');
-    if (!opt_sb) return output.toString();
+    var nameParam = 'name' in opt_data ? opt_data.name : 'World';
+    var output = 'Hello ' + nameParam + '!';
+    if (!opt_sb) return output;
+    opt_sb.append(output);
 };""")
 
     def test_var13(self):
@@ -340,15 +436,10 @@ Hello {{ name }}!
         source_code = generateMacro(node, self.env, "var2.html", "var2.html")
 
         self.assertEqual(source_code, """test.hello = function(opt_data, opt_sb, opt_caller) {
-    var defaults = {age: 30};
-    for (var key in defaults) {
-        if (!(key in opt_data)) {
-            opt_data[key] = defaults[key];
-        }
-    }
-    var output = opt_sb || new goog.string.StringBuffer();
-    output.append(opt_data.name, ' is ', opt_data.age);
-    if (!opt_sb) return output.toString();
+    var ageParam = 'age' in opt_data ? opt_data.age : 30;
+    var output = '' + opt_data.name + ' is ' + ageParam;
+    if (!opt_sb) return output;
+    opt_sb.append(output);
 };""")
 
     def test_var14(self):
@@ -360,15 +451,11 @@ Hello {{ name }}!
         source_code = generateMacro(node, self.env, "var2.html", "var2.html")
 
         self.assertEqual(source_code, """test.hello = function(opt_data, opt_sb, opt_caller) {
-    var defaults = {name: 'Michael', age: 30};
-    for (var key in defaults) {
-        if (!(key in opt_data)) {
-            opt_data[key] = defaults[key];
-        }
-    }
-    var output = opt_sb || new goog.string.StringBuffer();
-    output.append(opt_data.name, ' is ', opt_data.age);
-    if (!opt_sb) return output.toString();
+    var nameParam = 'name' in opt_data ? opt_data.name : 'Michael';
+    var ageParam = 'age' in opt_data ? opt_data.age : 30;
+    var output = '' + nameParam + ' is ' + ageParam;
+    if (!opt_sb) return output;
+    opt_sb.append(output);
 };""")
 
     def test_for1(self):
@@ -750,9 +837,9 @@ No option.
         source_code = generateMacro(node, self.env, "condexpr.html", "condexpr.html")
 
         self.assertEqual(source_code, """test.testif = function(opt_data, opt_sb, opt_caller) {
-    var output = opt_sb || new goog.string.StringBuffer();
-    output.append(opt_data.option ? opt_data.option : '');
-    if (!opt_sb) return output.toString();
+    var output = '' + (opt_data.option ? opt_data.option : '');
+    if (!opt_sb) return output;
+    opt_sb.append(output);
 };""")
 
     def test_condexpr2(self):
@@ -765,9 +852,9 @@ No option.
         source_code = generateMacro(node, self.env, "condexpr.html", "condexpr.html")
 
         self.assertEqual(source_code, """test.iftest = function(opt_data, opt_sb, opt_caller) {
-    var output = opt_sb || new goog.string.StringBuffer();
-    output.append('\\n', opt_data.option ? 'Option set.' : 'No option.', '\\n');
-    if (!opt_sb) return output.toString();
+    var output = '\\n' + (opt_data.option ? 'Option set.' : 'No option.') + '\\n';
+    if (!opt_sb) return output;
+    opt_sb.append(output);
 };""")
 
 
@@ -1147,9 +1234,9 @@ goog.require('goog.string');
 goog.require('goog.string.StringBuffer');
 
 xxx.ns1.hello = function(opt_data, opt_sb, opt_caller) {
-    var output = opt_sb || new goog.string.StringBuffer();
-    output.append('Hello, ', opt_data.index);
-    if (!opt_sb) return output.toString();
+    var output = 'Hello, ' + opt_data.index;
+    if (!opt_sb) return output;
+    opt_sb.append(output);
 };
 
 xxx.ns1.testcall = function(opt_data, opt_sb, opt_caller) {
@@ -1194,9 +1281,9 @@ tests.render_dialog = function(opt_data, opt_sb, opt_caller) {
 tests.render = function(opt_data, opt_sb, opt_caller) {
     var output = opt_sb || new goog.string.StringBuffer();
     func_caller = function(func_data, func_sb, func_caller) {
-        var output = func_sb || new goog.string.StringBuffer();
-        output.append('Hello ', opt_data.name, '!');
-        if (!func_sb) return output.toString();
+        var output = 'Hello ' + opt_data.name + '!';
+        if (!func_sb) return output;
+        func_sb.append(output);
     };
     tests.render_dialog({type: 'box'}, output, func_caller);
     if (!opt_sb) return output.toString();
@@ -1241,9 +1328,9 @@ list_users = function(opt_data, opt_sb, opt_caller) {
 users = function(opt_data, opt_sb, opt_caller) {
     var output = opt_sb || new goog.string.StringBuffer();
     func_caller = function(func_data, func_sb, func_caller) {
-        var output = func_sb || new goog.string.StringBuffer();
-        output.append('Hello, ', func_data.user, '!');
-        if (!func_sb) return output.toString();
+        var output = 'Hello, ' + func_data.user + '!';
+        if (!func_sb) return output;
+        func_sb.append(output);
     };
     list_users({users: opt_data.users}, output, func_caller);
     if (!opt_sb) return output.toString();
@@ -1291,16 +1378,16 @@ list_users = function(opt_data, opt_sb, opt_caller) {
 users = function(opt_data, opt_sb, opt_caller) {
     var output = opt_sb || new goog.string.StringBuffer();
     func_caller = function(func_data, func_sb, func_caller) {
-        var output = func_sb || new goog.string.StringBuffer();
-        output.append('Hello, ', func_data.user, '!');
-        if (!func_sb) return output.toString();
+        var output = 'Hello, ' + func_data.user + '!';
+        if (!func_sb) return output;
+        func_sb.append(output);
     };
     list_users({users: opt_data.users}, output, func_caller);
     output.append('\\n');
     func_caller = function(func_data, func_sb, func_caller) {
-        var output = func_sb || new goog.string.StringBuffer();
-        output.append('Goodbye, ', func_data.user, ' from ', opt_data.name, '!');
-        if (!func_sb) return output.toString();
+        var output = 'Goodbye, ' + func_data.user + ' from ' + opt_data.name + '!';
+        if (!func_sb) return output;
+        func_sb.append(output);
     };
     list_users({users: opt_data.users2}, output, func_caller);
     if (!opt_sb) return output.toString();
@@ -1346,15 +1433,10 @@ list_users = function(opt_data, opt_sb, opt_caller) {
 users = function(opt_data, opt_sb, opt_caller) {
     var output = opt_sb || new goog.string.StringBuffer();
     func_caller = function(func_data, func_sb, func_caller) {
-        var defaults = {user: 'Anonymous'};
-        for (var key in defaults) {
-            if (!(key in func_data)) {
-                func_data[key] = defaults[key];
-            }
-        }
-        var output = func_sb || new goog.string.StringBuffer();
-        output.append('Hello, ', func_data.user, '!');
-        if (!func_sb) return output.toString();
+        var userParam = 'user' in func_data ? func_data.user : 'Anonymous';
+        var output = 'Hello, ' + userParam + '!';
+        if (!func_sb) return output;
+        func_sb.append(output);
     };
     list_users({users: opt_data.users}, output, func_caller);
     if (!opt_sb) return output.toString();
@@ -1381,9 +1463,9 @@ goog.require('goog.string.StringBuffer');
 // A comment
 
 test_html = function(opt_data, opt_sb, opt_caller) {
-    var output = opt_sb || new goog.string.StringBuffer();
-    output.append('<h1><a href="', opt_data.link, '">', opt_data.name, '</a></h1>');
-    if (!opt_sb) return output.toString();
+    var output = '<h1><a href="' + opt_data.link + '">' + opt_data.name + '</a></h1>';
+    if (!opt_sb) return output;
+    opt_sb.append(output);
 };""")
 
     def test_add_compiler_annotations(self):
@@ -1409,9 +1491,9 @@ goog.require('goog.string.StringBuffer');
  * @notypecheck
  */
 test_annotations = function(opt_data, opt_sb, opt_caller) {
-    var output = opt_sb || new goog.string.StringBuffer();
-    output.append(opt_data.arg);
-    if (!opt_sb) return output.toString();
+    var output = '' + opt_data.arg;
+    if (!opt_sb) return output;
+    opt_sb.append(output);
 };""")
 
     def test_recursive_macros_with_namespace(self):
@@ -1489,9 +1571,9 @@ jinja2js.test_macro = function(opt_data, opt_sb, opt_caller) {
     if (!opt_sb) return output.toString();
 };
 jinja2js.test_related = function(opt_data, opt_sb, opt_caller) {
-    var output = opt_sb || new goog.string.StringBuffer();
-    output.append('\\n    ', opt_data.related.name, '\\n');
-    if (!opt_sb) return output.toString();
+    var output = '\\n    ' + opt_data.related.name + '\\n';
+    if (!opt_sb) return output;
+    opt_sb.append(output);
 };""")
 
     def test_indentation_customization(self):
@@ -1508,9 +1590,9 @@ jinja2js.test_related = function(opt_data, opt_sb, opt_caller) {
 goog.require('goog.string.StringBuffer');
 // A comment
 test_indent = function(opt_data, opt_sb, opt_caller) {
-  var output = opt_sb || new goog.string.StringBuffer();
-  output.append('<h1>Test</h1>');
-  if (!opt_sb) return output.toString();
+  var output = '<h1>Test</h1>';
+  if (!opt_sb) return output;
+  opt_sb.append(output);
 };""")
 
     def test_import1(self):
@@ -1547,9 +1629,9 @@ xxx.ns1.hello = function(opt_data, opt_sb, opt_caller) {
         source_code = generateMacro(node, self.env, "filter.html", "filter.html")
 
         self.assertEqual(source_code, """test.filtertest = function(opt_data, opt_sb, opt_caller) {
-    var output = opt_sb || new goog.string.StringBuffer();
-    output.append(goog.string.htmlEscape(String(opt_data.data)));
-    if (!opt_sb) return output.toString();
+    var output = '' + goog.string.htmlEscape(String(opt_data.data));
+    if (!opt_sb) return output;
+    opt_sb.append(output);
 };""")
 
     def test_filter_escape2(self):
@@ -1559,9 +1641,9 @@ xxx.ns1.hello = function(opt_data, opt_sb, opt_caller) {
         source_code = generateMacro(node, self.env, "filter.html", "filter.html", autoescape = True)
 
         self.assertEqual(source_code, """test.filtertest = function(opt_data, opt_sb, opt_caller) {
-    var output = opt_sb || new goog.string.StringBuffer();
-    output.append(goog.string.htmlEscape(String(opt_data.data)));
-    if (!opt_sb) return output.toString();
+    var output = '' + goog.string.htmlEscape(String(opt_data.data));
+    if (!opt_sb) return output;
+    opt_sb.append(output);
 };""")
 
     def test_filter_escape3(self):
@@ -1571,9 +1653,9 @@ xxx.ns1.hello = function(opt_data, opt_sb, opt_caller) {
         source_code = generateMacro(node, self.env, "filter.html", "filter.html", autoescape = True)
 
         self.assertEqual(source_code, """test.filtertest = function(opt_data, opt_sb, opt_caller) {
-    var output = opt_sb || new goog.string.StringBuffer();
-    output.append(opt_data.data);
-    if (!opt_sb) return output.toString();
+    var output = '' + opt_data.data;
+    if (!opt_sb) return output;
+    opt_sb.append(output);
 };""")
 
     def test_filter_escape4(self):
@@ -1583,9 +1665,9 @@ xxx.ns1.hello = function(opt_data, opt_sb, opt_caller) {
         source_code = generateMacro(node, self.env, "filter.html", "filter.html", autoescape = False)
 
         self.assertEqual(source_code, """test.filtertest = function(opt_data, opt_sb, opt_caller) {
-    var output = opt_sb || new goog.string.StringBuffer();
-    output.append(opt_data.data);
-    if (!opt_sb) return output.toString();
+    var output = '' + opt_data.data;
+    if (!opt_sb) return output;
+    opt_sb.append(output);
 };""")
 
     def test_filter_default1(self):
@@ -1594,9 +1676,9 @@ xxx.ns1.hello = function(opt_data, opt_sb, opt_caller) {
         source_code = generateMacro(node, self.env, "f.html", "f.html")
 
         self.assertEqual(source_code, """test.hello = function(opt_data, opt_sb, opt_caller) {
-    var output = opt_sb || new goog.string.StringBuffer();
-    output.append((opt_data.name ? opt_data.name : 'World'));
-    if (!opt_sb) return output.toString();
+    var output = '' + (opt_data.name ? opt_data.name : 'World');
+    if (!opt_sb) return output;
+    opt_sb.append(output);
 };""")
 
     def test_filter_default2(self):
@@ -1606,9 +1688,9 @@ xxx.ns1.hello = function(opt_data, opt_sb, opt_caller) {
         source_code = generateMacro(node, self.env, "f.html", "f.html")
 
         self.assertEqual(source_code, """test.hello = function(opt_data, opt_sb, opt_caller) {
-    var output = opt_sb || new goog.string.StringBuffer();
-    output.append((opt_data.name ? opt_data.name : 'World'));
-    if (!opt_sb) return output.toString();
+    var output = '' + (opt_data.name ? opt_data.name : 'World');
+    if (!opt_sb) return output;
+    opt_sb.append(output);
 };""")
 
     def test_filter_truncate1(self):
@@ -1617,9 +1699,9 @@ xxx.ns1.hello = function(opt_data, opt_sb, opt_caller) {
         source_code = generateMacro(node, self.env, "f.html", "f.html")
 
         self.assertEqual(source_code, """test.trunc = function(opt_data, opt_sb, opt_caller) {
-    var output = opt_sb || new goog.string.StringBuffer();
-    output.append(opt_data.s.substring(0, 280));
-    if (!opt_sb) return output.toString();
+    var output = '' + opt_data.s.substring(0, 280);
+    if (!opt_sb) return output;
+    opt_sb.append(output);
 };""")
 
     def test_filter_capitalize(self):
@@ -1629,9 +1711,9 @@ xxx.ns1.hello = function(opt_data, opt_sb, opt_caller) {
         source_code = generateMacro(node, self.env, "f.html", "f.html")
 
         self.assertEqual(source_code, """test.trunc = function(opt_data, opt_sb, opt_caller) {
-    var output = opt_sb || new goog.string.StringBuffer();
-    output.append(opt_data.s.substring(0, 1).toUpperCase(), opt_data.s.substring(1));
-    if (!opt_sb) return output.toString();
+    var output = '' + opt_data.s.substring(0, 1).toUpperCase() + opt_data.s.substring(1);
+    if (!opt_sb) return output;
+    opt_sb.append(output);
 };""")
 
     def test_filter_round1(self):
@@ -1640,9 +1722,9 @@ xxx.ns1.hello = function(opt_data, opt_sb, opt_caller) {
         source_code = generateMacro(node, self.env, "f.html", "f.html")
 
         self.assertEqual(source_code, """test.round = function(opt_data, opt_sb, opt_caller) {
-    var output = opt_sb || new goog.string.StringBuffer();
-    output.append(Math.round(opt_data.num));
-    if (!opt_sb) return output.toString();
+    var output = '' + Math.round(opt_data.num);
+    if (!opt_sb) return output;
+    opt_sb.append(output);
 };""")
 
     def test_filter_round2(self):
@@ -1651,9 +1733,9 @@ xxx.ns1.hello = function(opt_data, opt_sb, opt_caller) {
         source_code = generateMacro(node, self.env, "f.html", "f.html")
 
         self.assertEqual(source_code, """test.round = function(opt_data, opt_sb, opt_caller) {
-    var output = opt_sb || new goog.string.StringBuffer();
-    output.append(Math.round(opt_data.num * 100) / 100);
-    if (!opt_sb) return output.toString();
+    var output = '' + Math.round(opt_data.num * 100) / 100;
+    if (!opt_sb) return output;
+    opt_sb.append(output);
 };""")
 
     def test_filter_round3(self):
@@ -1662,9 +1744,9 @@ xxx.ns1.hello = function(opt_data, opt_sb, opt_caller) {
         source_code = generateMacro(node, self.env, "f.html", "f.html")
 
         self.assertEqual(source_code, """test.round = function(opt_data, opt_sb, opt_caller) {
-    var output = opt_sb || new goog.string.StringBuffer();
-    output.append(Math.round(opt_data.num * Math.pow(10, opt_data.prec)) / Math.pow(10, opt_data.prec));
-    if (!opt_sb) return output.toString();
+    var output = '' + Math.round(opt_data.num * Math.pow(10, opt_data.prec)) / Math.pow(10, opt_data.prec);
+    if (!opt_sb) return output;
+    opt_sb.append(output);
 };""")
 
     def test_filter_round4(self):
@@ -1673,9 +1755,9 @@ xxx.ns1.hello = function(opt_data, opt_sb, opt_caller) {
         source_code = generateMacro(node, self.env, "f.html", "f.html")
 
         self.assertEqual(source_code, """test.round = function(opt_data, opt_sb, opt_caller) {
-    var output = opt_sb || new goog.string.StringBuffer();
-    output.append(Math.round(opt_data.num));
-    if (!opt_sb) return output.toString();
+    var output = '' + Math.round(opt_data.num);
+    if (!opt_sb) return output;
+    opt_sb.append(output);
 };""")
 
     def test_filter_round5(self):
@@ -1705,9 +1787,7 @@ Hello, world!
         self.assertEqual(source_code, """if (typeof testns == 'undefined') { var testns = {}; }\nif (typeof testns.consts == 'undefined') { testns.consts = {}; }
 
 testns.consts.hello = function(opt_data, opt_sb, opt_caller) {
-    var output = '';
-    output += 'Hello, world!';
-    return output;
+    return 'Hello, world!';
 };""")
 
     def test_var1(self):
@@ -1718,8 +1798,200 @@ testns.consts.hello = function(opt_data, opt_sb, opt_caller) {
         source_code = generateMacro(node, self.env, "var1.html", "var1.html")
 
         self.assertEqual(source_code, """test.hello = function(opt_data, opt_sb, opt_caller) {
+    return '\\n' + opt_data.name + '\\n';
+};""")
+
+    def test_expression_empty1(self):
+        node = self.get_compile_from_string("""{% macro hello() %}{% endmacro %}""")
+        source_code = generateMacro(node, self.env, "e.html", "e.html")
+
+        self.assertEqual(source_code, """test.hello = function(opt_data, opt_sb, opt_caller) {
+    return '';
+};""")
+
+    def test_expression_compare1(self):
+        node = self.get_compile_from_string("""{% macro hello(a, b) %}{{ a == b }}!{% endmacro %}""")
+        source_code = generateMacro(node, self.env, "e.html", "e.html")
+
+        self.assertEqual(source_code, """test.hello = function(opt_data, opt_sb, opt_caller) {
+    return '' + (opt_data.a == opt_data.b) + '!';
+};""")
+
+    def test_expression_controlflow1(self):
+        # only macros without any statements are compiled to an expression
+        node = self.get_compile_from_string("""{% macro hello(a) %}{% if a %}{{ a }}{% endif %}{% endmacro %}""")
+        source_code = generateMacro(node, self.env, "e.html", "e.html")
+
+        self.assertEqual(source_code, """test.hello = function(opt_data, opt_sb, opt_caller) {
+    var output = '';
+    if (opt_data.a) {
+        output += opt_data.a;
+    }
+    return output;
+};""")
+
+    def test_defaults_for1(self):
+        node = self.get_compile_from_string("""{% macro hello(items, sep = ', ') %}{% for item in items %}{{ item }}{{ sep }}{% endfor %}{% endmacro %}""")
+        source_code = generateMacro(node, self.env, "d.html", "d.html")
+
+        self.assertEqual(source_code, """test.hello = function(opt_data, opt_sb, opt_caller) {
+    var sepParam = 'sep' in opt_data ? opt_data.sep : ', ';
+    var output = '';
+    var itemList = opt_data.items;
+    var itemListLen = itemList.length;
+    for (var itemIndex = 0; itemIndex < itemListLen; itemIndex++) {
+        var itemData = itemList[itemIndex];
+        output += itemData + sepParam;
+    }
+    return output;
+};""")
+
+    def test_if_const1(self):
+        node = self.get_compile_from_string("""{% macro hello(name) %}{% if 1 > 2 %}no{% else %}yes{% endif %}{% if true %}{{ name }}{% endif %}{% endmacro %}""")
+        source_code = generateMacro(node, self.env, "if.html", "if.html")
+
+        self.assertEqual(source_code, """test.hello = function(opt_data, opt_sb, opt_caller) {
+    return 'yes' + opt_data.name;
+};""")
+
+    def test_if_const_object1(self):
+        # empty lists and objects are true in JavaScript. Jinja2's
+        # optimizer would fold them, so parse the template directly.
+        node = self.env._parse("""{% macro hello() %}{% if [] %}a{% endif %}{% if {} %}b{% endif %}{% endmacro %}""", None, None)
+        source_code = generateMacro(node, self.env, "if.html", "if.html")
+
+        self.assertEqual(source_code, """test.hello = function(opt_data, opt_sb, opt_caller) {
+    var output = '';
+    if ([]) {
+        output += 'a';
+    }
+    if ({}) {
+        output += 'b';
+    }
+    return output;
+};""")
+
+    def test_if_const_empty1(self):
+        # the branch that is taken is empty
+        node = self.get_compile_from_string("""{% macro hello() %}{% if true %}{% else %}X{% endif %}Y{% if 0 %}A{% elif 1 %}{% else %}C{% endif %}Z{% endmacro %}""")
+        source_code = generateMacro(node, self.env, "if.html", "if.html")
+
+        self.assertEqual(source_code, """test.hello = function(opt_data, opt_sb, opt_caller) {
+    return 'YZ';
+};""")
+
+    def test_if_const_elif1(self):
+        node = self.get_compile_from_string("""{% macro hello(name) %}{% if name %}a{% elif false %}b{% endif %}{% endmacro %}""")
+        source_code = generateMacro(node, self.env, "if.html", "if.html")
+
+        self.assertEqual(source_code, """test.hello = function(opt_data, opt_sb, opt_caller) {
+    var output = '';
+    if (opt_data.name) {
+        output += 'a';
+    }
+    return output;
+};""")
+
+    def test_if_empty1(self):
+        node = self.get_compile_from_string("""{% macro hello(name) %}{% if name %}{% endif %}{% if name %}{% else %}nobody{% endif %}{% endmacro %}""")
+        source_code = generateMacro(node, self.env, "if.html", "if.html")
+
+        self.assertEqual(source_code, """test.hello = function(opt_data, opt_sb, opt_caller) {
+    var output = '';
+    if (!(opt_data.name)) {
+        output += 'nobody';
+    }
+    return output;
+};""")
+
+    def test_for_hoist1(self):
+        node = self.get_compile_from_string("""{% macro users(users) %}{% for user in users %}<img src="{{ user.profile.avatar.url }}" alt="{{ user.profile.avatar.url }}">{{ user.name }}{{ user.name }}{% endfor %}{% endmacro %}""")
+        source_code = generateMacro(node, self.env, "h.html", "h.html")
+
+        self.assertEqual(source_code, """test.users = function(opt_data, opt_sb, opt_caller) {
+    var output = '';
+    var userList = opt_data.users;
+    var userListLen = userList.length;
+    for (var userIndex = 0; userIndex < userListLen; userIndex++) {
+        var userData = userList[userIndex];
+        var user$profile$avatar$url = userData.profile.avatar.url;
+        output += '<img src="' + user$profile$avatar$url + '" alt="' + user$profile$avatar$url + '">' + userData.name + userData.name;
+    }
+    return output;
+};""")
+
+    def test_for_hoist_loop_names1(self):
+        # the cached chain must not replace the variables of the loop
+        node = self.get_compile_from_string("""{% macro users(users) %}{% for user in users %}[{{ user.list.len }}{{ user.list.len }}]{% endfor %}{% endmacro %}""")
+        source_code = generateMacro(node, self.env, "h.html", "h.html")
+
+        self.assertEqual(source_code, """test.users = function(opt_data, opt_sb, opt_caller) {
+    var output = '';
+    var userList = opt_data.users;
+    var userListLen = userList.length;
+    for (var userIndex = 0; userIndex < userListLen; userIndex++) {
+        var userData = userList[userIndex];
+        var user$list$len = userData.list.len;
+        output += '[' + user$list$len + user$list$len + ']';
+    }
+    return output;
+};""")
+
+    def test_for_hoist_conditional1(self):
+        # chains that are only evaluated under a condition stay where they
+        # are, unless they are also always evaluated.
+        node = self.get_compile_from_string("""{% macro users(users) %}{% for user in users %}{% if user.profile %}{{ user.profile.name }}{{ user.profile.name }}{% endif %}{{ user.a.b|default(user.c.d) }}{{ user.c.d }}{% endfor %}{% endmacro %}""")
+        source_code = generateMacro(node, self.env, "h.html", "h.html")
+
+        self.assertEqual(source_code, """test.users = function(opt_data, opt_sb, opt_caller) {
+    var output = '';
+    var userList = opt_data.users;
+    var userListLen = userList.length;
+    for (var userIndex = 0; userIndex < userListLen; userIndex++) {
+        var userData = userList[userIndex];
+        var user$c$d = userData.c.d;
+        if (userData.profile) {
+            output += userData.profile.name + userData.profile.name;
+        }
+        output += (userData.a.b ? userData.a.b : user$c$d) + user$c$d;
+    }
+    return output;
+};""")
+
+    def test_for_hoist_reassigned1(self):
+        # calls and chains on variables that change in the loop are not cached
+        node = self.get_compile_from_string("""{% macro users(users) %}{% for user in users %}{{ user.a.fn() }}{{ user.a.fn() }}{% set data = user %}{{ data.a.b }}{{ data.a.b }}{% endfor %}{% endmacro %}""")
+        source_code = generateMacro(node, self.env, "h.html", "h.html")
+
+        self.assertEqual(source_code, """test.users = function(opt_data, opt_sb, opt_caller) {
+    var output = '';
+    var userList = opt_data.users;
+    var userListLen = userList.length;
+    for (var userIndex = 0; userIndex < userListLen; userIndex++) {
+        var userData = userList[userIndex];
+        output += userData.a.fn({}) + userData.a.fn({});
+        var data = userData;
+        output += data.a.b + data.a.b;
+    }
+    return output;
+};""")
+
+    def test_defaults_callblock1(self):
+        node = self.get_compile_from_string("""{% namespace tests %}
+{% macro render(name = 'World') -%}
+{% call tests.dialog() %}Hello {{ name }}!{% endcall %}
+{%- endmacro %}""")
+        source_code = jscompiler.generate(node, self.env, "d.html", "d.html")
+
+        self.assertEqual(source_code, """if (typeof tests == 'undefined') { var tests = {}; }
+
+tests.render = function(opt_data, opt_sb, opt_caller) {
+    var nameParam = 'name' in opt_data ? opt_data.name : 'World';
     var output = '';
-    output += '\\n' + opt_data.name + '\\n';
+    func_caller = function(func_data, func_sb, func_caller) {
+        return 'Hello ' + nameParam + '!';
+    };
+    output += tests.dialog({}, null, func_caller);
     return output;
 };""")
 
@@ -1767,9 +2039,7 @@ xxx.testif = function(opt_data, opt_sb, opt_caller) {
 };
 
 xxx.testcall = function(opt_data, opt_sb, opt_caller) {
-    var output = '';
-    output += xxx.testif({});
-    return output;
+    return '' + xxx.testif({});
 };""")
 
     def test_call_macro3(self): # Copied from above and modified
@@ -1794,9 +2064,7 @@ xxx.ns1.testif = function(opt_data, opt_sb, opt_caller) {
 };
 
 xxx.ns1.testcall = function(opt_data, opt_sb, opt_caller) {
-    var output = '';
-    output += xxx.ns1.testif({option: true});
-    return output;
+    return '' + xxx.ns1.testif({option: true});
 };""")
 
     def test_callblock1(self):
@@ -1817,17 +2085,13 @@ Hello {{ name }}!
         self.assertEqual(source_code, """if (typeof tests == \'undefined\') { var tests = {}; }
 
 tests.render_dialog = function(opt_data, opt_sb, opt_caller) {
-    var output = '';
-    output += '<div class="type">' + opt_caller({}) + '</div>';
-    return output;
+    return '<div class="type">' + opt_caller({}) + '</div>';
 };
 
 tests.render = function(opt_data, opt_sb, opt_caller) {
     var output = '';
     func_caller = function(func_data, func_sb, func_caller) {
-        var output = '';
-        output += 'Hello ' + opt_data.name + '!';
-        return output;
+        return 'Hello ' + opt_data.name + '!';
     };
     output += tests.render_dialog({type: 'box'}, null, func_caller);
     return output;
@@ -1840,9 +2104,7 @@ tests.render = function(opt_data, opt_sb, opt_caller) {
         source_code = generateMacro(node, self.env, "f.html", "f.html")
 
         self.assertEqual(source_code, """test.trunc = function(opt_data, opt_sb, opt_caller) {
-    var output = '';
-    output += opt_data.s.substring(0, 1).toUpperCase() + opt_data.s.substring(1);
-    return output;
+    return '' + opt_data.s.substring(0, 1).toUpperCase() + opt_data.s.substring(1);
 };""")
 
     def test_condexpr1(self):
@@ -1852,36 +2114,992 @@ tests.render = function(opt_data, opt_sb, opt_caller) {
         source_code = generateMacro(node, self.env, "condexpr.html", "condexpr.html")
 
         self.assertEqual(source_code, """test.testif = function(opt_data, opt_sb, opt_caller) {
-    var output = '';
-    output += (opt_data.option ? opt_data.option : '') + 'hello';
-    return output;
+    return '' + (opt_data.option ? opt_data.option : '') + 'hello';
 };""")
 
 
-class JSCompilerTemplateTestCaseOutput(JSCompilerTestCase):
-    # Test the standard output so that if a developer needs to debug the
-    # output then we can add comments and other information, keep the ordering
-    # so that it is easier to do so.
+class JSJoinCompilerTemplateTestCase(JSCompilerTestCase):
 
-    def test_comments1(self):
-        node = self.get_compile_from_string("""/**
-* This prints out hello world!
-*/
-{% macro hello() %}
+    def setUp(self):
+        super(JSJoinCompilerTemplateTestCase, self).setUp()
+
+        self.env = environment.create_environment(
+            packages = ["pwt.jinja2js:test_templates"],
+            writer = "pwt.jinja2js.jscompiler.Join",
+            )
+
+    def test_const1(self):
+        node = self.get_compile_from_string("""{% namespace testns.consts %}
+{% macro hello() -%}
 Hello, world!
-{% endmacro %}""")
+{%- endmacro %}""")
+        source_code = jscompiler.generate(node, self.env, "const.html", "const.html")
 
-        source_code = jscompiler.generate(node, self.env, "v.html", "v.html")
+        self.assertEqual(source_code, """if (typeof testns == 'undefined') { var testns = {}; }\nif (typeof testns.consts == 'undefined') { testns.consts = {}; }
 
-        self.assertEqual(source_code, """goog.require('goog.string');
-goog.require('goog.string.StringBuffer');
-/**
-* This prints out hello world!
-*/
-hello = function(opt_data, opt_sb, opt_caller) {
-    var output = opt_sb || new goog.string.StringBuffer();
-    output.append('\\nHello, world!\\n');
-    if (!opt_sb) return output.toString();
+testns.consts.hello = function(opt_data, opt_sb, opt_caller) {
+    return 'Hello, world!';
+};""")
+
+    def test_var1(self):
+        node = self.get_compile_from_string("""{% macro hello(name) %}
+{{ name }}
+{% endmacro %}
+""")
+        source_code = generateMacro(node, self.env, "var1.html", "var1.html")
+
+        self.assertEqual(source_code, """test.hello = function(opt_data, opt_sb, opt_caller) {
+    return '\\n' + opt_data.name + '\\n';
+};""")
+
+    def test_for1(self):
+        node = self.get_compile_from_string("""{% macro forinlist(jobs) -%}
+{% for job in jobs %}<li>{{ job.name }}</li>{% endfor %}
+{%- endmacro %}""")
+
+        source_code = generateMacro(node, self.env, "f.html", "f.html")
+
+        self.assertEqual(source_code, """test.forinlist = function(opt_data, opt_sb, opt_caller) {
+    var output = [];
+    var jobList = opt_data.jobs;
+    var jobListLen = jobList.length;
+    for (var jobIndex = 0; jobIndex < jobListLen; jobIndex++) {
+        var jobData = jobList[jobIndex];
+        output.push('<li>', jobData.name, '</li>');
+    }
+    return output.join('');
+};""")
+
+    def test_autoescape1(self):
+        node = self.get_compile_from_string("""{% macro hello(name) %}{{ name }}{% endmacro %}""")
+        source_code = generateMacro(
+            node, self.env, "var1.html", "var1.html", autoescape = True)
+
+        self.assertEqual(source_code, """test.hello = function(opt_data, opt_sb, opt_caller) {
+    return '' + soy.$$escapeHtml(opt_data.name);
+};""")
+
+    def test_autoescape_capitalize1(self):
+        # capitalize joins two values inside the escaped value
+        node = self.get_compile_from_string("""{% macro hello(names) -%}
+{% for name in names %}<b>{{ name|capitalize }}</b>{% endfor %}
+{%- endmacro %}""")
+        source_code = generateMacro(
+            node, self.env, "var1.html", "var1.html", autoescape = True)
+
+        self.assertEqual(source_code, """test.hello = function(opt_data, opt_sb, opt_caller) {
+    var output = [];
+    var nameList = opt_data.names;
+    var nameListLen = nameList.length;
+    for (var nameIndex = 0; nameIndex < nameListLen; nameIndex++) {
+        var nameData = nameList[nameIndex];
+        output.push('<b>', soy.$$escapeHtml(nameData.substring(0, 1).toUpperCase() + nameData.substring(1)), '</b>');
+    }
+    return output.join('');
+};""")
+
+    def test_call_macro1(self):
+        node = self.get_compile_from_string("""{% namespace xxx %}
+{% macro testif(option) -%}
+{% if option %}{{ option }}{% endif %}{% endmacro %}
+
+{% macro testcall() %}{{ xxx.testif() }}{% endmacro %}""")
+
+        source_code = jscompiler.generate(node, self.env, "f.html", "f.html")
+
+        self.assertEqual(source_code, """if (typeof xxx == 'undefined') { var xxx = {}; }
+
+xxx.testif = function(opt_data, opt_sb, opt_caller) {
+    var output = [];
+    if (opt_data.option) {
+        output.push(opt_data.option);
+    }
+    return output.join('');
+};
+
+xxx.testcall = function(opt_data, opt_sb, opt_caller) {
+    return '' + xxx.testif({});
+};""")
+
+    def test_callblock1(self):
+        node = self.get_compile_from_string("""{% namespace tests %}
+{% macro render_dialog(type) -%}
+<div class="type">{{ caller() }}</div>
+{%- endmacro %}
+
+{% macro render(name) -%}
+{% call tests.render_dialog(type = 'box') -%}
+Hello {{ name }}!
+{%- endcall %}
+{%- endmacro %}
+""")
+
+        source_code = jscompiler.generate(node, self.env, "cb.html", "cb.html")
+
+        self.assertEqual(source_code, """if (typeof tests == \'undefined\') { var tests = {}; }
+
+tests.render_dialog = function(opt_data, opt_sb, opt_caller) {
+    return '<div class="type">' + opt_caller({}) + '</div>';
+};
+
+tests.render = function(opt_data, opt_sb, opt_caller) {
+    var output = [];
+    func_caller = function(func_data, func_sb, func_caller) {
+        return 'Hello ' + opt_data.name + '!';
+    };
+    output.push(tests.render_dialog({type: 'box'}, null, func_caller));
+    return output.join('');
+};""")
+
+    def test_condexpr1(self):
+        node = self.get_compile_from_string("""{% macro testif(option) %}{{ option if option }}hello{% endmacro %}""")
+
+        source_code = generateMacro(node, self.env, "condexpr.html", "condexpr.html")
+
+        self.assertEqual(source_code, """test.testif = function(opt_data, opt_sb, opt_caller) {
+    return '' + (opt_data.option ? opt_data.option : '') + 'hello';
+};""")
+
+
+class JSTemplateLiteralCompilerTemplateTestCase(JSCompilerTestCase):
+
+    def setUp(self):
+        super(JSTemplateLiteralCompilerTemplateTestCase, self).setUp()
+
+        self.env = environment.create_environment(
+            packages = ["pwt.jinja2js:test_templates"],
+            writer = "pwt.jinja2js.jscompiler.TemplateLiteral",
+            )
+
+    def test_const1(self):
+        node = self.get_compile_from_string("""{% macro hello() -%}
+Hello, world!
+{%- endmacro %}""")
+        source_code = generateMacro(node, self.env, "const.html", "const.html")
+
+        self.assertEqual(source_code, """test.hello = function(opt_data, opt_sb, opt_caller) {
+    return `Hello, world!`;
+};""")
+
+    def test_const_escapes1(self):
+        node = self.get_compile_from_string("""{% macro hello() %}
+`${a}` \\ '"
+{% endmacro %}""")
+        source_code = generateMacro(node, self.env, "const.html", "const.html")
+
+        self.assertEqual(source_code, """test.hello = function(opt_data, opt_sb, opt_caller) {
+    return `\\n\\`\\${a}\\` \\\\ '"\\n`;
+};""")
+
+    def test_var1(self):
+        node = self.get_compile_from_string("""{% macro hello(name) %}
+Hello {{ name }}!
+{% endmacro %}
+""")
+        source_code = generateMacro(node, self.env, "var1.html", "var1.html")
+
+        self.assertEqual(source_code, """test.hello = function(opt_data, opt_sb, opt_caller) {
+    return `\\nHello ${opt_data.name}!\\n`;
+};""")
+
+    def test_for1(self):
+        node = self.get_compile_from_string("""{% macro forinlist(jobs) -%}
+{% for job in jobs %}<li>{{ job.name }}</li>{% endfor %}
+{%- endmacro %}""")
+
+        source_code = generateMacro(node, self.env, "f.html", "f.html")
+
+        self.assertEqual(source_code, """test.forinlist = function(opt_data, opt_sb, opt_caller) {
+    var output = '';
+    var jobList = opt_data.jobs;
+    var jobListLen = jobList.length;
+    for (var jobIndex = 0; jobIndex < jobListLen; jobIndex++) {
+        var jobData = jobList[jobIndex];
+        output += `<li>${jobData.name}</li>`;
+    }
+    return output;
+};""")
+
+    def test_autoescape1(self):
+        node = self.get_compile_from_string("""{% macro hello(name) %}{{ name }}{% endmacro %}""")
+        source_code = generateMacro(
+            node, self.env, "var1.html", "var1.html", autoescape = True)
+
+        self.assertEqual(source_code, """test.hello = function(opt_data, opt_sb, opt_caller) {
+    return `${soy.$$escapeHtml(opt_data.name)}`;
+};""")
+
+    def test_filter_capitalize1(self):
+        node = self.get_compile_from_string("""{% macro hello(name) %}<b>{{ name|capitalize }}</b>{% endmacro %}""")
+        source_code = generateMacro(node, self.env, "var1.html", "var1.html")
+
+        self.assertEqual(source_code, """test.hello = function(opt_data, opt_sb, opt_caller) {
+    return `<b>${opt_data.name.substring(0, 1).toUpperCase() + opt_data.name.substring(1)}</b>`;
+};""")
+
+    def test_callblock1(self):
+        node = self.get_compile_from_string("""{% namespace tests %}
+{% macro render_dialog(type) -%}
+<div class="type">{{ caller() }}</div>
+{%- endmacro %}
+
+{% macro render(name) -%}
+{% call tests.render_dialog(type = 'box') -%}
+Hello {{ name }}!
+{%- endcall %}
+{%- endmacro %}
+""")
+
+        source_code = jscompiler.generate(node, self.env, "cb.html", "cb.html")
+
+        self.assertEqual(source_code, """if (typeof tests == \'undefined\') { var tests = {}; }
+
+tests.render_dialog = function(opt_data, opt_sb, opt_caller) {
+    return `<div class="type">${opt_caller({})}</div>`;
+};
+
+tests.render = function(opt_data, opt_sb, opt_caller) {
+    var output = '';
+    func_caller = function(func_data, func_sb, func_caller) {
+        return `Hello ${opt_data.name}!`;
+    };
+    output += `${tests.render_dialog({type: 'box'}, null, func_caller)}`;
+    return output;
+};""")
+
+    def test_cli_codestyle1(self):
+        self.assertEqual(
+            cli.writerclasses["templateliteral"],
+            "pwt.jinja2js.jscompiler.TemplateLiteral")
+
+        tempdir = tempfile.mkdtemp()
+        try:
+            filename = os.path.join(tempdir, "hello.jinja2")
+            open(filename, "w").write("""{% namespace test %}
+{% macro hello(name) %}Hello {{ name }}!{% endmacro %}""")
+
+            result = cli.main([
+                "--codeStyle", "templateliteral",
+                "--outputPathFormat",
+                "%s/${INPUT_FILE_NAME_NO_EXT}.js" % tempdir,
+                filename], StringIO())
+            self.assertEqual(result, 0)
+
+            self.assertEqual(
+                open(os.path.join(tempdir, "hello.js")).read(),
+                """if (typeof test == 'undefined') { var test = {}; }
+
+test.hello = function(opt_data, opt_sb, opt_caller) {
+    return `Hello ${opt_data.name}!`;
+};""")
+        finally:
+            shutil.rmtree(tempdir)
+
+
+class OutputMergeTestCase(JSCompilerTestCase):
+
+    def append(self, writer, *items):
+        writer.writeline_outputappend(None, None)
+        for idx, item in enumerate(items):
+            if idx:
+                writer.write_outputappend_add(None, None)
+            if isinstance(item, list):
+                writer.write_outputappend_const(None, None, item[0])
+            else:
+                writer.write_outputappend_value(None, None)
+                writer.write(item)
+                writer.write_outputappend_value_end(None, None)
+        writer.write_outputappend_end(None, None)
+
+    def test_merge_consts1(self):
+        writer = jscompiler.Concat()
+        self.append(writer, ["a"])
+        self.append(writer, ["b"])
+        self.assertEqual(writer.stream.getvalue(), "output += 'ab';")
+
+    def test_merge_values1(self):
+        writer = jscompiler.Concat()
+        self.append(writer, ["a"], "x")
+        self.append(writer, "y", ["b"])
+        self.append(writer, ["c"])
+        self.assertEqual(
+            writer.stream.getvalue(), "output += 'a' + x + y + 'bc';")
+
+    def test_merge_stringbuilder1(self):
+        writer = jscompiler.StringBuilder()
+        self.append(writer, ["a"], "x")
+        self.append(writer, ["b"])
+        self.assertEqual(
+            writer.stream.getvalue(), "output.append('a', x, 'b');")
+
+    def test_merge_templateliteral1(self):
+        writer = jscompiler.TemplateLiteral()
+        self.append(writer, ["a`"], "x")
+        self.append(writer, ["b"])
+        self.append(writer, ["c"])
+        self.assertEqual(
+            writer.stream.getvalue(), "output += `a\\`${x}bc`;")
+
+    def test_no_merge1(self):
+        writer = jscompiler.Concat()
+        self.append(writer, ["a"])
+        writer.writeline("var x = 1;")
+        self.append(writer, ["b"])
+        self.assertEqual(
+            writer.stream.getvalue(),
+            "output += 'a';\nvar x = 1;\noutput += 'b';")
+
+    def test_no_merge_values1(self):
+        # `output += x + y` would add two numbers together
+        writer = jscompiler.Concat()
+        self.append(writer, "x")
+        self.append(writer, "y", ["a"])
+        self.append(writer, ["b"])
+        self.assertEqual(
+            writer.stream.getvalue(), "output += x;\noutput += y + 'ab';")
+
+    def test_numbers1(self):
+        node = self.get_compile_from_string("""{% namespace tests %}
+{% macro render(n, m) -%}
+{% for i in n %}{{ i }}{% if false %}x{% endif %}{{ m }}{% endfor %}
+{%- endmacro %}""")
+
+        source_code = jscompiler.generateConcat(node, self.env, "n.html", "n.html")
+
+        self.assertEqual(source_code, """if (typeof tests == 'undefined') { var tests = {}; }
+
+tests.render = function(opt_data, opt_sb, opt_caller) {
+    var output = '';
+    var iList = opt_data.n;
+    var iListLen = iList.length;
+    for (var iIndex = 0; iIndex < iListLen; iIndex++) {
+        var iData = iList[iIndex];
+        output += iData;
+        output += opt_data.m;
+    }
+    return output;
+};""")
+
+        node_js = distutils.spawn.find_executable("node")
+        if node_js is None:
+            return
+        process = subprocess.Popen(
+            [node_js, "-e",
+             source_code + "\nprocess.stdout.write("
+             "tests.render({n: [1, 2], m: 5}));"],
+            stdout = subprocess.PIPE)
+        self.assertEqual(process.communicate()[0], "1525")
+
+    def test_callblock1(self):
+        node = self.get_compile_from_string("""{% namespace tests %}
+{% macro render(name) -%}
+Hello {% call tests.dialog() %}{{ name }}{% endcall %}!
+{%- endmacro %}
+""")
+
+        source_code = jscompiler.generateConcat(node, self.env, "cb.html", "cb.html")
+
+        self.assertEqual(source_code, """if (typeof tests == \'undefined\') { var tests = {}; }
+
+tests.render = function(opt_data, opt_sb, opt_caller) {
+    var output = '';
+    output += 'Hello ';
+    func_caller = function(func_data, func_sb, func_caller) {
+        return '' + opt_data.name;
+    };
+    output += tests.dialog({}, null, func_caller) + '!';
+    return output;
+};""")
+
+
+class DefinesTestCase(JSCompilerTestCase):
+
+    def setUp(self):
+        super(DefinesTestCase, self).setUp()
+
+        self.env = environment.create_environment(
+            packages = ["pwt.jinja2js:test_templates"],
+            defines = environment.parse_defines([
+                "tier=pro", "beta=false", 'langs=["en", "fr"]',
+                'limits={"items": 3}']),
+            )
+
+    def test_parse_defines1(self):
+        self.assertEqual(
+            environment.parse_defines(
+                ["a=1", "b=true", "c=hello", 'd="x=y"', "e=[1, null]"]),
+            {"a": 1, "b": True, "c": "hello", "d": "x=y", "e": [1, None]})
+        self.assertEqual(
+            type(environment.parse_defines(['a="x"'])["a"]), str)
+        self.assertRaises(ValueError, environment.parse_defines, ["a"])
+
+    def test_js_values1(self):
+        # the constants are written out like JavaScript would and filters
+        # that work differently in JavaScript are left to run time
+        env = environment.create_environment(
+            defines = environment.parse_defines([
+                "DEBUG=true", "N=null", "F=1.0", "title=Hello world"]))
+        node = env.parse("""{% namespace defs %}
+{% macro hello() -%}
+{{ DEBUG }}/{{ N }}/{{ F }}/{{ title|length }}/{{ title|truncate(5) }}
+{%- endmacro %}""")
+        source_code = jscompiler.generate(node, env, "d.html", "d.html")
+
+        self.assertEqual(source_code, """if (typeof defs == 'undefined') { var defs = {}; }
+
+defs.hello = function(opt_data, opt_sb, opt_caller) {
+    return 'true/null/1/11/' + 'Hello world'.substring(0, 5);
+};""")
+
+    def test_parse_environment1(self):
+        env = environment.parse_environment({"defines": """
+            a=1
+            b=x
+            c={"x": 1}"""})
+        self.assertEqual(env.defines, {"a": 1, "b": "x", "c": {"x": 1}})
+
+    def test_if1(self):
+        node = self.get_compile_from_string("""{% namespace defs %}
+{% macro hello(name) -%}
+{% if tier == 'pro' %}Pro {{ tier|upper }}{% else %}Free{% endif %}{% if beta %} beta{% endif %}
+{%- endmacro %}""")
+        source_code = jscompiler.generate(node, self.env, "d.html", "d.html")
+
+        self.assertEqual(source_code, """if (typeof defs == 'undefined') { var defs = {}; }
+
+defs.hello = function(opt_data, opt_sb, opt_caller) {
+    return 'Pro PRO';
+};""")
+
+    def test_for1(self):
+        node = self.get_compile_from_string("""{% namespace defs %}
+{% macro hello() -%}
+{% for lang in langs %}{{ lang }}{% endfor %}{{ limits.items }}
+{%- endmacro %}""")
+        source_code = jscompiler.generate(node, self.env, "d.html", "d.html")
+
+        self.assertEqual(source_code, """if (typeof defs == 'undefined') { var defs = {}; }
+
+defs.hello = function(opt_data, opt_sb, opt_caller) {
+    var output = '';
+    var langList = ['en', 'fr'];
+    var langListLen = langList.length;
+    for (var langIndex = 0; langIndex < langListLen; langIndex++) {
+        var langData = langList[langIndex];
+        output += langData;
+    }
+    output += '3';
+    return output;
+};""")
+
+    def test_missing_key1(self):
+        # keys that aren't defined are undefined, even the names of the
+        # methods of a Python dictionary
+        node = self.get_compile_from_string("""{% namespace defs %}
+{% macro hello() -%}
+{% if limits.pages %}pages{% endif %}{{ limits.pages }}/{{ limits.keys }}
+{%- endmacro %}""")
+        source_code = jscompiler.generate(node, self.env, "d.html", "d.html")
+
+        self.assertEqual(source_code, """if (typeof defs == 'undefined') { var defs = {}; }
+
+defs.hello = function(opt_data, opt_sb, opt_caller) {
+    return 'null/null';
+};""")
+
+    def test_shadowed1(self):
+        # parameters, loop variables and dictionary keys are left alone
+        node = self.get_compile_from_string("""{% namespace defs %}
+{% macro hello(tier) -%}
+{{ tier }}{% for beta in tier %}{{ beta }}{% endfor %}{{ defs.other(tier = {langs: 1}) }}
+{%- endmacro %}""")
+        source_code = jscompiler.generate(node, self.env, "d.html", "d.html")
+
+        self.assertEqual(source_code, """if (typeof defs == 'undefined') { var defs = {}; }
+
+defs.hello = function(opt_data, opt_sb, opt_caller) {
+    var output = '';
+    output += opt_data.tier;
+    var betaList = opt_data.tier;
+    var betaListLen = betaList.length;
+    for (var betaIndex = 0; betaIndex < betaListLen; betaIndex++) {
+        var betaData = betaList[betaIndex];
+        output += betaData;
+    }
+    output += defs.other({tier: {langs: 1}});
+    return output;
+};""")
+
+    def test_parsed_template_unchanged1(self):
+        node = self.get_compile_from_string("""{% namespace defs %}
+{% macro hello() %}{{ tier }}{% endmacro %}""")
+        jscompiler.generate(node, self.env, "d.html", "d.html")
+
+        self.assertEqual(
+            [name.name for name in node.find_all(jinja2.nodes.Name)],
+            ["tier"])
+
+
+class InlineTestCase(JSCompilerTestCase):
+
+    def setUp(self):
+        super(InlineTestCase, self).setUp()
+
+        self.env = environment.create_environment(
+            packages = ["pwt.jinja2js:test_templates"],
+            inline_threshold = 20,
+            )
+
+    def test_parse_environment1(self):
+        env = environment.parse_environment({"inline_threshold": "15"})
+        self.assertEqual(env.inline_threshold, 15)
+        self.assertEqual(environment.parse_environment({}).inline_threshold, 0)
+
+    def test_inline1(self):
+        node = self.get_compile_from_string("""{% namespace inl %}
+{% macro link(url, title = 'home') -%}
+<a href="{{ url }}">{{ title }}</a>
+{%- endmacro %}
+{% macro list(items) -%}
+{% for item in items %}<li>{{ link(url = item.url) }}</li>{% endfor %}
+{%- endmacro %}
+{% macro item(item) -%}
+{{ inl.link(url = item.url, title = item.title) }}
+{%- endmacro %}""")
+        source_code = jscompiler.generate(node, self.env, "i.html", "i.html")
+
+        self.assertEqual(source_code, """if (typeof inl == 'undefined') { var inl = {}; }
+
+inl.link = function(opt_data, opt_sb, opt_caller) {
+    var titleParam = 'title' in opt_data ? opt_data.title : 'home';
+    return '<a href="' + opt_data.url + '">' + titleParam + '</a>';
+};
+inl.list = function(opt_data, opt_sb, opt_caller) {
+    var output = '';
+    var itemList = opt_data.items;
+    var itemListLen = itemList.length;
+    for (var itemIndex = 0; itemIndex < itemListLen; itemIndex++) {
+        var itemData = itemList[itemIndex];
+        var linkUrl1 = itemData.url;
+        var linkTitle1 = 'home';
+        output += '<li><a href="' + linkUrl1 + '">' + linkTitle1 + '</a></li>';
+    }
+    return output;
+};
+inl.item = function(opt_data, opt_sb, opt_caller) {
+    var linkUrl1 = opt_data.item.url;
+    var linkTitle1 = opt_data.item.title;
+    return '<a href="' + linkUrl1 + '">' + linkTitle1 + '</a>';
+};""")
+
+    def test_inline_numbers1(self):
+        # the call returned a string, the inlined values mustn't be added
+        # together
+        node = self.get_compile_from_string("""{% namespace inl %}
+{% macro pair(a, b) %}{{ a }}{{ b }}{% endmacro %}
+{% macro list(items) -%}
+{% for item in items %}{{ pair(a = 1, b = 2) }}{% endfor %}
+{%- endmacro %}""")
+        source_code = jscompiler.generate(node, self.env, "i.html", "i.html")
+
+        self.assertTrue("""inl.list = function(opt_data, opt_sb, opt_caller) {
+    var output = '';
+    var itemList = opt_data.items;
+    var itemListLen = itemList.length;
+    for (var itemIndex = 0; itemIndex < itemListLen; itemIndex++) {
+        var itemData = itemList[itemIndex];
+        var pairA1 = 1;
+        var pairB1 = 2;
+        output += '' + pairA1 + pairB1;
+    }
+    return output;
+};""" in source_code)
+
+        node_js = distutils.spawn.find_executable("node")
+        if node_js is None:
+            return
+        process = subprocess.Popen(
+            [node_js, "-e",
+             source_code + "\nprocess.stdout.write("
+             "inl.list({items: [1, 2]}));"],
+            stdout = subprocess.PIPE)
+        self.assertEqual(process.communicate()[0], "1212")
+
+    def test_not_inlined1(self):
+        # macros that call other macros or use caller, macros from other
+        # namespaces and calls with positional arguments stay calls
+        node = self.get_compile_from_string("""{% namespace inl %}
+{% macro recurse(n) %}{{ recurse(n = n) }}{% endmacro %}
+{% macro wrap() %}[{{ caller() }}]{% endmacro %}
+{% macro greet(name) %}Hello {{ name }}{% endmacro %}
+{% macro hello(name) -%}
+{{ recurse(n = 1) }}{{ wrap() }}{{ other.link(url = name) }}{{ greet(name) }}
+{%- endmacro %}""")
+        source_code = jscompiler.generate(node, self.env, "i.html", "i.html")
+
+        self.assertTrue("""inl.hello = function(opt_data, opt_sb, opt_caller) {
+    return '' + inl.recurse({n: 1}) + inl.wrap({}) + other.link({url: opt_data.name}) + inl.greet(opt_data.name);
+};""" in source_code)
+
+    def test_threshold1(self):
+        source = """{% namespace inl %}
+{% macro link(url) %}<a href="{{ url }}">{{ url }}</a>{% endmacro %}
+{% macro hello(name) %}{{ link(url = name) }}{% endmacro %}"""
+        self.env.inline_threshold = 5
+        source_code = jscompiler.generate(
+            self.get_compile_from_string(source), self.env, "i.html", "i.html")
+        self.assertTrue("return '' + inl.link({url: opt_data.name});" in source_code)
+
+        self.env.inline_threshold = 0
+        source_code = jscompiler.generate(
+            self.get_compile_from_string(source), self.env, "i.html", "i.html")
+        self.assertTrue("return '' + inl.link({url: opt_data.name});" in source_code)
+
+    def test_autoescape1(self):
+        self.env.autoescape = True
+        node = self.get_compile_from_string("""{% namespace inl %}
+{% macro link(url) %}<a href="{{ url }}">{{ url }}</a>{% endmacro %}
+{% macro hello(name) %}{{ link(url = name) }}{% endmacro %}""")
+        source_code = jscompiler.generate(node, self.env, "i.html", "i.html")
+        self.assertTrue("inl.link({url: opt_data.name})" in source_code)
+
+
+class MinifyTestCase(JSCompilerTestCase):
+
+    def setUp(self):
+        super(MinifyTestCase, self).setUp()
+
+        self.env = environment.create_environment(
+            packages = ["pwt.jinja2js:test_templates"],
+            minify = True,
+            )
+
+    def test_parse_environment1(self):
+        for value, expected in (("true", True), ("false", False),
+                                ("0", False)):
+            env = environment.parse_environment({"minify": value})
+            self.assertEqual(env.minify, expected)
+        self.assertEqual(environment.parse_environment({}).minify, False)
+
+    def test_minify1(self):
+        self.assertEqual(
+            minify.minify("""foo.bar = function(opt_data, opt_sb) {
+    // comment
+    var output = '';
+    var x = {output: opt_data.output, y: a ? output : 1};
+    output += typeof x + '  ' + + x.y;
+    return output;
+};"""),
+            "foo.bar=function(d,e){var b='';var c={output:d.output,y:a?b:1};"
+            "b+=typeof c+'  '+ +c.y;return b;};")
+
+    def test_minify_template_literal1(self):
+        self.assertEqual(
+            minify.minify(
+                "var output = `a ${output + `${ {x: output}.x }`} }`;"),
+            "var a=`a ${a+`${{x:a}.x}`} }`;")
+
+    def test_minify_globals1(self):
+        # names that are assigned without being declared are globals, even
+        # when a function has a parameter with the same name
+        self.assertEqual(
+            minify.minify("""foo.bar = function(opt_data, opt_sb, opt_caller) {
+    func_caller = function(func_data, func_sb, func_caller) {
+        return func_caller(opt_data);
+    };
+    return foo.baz({}, null, func_caller);
+};"""),
+            "foo.bar=function(a,c,d){func_caller=function(e,f,b){return b(a);};"
+            "return foo.baz({},null,func_caller);};")
+
+    def test_short_names1(self):
+        names = minify.short_names(set(["b"]))
+        self.assertEqual([names.next() for i in range(3)], ["a", "c", "d"])
+
+        names = list(itertools.islice(minify.short_names(set()), 2000))
+        self.assertEqual(len(set(names)), 2000)
+        self.assertTrue("do" not in names and "in" not in names)
+
+    def test_macro1(self):
+        node = self.get_compile_from_string("""{% namespace min %}
+{% macro list(items) -%}
+{% for item in items %}<li>{{ item.name }}</li>{% endfor %}
+{%- endmacro %}
+{% macro hello(name) %}Hello {{ name }}{% endmacro %}""")
+        source_code = jscompiler.generate(node, self.env, "m.html", "m.html")
+
+        self.assertEqual(source_code, """if (typeof min == 'undefined') { var min = {}; }
+min.list=function(d,g,h){var b='';var c=d.items;var e=c.length;for(var a=0;a<e;a++){var f=c[a];b+='<li>'+f.name+'</li>';}return b;};min.hello=function(a,b,c){return'Hello '+a.name;};""")
+
+
+class SourceMapTestCase(JSCompilerTestCase):
+
+    def setUp(self):
+        super(SourceMapTestCase, self).setUp()
+
+        self.env = environment.create_environment(
+            packages = ["pwt.jinja2js:test_templates"])
+
+    def test_encode_vlq1(self):
+        self.assertEqual(
+            [sourcemap.encode_vlq(value) for value in (0, 1, -1, 15, 16, 123)],
+            ["A", "C", "D", "e", "gB", "2H"])
+
+    def test_mappings1(self):
+        node = self.get_compile_from_string("""{% namespace sm %}
+{% macro hello(name) %}
+Hello {{ name }}
+{% for item in name.items %}
+<li>{{ item }}</li>
+{% endfor %}
+{% endmacro %}""")
+        source_map = sourcemap.SourceMap("sm.js")
+        source_code = jscompiler.generate(
+            node, self.env, "sm.jinja2", "sm.jinja2", source_map)
+
+        lines = source_code.split("\n")
+        self.assertEqual(
+            [(lines[line][column:column + 14], lineno)
+             for line, column, name, lineno in source_map.mappings],
+            [("if (typeof sm ", 0),
+             ("sm.hello = fun", 1),
+             ("opt_data.name ", 2),
+             ("output += '\\n<", 3),
+             ("itemData + '</", 4),
+             ("output += '\\n'", 5),
+             ("return output;", 1)])
+        self.assertEqual(source_map.encode(), {
+            "version": 3,
+            "file": "sm.js",
+            "sources": ["sm.jinja2"],
+            "names": [],
+            "mappings": "AAAA;;AACA;;2BACA;;;;;QACA,qBACA;;IACA;IAJA",
+            })
+
+    def test_source_map_content1(self):
+        source_map = sourcemap.SourceMap()
+        source_map.update("a;\n  b;", [(0, 1, "t.jinja2"), (5, 3, "t.jinja2")])
+        source_map.add_content("t.jinja2", u"one\ntwo\nthree")
+        self.assertEqual(json.loads(source_map.dumps({"t.jinja2": "../t.jinja2"})), {
+            "version": 3,
+            "sources": ["../t.jinja2"],
+            "sourcesContent": ["one\ntwo\nthree"],
+            "names": [],
+            "mappings": "AAAA;EAEA",
+            })
+
+
+class MetricsTestCase(unittest.TestCase):
+
+    def test_counter1(self):
+        registry = metrics.Registry()
+        counter = registry.counter("test_total", "Things counted.")
+        counter.inc()
+        counter.inc(2)
+
+        self.assertEqual(registry.render(), """# HELP test_total Things counted.
+# TYPE test_total counter
+test_total 3
+""")
+
+    def test_histogram1(self):
+        registry = metrics.Registry()
+        histogram = registry.histogram(
+            "test_seconds", "Time taken.", buckets = (1, 0.5))
+        histogram.observe(0.25)
+        histogram.observe(0.5)
+        histogram.observe(2)
+
+        self.assertEqual(registry.render(), """# HELP test_seconds Time taken.
+# TYPE test_seconds histogram
+test_seconds_bucket{le="0.5"} 2
+test_seconds_bucket{le="1.0"} 2
+test_seconds_bucket{le="+Inf"} 3
+test_seconds_sum 2.75
+test_seconds_count 3
+""")
+
+
+class ProfilerTestCase(unittest.TestCase):
+
+    def test_measure1(self):
+        # every call to the timer takes one second
+        ticks = itertools.count()
+        prof = profiler.Profiler(timer = lambda: float(ticks.next()))
+
+        with prof.measure("nodes", "For"):
+            with prof.measure("nodes", "For"):
+                with prof.measure("nodes", "Output"):
+                    pass
+        with prof.measure("phases", "inspect"):
+            pass
+
+        self.assertEqual(prof.as_dict(), {
+            "nodes": {
+                "For": {"calls": 2, "time": 4.0, "total": 5.0},
+                "Output": {"calls": 1, "time": 1.0, "total": 1.0},
+                },
+            "macros": {},
+            "phases": {"inspect": {"calls": 1, "time": 1.0, "total": 1.0}},
+            })
+
+    def test_exclusive1(self):
+        ticks = itertools.count()
+        prof = profiler.Profiler(timer = lambda: float(ticks.next()))
+
+        with prof.measure("phases", "generate"):
+            with prof.measure("nodes", "Output"):
+                with prof.measure("phases", "inspect"):
+                    pass
+
+        # the nodes don't change the time of the phases
+        self.assertEqual(prof.exclusive["phases"], {
+            "generate": 4.0, "inspect": 1.0})
+        self.assertEqual(prof.exclusive["nodes"], {"Output": 3.0})
+
+    def test_categories1(self):
+        prof = profiler.Profiler(categories = ("phases",))
+        env = environment.create_environment(
+            packages = ["pwt.jinja2js:test_templates"], profiler = prof)
+        source, filename, uptodate = env.loader.get_source(
+            env, "example.jinja2")
+        jscompiler.generate(
+            env._parse(source, "example.jinja2", filename),
+            env, "example.jinja2", filename)
+
+        self.assertEqual(sorted(prof.stats), ["phases"])
+        self.assertEqual(sorted(prof.stats["phases"]), ["inspect", "parse"])
+
+    def test_count1(self):
+        prof = profiler.Profiler()
+        env = environment.create_environment(profiler = prof)
+        node = env.parse("""{% namespace ns %}
+{% macro hello(name) %}{{ name|escape }} {{ name|escape }}{% endmacro %}""")
+        jscompiler.generate(node, env, "t.html", "t.html")
+        self.assertEqual(prof.counts, {"escapes": 2})
+
+        output = StringIO()
+        prof.report(output)
+        self.assert_("\nescapes " in output.getvalue())
+
+    def test_profile1(self):
+        env = environment.create_environment(
+            packages = ["pwt.jinja2js:test_templates"])
+        stats = profiler.profile(env, "example.jinja2")
+
+        self.assertEqual(env.profiler, None)
+        self.assertEqual(sorted(stats["macros"]), ["example.hello"])
+        self.assertEqual(stats["macros"]["example.hello"]["calls"], 1)
+        self.assertEqual(stats["nodes"]["Template"]["calls"], 1)
+        self.assertEqual(stats["nodes"]["Macro"]["calls"], 1)
+        self.assertEqual(
+            sorted(stats["phases"]), ["inspect", "parse"])
+        for category in stats.values():
+            for entry in category.values():
+                self.assert_(0 <= entry["time"] <= entry["total"])
+
+
+class InstrumentTestCase(JSCompilerTestCase):
+
+    def setUp(self):
+        super(InstrumentTestCase, self).setUp()
+
+        self.env = environment.create_environment(
+            packages = ["pwt.jinja2js:test_templates"],
+            instrument = True,
+            )
+
+    def test_instrument1(self):
+        node = self.get_compile_from_string("""{% namespace ins %}
+{% macro hello(name) %}Hello {{ name }}{% endmacro %}
+{% macro bye(name) %}Bye {{ name }}{% endmacro %}""")
+        source_code = jscompiler.generate(node, self.env, "i.html", "i.html")
+
+        self.assertEqual(source_code, """if (typeof ins == 'undefined') { var ins = {}; }
+if (typeof jinja2jsStats == 'undefined') { var jinja2jsStats = {}; }
+if (typeof jinja2jsInstrument == 'undefined') {
+    var jinja2jsInstrument = function(name, macro) {
+        var now = typeof performance != 'undefined' && performance.now ?
+            function() { return performance.now(); } :
+            function() { return Date.now(); };
+        var stats = jinja2jsStats[name] = {calls: 0, time: 0, length: 0};
+        return function(opt_data, opt_sb, opt_caller) {
+            var length = opt_sb && opt_sb.getLength ? opt_sb.getLength() : 0;
+            var start = now();
+            var output = macro(opt_data, opt_sb, opt_caller);
+            stats.time += now() - start;
+            stats.calls++;
+            if (output != null) {
+                stats.length += String(output).length;
+            } else if (opt_sb && opt_sb.getLength) {
+                stats.length += opt_sb.getLength() - length;
+            }
+            return output;
+        };
+    };
+}
+
+ins.hello = function(opt_data, opt_sb, opt_caller) {
+    return 'Hello ' + opt_data.name;
+};
+ins.hello = jinja2jsInstrument('ins.hello', ins.hello);
+ins.bye = function(opt_data, opt_sb, opt_caller) {
+    return 'Bye ' + opt_data.name;
+};
+ins.bye = jinja2jsInstrument('ins.bye', ins.bye);""")
+
+    def test_no_macros1(self):
+        node = self.get_compile_from_string("""{% namespace ins %}""")
+        source_code = jscompiler.generate(node, self.env, "i.html", "i.html")
+        self.assert_("jinja2jsInstrument" not in source_code)
+
+    def test_bundle1(self):
+        # the helper is only written once
+        templates = []
+        for idx in range(2):
+            templates.append((self.get_compile_from_string(
+                """{%% namespace ins%d %%}
+{%% macro hello() %%}Hello{%% endmacro %%}""" % idx),
+                              "i%d.html" % idx, "i%d.html" % idx))
+        source_code = jscompiler.generateBundle(templates, self.env)
+
+        self.assertEqual(
+            source_code.count("var jinja2jsInstrument = function"), 1)
+        self.assertEqual(source_code.count(" = jinja2jsInstrument("), 2)
+
+    def test_parse_environment1(self):
+        env = environment.parse_environment({"instrument": "true"})
+        self.assertEqual(env.instrument, True)
+        self.assertEqual(environment.parse_environment({}).instrument, False)
+        self.assertEqual(
+            environment.parse_environment({"instrument": "false"}).instrument,
+            False)
+
+
+class JSCompilerTemplateTestCaseOutput(JSCompilerTestCase):
+    # Test the standard output so that if a developer needs to debug the
+    # output then we can add comments and other information, keep the ordering
+    # so that it is easier to do so.
+
+    def test_comments1(self):
+        node = self.get_compile_from_string("""/**
+* This prints out hello world!
+*/
+{% macro hello() %}
+Hello, world!
+{% endmacro %}""")
+
+        source_code = jscompiler.generate(node, self.env, "v.html", "v.html")
+
+        self.assertEqual(source_code, """goog.require('goog.string');
+goog.require('goog.string.StringBuffer');
+/**
+* This prints out hello world!
+*/
+hello = function(opt_data, opt_sb, opt_caller) {
+    var output = '\\nHello, world!\\n';
+    if (!opt_sb) return output;
+    opt_sb.append(output);
 };""")
 
     def test_comments_containing_variables(self):
@@ -1900,9 +3118,9 @@ goog.require('goog.string.StringBuffer');
 // This prints out hello !
 
 hello = function(opt_data, opt_sb, opt_caller) {
-    var output = opt_sb || new goog.string.StringBuffer();
-    output.append('\\nHello, ', opt_data.name, '!\\n');
-    if (!opt_sb) return output.toString();
+    var output = '\\nHello, ' + opt_data.name + '!\\n';
+    if (!opt_sb) return output;
+    opt_sb.append(output);
 };""")
 
     def test_comments2(self):
@@ -1921,9 +3139,9 @@ goog.require('goog.string.StringBuffer');
  * This prints out hello world!
  */
 hello = function(opt_data, opt_sb, opt_caller) {
-    var output = opt_sb || new goog.string.StringBuffer();
-    output.append('\\nHello, ', opt_data.name.firstname, '!\\n');
-    if (!opt_sb) return output.toString();
+    var output = '\\nHello, ' + opt_data.name.firstname + '!\\n';
+    if (!opt_sb) return output;
+    opt_sb.append(output);
 };""")
 
     def test_comments3(self):
@@ -1948,9 +3166,9 @@ goog.require('test.ns1');
  * This prints out hello world!
  */
 hello = function(opt_data, opt_sb, opt_caller) {
-    var output = opt_sb || new goog.string.StringBuffer();
-    output.append('\\nHello, ', opt_data.name.firstname, '!\\n');
-    if (!opt_sb) return output.toString();
+    var output = '\\nHello, ' + opt_data.name.firstname + '!\\n';
+    if (!opt_sb) return output;
+    opt_sb.append(output);
 };""")
 
     def test_comments4(self):
@@ -1982,9 +3200,9 @@ goog.require('test.ns1');
  * This prints out hello world!
  */
 hello = function(opt_data, opt_sb, opt_caller) {
-    var output = opt_sb || new goog.string.StringBuffer();
-    output.append('\\nHello, ', opt_data.name.firstname, '!\\n');
-    if (!opt_sb) return output.toString();
+    var output = '\\nHello, ' + opt_data.name.firstname + '!\\n';
+    if (!opt_sb) return output;
+    opt_sb.append(output);
 };""")
 
 
@@ -2044,9 +3262,7 @@ class SoyServer(unittest.TestCase):
 
 
 example.hello = function(opt_data, opt_sb, opt_caller) {
-    var output = '';
-    output += '\\nHello, ' + opt_data.name + '!\\n';
-    return output;
+    return '\\nHello, ' + opt_data.name + '!\\n';
 };""")
 
     def test_closure_soy1(self):
@@ -2061,12 +3277,271 @@ goog.require('goog.string.StringBuffer');
 
 
 example.hello = function(opt_data, opt_sb, opt_caller) {
-    var output = opt_sb || new goog.string.StringBuffer();
-    output.append('\\nHello, ', opt_data.name, '!\\n');
-    if (!opt_sb) return output.toString();
+    var output = '\\nHello, ' + opt_data.name + '!\\n';
+    if (!opt_sb) return output;
+    opt_sb.append(output);
 };""")
 
 
+class CountingResourcesApp(wsgi.ConcatResourcesApp):
+
+    compiled = 0
+
+    def compiler(self, node, env, path, filename):
+        self.compiled += 1
+        return super(CountingResourcesApp, self).compiler(
+            node, env, path, filename)
+
+
+class SoyServerCache(unittest.TestCase):
+
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+        self.write("lib.jinja2", """{% namespace lib %}
+{% macro hello() %}Hello{% endmacro %}""")
+        self.write("page.jinja2", """{% namespace page %}
+{% import 'lib.jinja2' as lib %}
+{% macro page() %}{{ lib.hello() }}{% endmacro %}""")
+
+    def tearDown(self):
+        shutil.rmtree(self.tempdir)
+
+    def write(self, name, source, mtime = None):
+        filename = os.path.join(self.tempdir, name)
+        open(filename, "w").write(source)
+        if mtime is not None:
+            os.utime(filename, (mtime, mtime))
+
+    def get_app(self, **config):
+        self.resources = CountingResourcesApp(
+            environment.create_environment(directories = [self.tempdir]),
+            **wsgi.parse_config(config))
+        return webtest.TestApp(self.resources)
+
+    def test_cache_hit1(self):
+        app = self.get_app()
+        res1 = app.get("/page.jinja2")
+        res2 = app.get("/page.jinja2")
+
+        self.assertEqual(res1.body, res2.body)
+        self.assertEqual(self.resources.compiled, 1)
+
+    def test_cache_disabled1(self):
+        app = self.get_app(cache_size = "0")
+        app.get("/page.jinja2")
+        app.get("/page.jinja2")
+
+        self.assertEqual(self.resources.compiled, 2)
+
+    def test_cache_size1(self):
+        app = self.get_app(cache_size = "1")
+        app.get("/page.jinja2")
+        app.get("/lib.jinja2")
+        app.get("/page.jinja2")
+
+        self.assertEqual(self.resources.compiled, 3)
+
+    def test_cache_invalidate1(self):
+        app = self.get_app()
+        app.get("/page.jinja2")
+
+        self.write("page.jinja2", """{% namespace page2 %}
+{% import 'lib.jinja2' as lib %}
+{% macro page() %}{{ lib.hello() }}{% endmacro %}""", mtime = 1)
+        res = app.get("/page.jinja2")
+
+        self.assertEqual(self.resources.compiled, 2)
+        self.assert_("page2.page = function" in res.body)
+
+    def test_cache_invalidate_import1(self):
+        app = self.get_app()
+        app.get("/page.jinja2")
+
+        self.write("lib.jinja2", """{% namespace lib2 %}
+{% macro hello() %}Hello{% endmacro %}""", mtime = 1)
+        res = app.get("/page.jinja2")
+
+        self.assertEqual(self.resources.compiled, 2)
+        self.assert_("lib2.hello({})" in res.body)
+
+    def test_etag1(self):
+        app = self.get_app()
+        res = app.get("/page.jinja2")
+        etag = res.headers["ETag"]
+        self.assertEqual(res.headers.get("Cache-Control"), None)
+
+        res = app.get(
+            "/page.jinja2", headers = {"If-None-Match": etag}, status = 304)
+        self.assertEqual(res.body, "")
+        self.assertEqual(res.headers["ETag"], etag)
+        self.assertEqual(self.resources.compiled, 1)
+
+        res = app.get("/page.jinja2", headers = {"If-None-Match": '"other"'})
+        self.assertEqual(res.status_int, 200)
+        self.assertEqual(res.headers["ETag"], etag)
+
+    def test_etag_changes1(self):
+        app = self.get_app()
+        etag = app.get("/page.jinja2").headers["ETag"]
+
+        self.write("lib.jinja2", """{% namespace lib2 %}
+{% macro hello() %}Hello{% endmacro %}""", mtime = 1)
+        res = app.get("/page.jinja2", headers = {"If-None-Match": etag})
+        self.assertEqual(res.status_int, 200)
+        self.assertNotEqual(res.headers["ETag"], etag)
+
+    def test_cache_control1(self):
+        app = self.get_app(cache_control = "public, max-age=300")
+        res = app.get("/page.jinja2")
+        self.assertEqual(res.headers["Cache-Control"], "public, max-age=300")
+
+    def get_response(self, path, headers):
+        # webtest decodes compressed responses so talk to the app directly
+        return webob.Request.blank(path, headers = headers).get_response(
+            self.resources)
+
+    def test_gzip1(self):
+        self.get_app()
+        plain = self.get_response("/page.jinja2", {})
+        self.assertEqual(plain.headers.get("Content-Encoding"), None)
+        self.assertEqual(plain.headers["Vary"], "Accept-Encoding")
+
+        res = self.get_response(
+            "/page.jinja2", {"Accept-Encoding": "gzip, deflate"})
+        self.assertEqual(res.headers["Content-Encoding"], "gzip")
+        self.assertEqual(res.headers["Vary"], "Accept-Encoding")
+        self.assertNotEqual(res.headers["ETag"], plain.headers["ETag"])
+        self.assertEqual(
+            gzip.GzipFile(fileobj = StringIO(res.body)).read(), plain.body)
+
+        # compressed once per version of the template
+        resource = self.resources.get_resource("/page.jinja2")
+        res2 = self.get_response(
+            "/page.jinja2", {"Accept-Encoding": "gzip"})
+        self.assertEqual(res2.body, res.body)
+        self.assert_(resource.gzipped is resource.gzipped)
+        self.assertEqual(self.resources.compiled, 1)
+
+        res3 = self.get_response(
+            "/page.jinja2", {
+                "Accept-Encoding": "gzip",
+                "If-None-Match": res.headers["ETag"]})
+        self.assertEqual(res3.status_int, 304)
+
+    def test_gzip_refused1(self):
+        self.get_app()
+        res = self.get_response(
+            "/page.jinja2", {"Accept-Encoding": "gzip;q=0, deflate"})
+        self.assertEqual(res.headers.get("Content-Encoding"), None)
+
+    def test_gzip_disabled1(self):
+        self.get_app(gzip = "false")
+        res = self.get_response(
+            "/page.jinja2", {"Accept-Encoding": "gzip"})
+        self.assertEqual(res.headers.get("Content-Encoding"), None)
+        self.assertEqual(res.headers.get("Vary"), None)
+
+    def test_source_map1(self):
+        self.resources = wsgi.ConcatResourcesApp(
+            environment.create_environment(directories = [self.tempdir]),
+            **wsgi.parse_config({"source_map": "true"}))
+        app = webtest.TestApp(self.resources)
+
+        res = app.get("/page.jinja2")
+        self.assertEqual(res.headers["SourceMap"], "page.jinja2.map")
+
+        res = app.get("/page.jinja2.map")
+        self.assertEqual(res.content_type, "application/json")
+        source_map = json.loads(res.body)
+        self.assertEqual(source_map["file"], "page.jinja2")
+        self.assertEqual(source_map["sources"], ["/page.jinja2"])
+        self.assertEqual(
+            source_map["sourcesContent"],
+            [open(os.path.join(self.tempdir, "page.jinja2")).read()])
+
+        app.get("/missing.jinja2.map", status = 404)
+
+    def test_source_map_etag1(self):
+        self.resources = wsgi.ConcatResourcesApp(
+            environment.create_environment(directories = [self.tempdir]),
+            **wsgi.parse_config({"source_map": "true"}))
+        app = webtest.TestApp(self.resources)
+
+        script = app.get("/page.jinja2")
+        res = app.get("/page.jinja2.map")
+        self.assertNotEqual(res.etag, script.etag)
+        app.get(
+            "/page.jinja2.map", headers = {"If-None-Match": res.etag},
+            status = 304)
+
+        # whitespace changes the source map but not the output
+        self.write("page.jinja2", """{% namespace page %}
+{% import 'lib.jinja2' as lib %}
+{% macro page() %}{{  lib.hello()  }}{% endmacro %}""", mtime = 2000000000)
+        self.assertEqual(app.get("/page.jinja2").etag, script.etag)
+        app.get(
+            "/page.jinja2.map", headers = {"If-None-Match": res.etag},
+            status = 200)
+
+    def test_source_map_disabled1(self):
+        app = self.get_app()
+        res = app.get("/page.jinja2")
+        self.assertEqual(res.headers.get("SourceMap"), None)
+        app.get("/page.jinja2.map", status = 404)
+
+    def test_cache_missing1(self):
+        app = self.get_app()
+        self.assertEqual(
+            app.get("/missing.jinja2", status = 404).status_int, 404)
+
+    def get_metrics(self, app):
+        res = app.get("/metrics")
+        self.assertEqual(res.headers["Content-Type"], metrics.CONTENT_TYPE)
+        values = {}
+        for line in res.body.split("\n"):
+            if line and not line.startswith("#"):
+                name, value = line.rsplit(" ", 1)
+                values[name] = float(value)
+        return values
+
+    def test_metrics1(self):
+        app = self.get_app(metrics_path = "/metrics")
+        app.get("/page.jinja2")
+        app.get("/page.jinja2")
+        app.get("/missing.jinja2", status = 404)
+
+        values = self.get_metrics(app)
+        self.assertEqual(values["jinja2js_requests_total"], 3)
+        self.assertEqual(values["jinja2js_cache_hits_total"], 1)
+        self.assertEqual(values["jinja2js_cache_misses_total"], 2)
+        self.assertEqual(values["jinja2js_not_found_total"], 1)
+        self.assertEqual(values["jinja2js_compiles_total"], 1)
+        self.assertEqual(
+            values["jinja2js_compile_duration_seconds_count"], 1)
+        self.assertEqual(
+            values['jinja2js_compile_duration_seconds_bucket{le="+Inf"}'], 1)
+        self.assertEqual(
+            values["jinja2js_request_duration_seconds_count"], 3)
+        self.assertEqual(
+            values["jinja2js_output_bytes_total"],
+            len(app.get("/page.jinja2", headers = {}).body))
+
+    def test_metrics_recompile1(self):
+        app = self.get_app(metrics_path = "/metrics")
+        app.get("/page.jinja2")
+        self.write("lib.jinja2", """{% namespace lib %}
+{% macro hello() %}Hi{% endmacro %}""", mtime = 1)
+        app.get("/page.jinja2")
+
+        values = self.get_metrics(app)
+        self.assertEqual(values["jinja2js_compiles_total"], 2)
+        self.assertEqual(values["jinja2js_cache_misses_total"], 2)
+
+    def test_metrics_disabled1(self):
+        app = self.get_app()
+        app.get("/metrics", status = 404)
+
+
 class RealSoyServer(unittest.TestCase):
 
     def get_app(self):
@@ -2123,9 +3598,7 @@ class CLInterfaceTestCase(unittest.TestCase):
 
 
 example.hello = function(opt_data, opt_sb, opt_caller) {
-    var output = '';
-    output += '\\nHello, ' + opt_data.name + '!\\n';
-    return output;
+    return '\\nHello, ' + opt_data.name + '!\\n';
 };""")
 
     def test_cli4(self):
@@ -2149,11 +3622,564 @@ goog.require('goog.string.StringBuffer');
 
 
 example.hello = function(opt_data, opt_sb, opt_caller) {
+    var output = '\\nHello, ' + opt_data.name + '!\\n';
+    if (!opt_sb) return output;
+    opt_sb.append(output);
+};""")
+
+    def test_cli_cachedir1(self):
+        cachedir = os.path.join(self.tempdir, "cache")
+        outputdir = os.path.join(self.tempdir, "output")
+        os.mkdir(outputdir)
+        args = [
+            "--outputPathFormat", "%s/${INPUT_FILE_NAME_NO_EXT}.js" % outputdir,
+            "--cacheDir", cachedir,
+            "%s/test_templates/example.jinja2" %(
+                os.path.dirname(jscompiler.__file__))
+            ]
+
+        self.assertEqual(cli.main(args, StringIO()), 0)
+        self.assertEqual(len(os.listdir(cachedir)), 1)
+        first = open(os.path.join(outputdir, "example.js")).read()
+
+        self.assertEqual(cli.main(args, StringIO()), 0)
+        self.assertEqual(len(os.listdir(cachedir)), 1)
+        self.assertEqual(
+            open(os.path.join(outputdir, "example.js")).read(), first)
+
+    def test_cli_define1(self):
+        srcdir = os.path.join(self.tempdir, "src")
+        os.mkdir(srcdir)
+        filename = os.path.join(srcdir, "t.jinja2")
+        open(filename, "w").write("""{% namespace t %}
+{% macro hello(name) %}{% if beta %}Beta {% endif %}{{ greeting }} {{ name }}{% endmacro %}""")
+
+        result = cli.main([
+            "--outputPathFormat",
+            "%s/${INPUT_FILE_NAME_NO_EXT}.js" % self.tempdir,
+            "--define", "beta=true", "--define", "greeting=Hello",
+            filename], StringIO())
+        self.assertEqual(result, 0)
+
+        self.assertEqual(
+            open(os.path.join(self.tempdir, "t.js")).read(),
+            """if (typeof t == 'undefined') { var t = {}; }
+
+t.hello = function(opt_data, opt_sb, opt_caller) {
+    return 'Beta Hello ' + opt_data.name;
+};""")
+
+    def test_cli_inline1(self):
+        srcdir = os.path.join(self.tempdir, "src")
+        os.mkdir(srcdir)
+        filename = os.path.join(srcdir, "t.jinja2")
+        open(filename, "w").write("""{% namespace t %}
+{% macro b(text) %}<b>{{ text }}</b>{% endmacro %}
+{% macro hello(name) %}Hello {{ b(text = name) }}{% endmacro %}""")
+
+        result = cli.main([
+            "--outputPathFormat",
+            "%s/${INPUT_FILE_NAME_NO_EXT}.js" % self.tempdir,
+            "--inlineThreshold", "10", filename], StringIO())
+        self.assertEqual(result, 0)
+
+        self.assertEqual(
+            open(os.path.join(self.tempdir, "t.js")).read(),
+            """if (typeof t == 'undefined') { var t = {}; }
+
+t.b = function(opt_data, opt_sb, opt_caller) {
+    return '<b>' + opt_data.text + '</b>';
+};
+t.hello = function(opt_data, opt_sb, opt_caller) {
+    var bText1 = opt_data.name;
+    return 'Hello <b>' + bText1 + '</b>';
+};""")
+
+    def test_cli_minify1(self):
+        srcdir = os.path.join(self.tempdir, "src")
+        os.mkdir(srcdir)
+        filename = os.path.join(srcdir, "t.jinja2")
+        open(filename, "w").write("""{% namespace t %}
+{% macro hello(name) %}Hello {{ name }}{% endmacro %}""")
+
+        result = cli.main([
+            "--outputPathFormat",
+            "%s/${INPUT_FILE_NAME_NO_EXT}.js" % self.tempdir,
+            "--minify", filename], StringIO())
+        self.assertEqual(result, 0)
+
+        self.assertEqual(
+            open(os.path.join(self.tempdir, "t.js")).read(),
+            """if (typeof t == 'undefined') { var t = {}; }
+t.hello=function(a,b,c){return'Hello '+a.name;};""")
+
+    def test_cli_source_map1(self):
+        srcdir = os.path.join(self.tempdir, "src")
+        os.mkdir(srcdir)
+        filename = os.path.join(srcdir, "t.jinja2")
+        open(filename, "w").write("""{% namespace t %}
+{% macro hello(name) %}Hello {{ name }}{% endmacro %}""")
+
+        result = cli.main([
+            "--outputPathFormat",
+            "%s/${INPUT_FILE_NAME_NO_EXT}.js" % self.tempdir,
+            "--sourceMap", filename], StringIO())
+        self.assertEqual(result, 0)
+
+        self.assertEqual(
+            open(os.path.join(self.tempdir, "t.js")).read(),
+            """if (typeof t == 'undefined') { var t = {}; }
+
+t.hello = function(opt_data, opt_sb, opt_caller) {
+    return 'Hello ' + opt_data.name;
+};
+//# sourceMappingURL=t.js.map
+""")
+        self.assertEqual(
+            json.load(open(os.path.join(self.tempdir, "t.js.map"))), {
+                "version": 3,
+                "file": "t.js",
+                "sources": ["src/t.jinja2"],
+                "sourcesContent": [open(filename).read()],
+                "names": [],
+                "mappings": "AAAA;;AACA",
+                })
+
+    def test_cli_bundle_source_map1(self):
+        filenames = self.write_templates(2)
+        bundle_filename = os.path.join(self.tempdir, "bundle.js")
+
+        result = cli.main(
+            ["--bundle", bundle_filename, "--sourceMap"] + filenames,
+            StringIO())
+        self.assertEqual(result, 0)
+
+        self.assert_(open(bundle_filename).read().endswith(
+            "\n//# sourceMappingURL=bundle.js.map\n"))
+        source_map = json.load(open(bundle_filename + ".map"))
+        self.assertEqual(
+            source_map["sources"], ["src/t0.jinja2", "src/t1.jinja2"])
+        self.assertEqual(
+            source_map["mappings"], "AAAA;ACAA;ADAA;AACA;;;ACDA;AACA")
+
+    def test_cli_profile1(self):
+        output = StringIO()
+        result = cli.main([
+            "--outputPathFormat",
+            "%s/${INPUT_FILE_NAME_NO_EXT}.js" % self.tempdir,
+            "--profile", "--jobs", "2",
+            "%s/test_templates/example.jinja2" %(
+                os.path.dirname(jscompiler.__file__))
+            ], output)
+        self.assertEqual(result, 0)
+
+        lines = output.getvalue().split("\n")
+        self.assertEqual(
+            [line.split()[0] for line in lines if line.endswith("total")],
+            ["phases", "macros", "nodes"])
+        self.assert_(
+            [line for line in lines if line.startswith("example.hello ")])
+
+    def write_stats_templates(self):
+        srcdir = os.path.join(self.tempdir, "src")
+        os.mkdir(srcdir)
+        page = os.path.join(srcdir, "page.jinja2")
+        open(page, "w").write("""{% namespace app.page %}
+{% import 'lib.jinja2' as lib %}
+{% macro page(name) %}{{ lib.hello() }} {{ name|escape }}{% endmacro %}""")
+        lib = os.path.join(srcdir, "lib.jinja2")
+        open(lib, "w").write("""{% namespace app.lib %}
+{% macro hello() %}Hello{% endmacro %}""")
+        return srcdir, [page, lib]
+
+    def test_cli_stats1(self):
+        srcdir, files = self.write_stats_templates()
+        stats = os.path.join(self.tempdir, "stats.json")
+
+        result = cli.main([
+            "--outputPathFormat",
+            "%s/${INPUT_FILE_NAME_NO_EXT}.js" % self.tempdir,
+            "--directories", srcdir, "--stats", stats] + files, StringIO())
+        self.assertEqual(result, 0)
+
+        data = json.load(open(stats))
+        self.assertEqual(sorted(data), ["files"])
+        self.assertEqual(sorted(data["files"]), sorted(files))
+
+        page = data["files"][files[0]]
+        self.assertEqual(page["imports"], 1)
+        self.assertEqual(page["macros"], 1)
+        self.assertEqual(page["escapes"], 1)
+        self.assertEqual(
+            page["source_bytes"], len(open(files[0]).read()))
+        self.assertEqual(
+            page["output_bytes"],
+            len(open(os.path.join(self.tempdir, "page.js")).read()))
+        for key in ("parse_time", "scope_analysis_time", "codegen_time"):
+            self.assert_(page[key] >= 0)
+
+    def test_cli_stats_error1(self):
+        filename = os.path.join(self.tempdir, "bad.jinja2")
+        open(filename, "w").write("{% namespace bad %}{% if %}")
+        stats = os.path.join(self.tempdir, "stats.json")
+
+        result = cli.main([
+            "--outputPathFormat",
+            "%s/${INPUT_FILE_NAME_NO_EXT}.js" % self.tempdir,
+            "--stats", stats, filename], StringIO())
+        self.assertEqual(result, 1)
+
+        error = json.load(open(stats))["files"][filename]["error"]
+        self.assert_(error.startswith("TemplateSyntaxError: "))
+
+    def test_cli_bundle_stats1(self):
+        srcdir, files = self.write_stats_templates()
+        bundle = os.path.join(self.tempdir, "bundle.js")
+        stats = os.path.join(self.tempdir, "stats.json")
+
+        result = cli.main([
+            "--bundle", bundle, "--directories", srcdir,
+            "--stats", stats] + files, StringIO())
+        self.assertEqual(result, 0)
+
+        data = json.load(open(stats))
+        self.assertEqual(sorted(data["files"][files[0]]), [
+            "imports", "macros", "parse_time", "source_bytes"])
+        self.assertEqual(data["bundle"]["filename"], bundle)
+        self.assertEqual(data["bundle"]["macros"], 2)
+        self.assertEqual(data["bundle"]["imports"], 1)
+        self.assertEqual(data["bundle"]["escapes"], 1)
+        self.assertEqual(
+            data["bundle"]["output_bytes"], len(open(bundle).read()))
+
+    def test_cli_instrument1(self):
+        srcdir = os.path.join(self.tempdir, "src")
+        os.mkdir(srcdir)
+        filename = os.path.join(srcdir, "t.jinja2")
+        open(filename, "w").write("""{% namespace t %}
+{% macro hello(name) %}Hello {{ name }}{% endmacro %}""")
+
+        result = cli.main([
+            "--outputPathFormat",
+            "%s/${INPUT_FILE_NAME_NO_EXT}.js" % self.tempdir,
+            "--instrument", filename], StringIO())
+        self.assertEqual(result, 0)
+
+        self.assert_(open(os.path.join(self.tempdir, "t.js")).read().endswith(
+            """t.hello = jinja2jsInstrument('t.hello', t.hello);"""))
+
+    def test_cli_define_invalid1(self):
+        output = StringIO()
+        errors = StringIO()
+        result = cli.main(
+            ["--outputPathFormat", "x.js", "--define", "beta"], output, errors)
+        self.assertEqual(result, 1)
+        self.assertEqual(output.getvalue(), "")
+        self.assertEqual(
+            errors.getvalue(), "Invalid define 'beta', expected name=value\n")
+
+    def write_templates(self, count):
+        srcdir = os.path.join(self.tempdir, "src")
+        os.mkdir(srcdir)
+        filenames = []
+        for idx in range(count):
+            filename = os.path.join(srcdir, "t%d.jinja2" % idx)
+            open(filename, "w").write("""{%% namespace t%d %%}
+{%% macro hello(name) %%}Hello {{ name }} %d{%% endmacro %%}""" %(idx, idx))
+            filenames.append(filename)
+        return filenames
+
+    def test_cli_jobs1(self):
+        files = self.write_templates(4)
+        outputs = {}
+        for jobs in ("1", "3"):
+            outputdir = os.path.join(self.tempdir, "jobs%s" % jobs)
+            os.mkdir(outputdir)
+            result = cli.main([
+                "--outputPathFormat",
+                "%s/${INPUT_FILE_NAME_NO_EXT}.js" % outputdir,
+                "--jobs", jobs] + files, StringIO())
+            self.assertEqual(result, 0)
+
+            outputs[jobs] = dict(
+                (name, open(os.path.join(outputdir, name)).read())
+                for name in os.listdir(outputdir))
+
+        self.assertEqual(len(outputs["1"]), 4)
+        self.assertEqual(outputs["1"], outputs["3"])
+        self.assert_("t3.hello = function" in outputs["3"]["t3.js"])
+
+    def test_cli_jobs_errors1(self):
+        files = self.write_templates(3)
+        open(files[1], "w").write("{% macro broken( %}")
+        outputdir = os.path.join(self.tempdir, "output")
+        os.mkdir(outputdir)
+
+        output = StringIO()
+        errors = StringIO()
+        result = cli.main([
+            "--outputPathFormat",
+            "%s/${INPUT_FILE_NAME_NO_EXT}.js" % outputdir,
+            "--jobs", "2"] + files, output, errors)
+
+        self.assertEqual(result, 1)
+        self.assertEqual(sorted(os.listdir(outputdir)), ["t0.js", "t2.js"])
+        self.assert_(errors.getvalue().startswith(
+            "%s: TemplateSyntaxError: " % files[1]))
+        self.assertEqual(output.getvalue(), "")
+
+    def test_cli_manifest1(self):
+        files = self.write_templates(2)
+        srcdir = os.path.dirname(files[0])
+        open(os.path.join(srcdir, "lib.jinja2"), "w").write(
+            "{% namespace lib %}")
+        open(files[1], "w").write("""{% namespace t1 %}
+{% import 'lib.jinja2' as lib %}
+{% macro hello() %}{{ lib.hello() }}{% endmacro %}""")
+        outputdir = os.path.join(self.tempdir, "output")
+        os.mkdir(outputdir)
+        manifest = os.path.join(self.tempdir, "manifest.json")
+        args = [
+            "--outputPathFormat",
+            "%s/${INPUT_FILE_NAME_NO_EXT}.js" % outputdir,
+            "--directories", srcdir,
+            "--manifest", manifest] + files
+
+        def build():
+            # Mark the existing output so we can tell what was rebuilt
+            for name in os.listdir(outputdir):
+                open(os.path.join(outputdir, name), "w").write("stale")
+            self.assertEqual(cli.main(args, StringIO()), 0)
+            return sorted(
+                name for name in os.listdir(outputdir)
+                if open(os.path.join(outputdir, name)).read() != "stale")
+
+        self.assertEqual(build(), ["t0.js", "t1.js"])
+        self.assertEqual(build(), [])
+
+        # changing a template recompiles just that template
+        open(files[0], "a").write("\n")
+        self.assertEqual(build(), ["t0.js"])
+
+        # changing an imported template recompiles the templates using it
+        open(os.path.join(srcdir, "lib.jinja2"), "w").write(
+            "{% namespace lib2 %}")
+        self.assertEqual(build(), ["t1.js"])
+        self.assert_("lib2.hello({})" in open(
+            os.path.join(outputdir, "t1.js")).read())
+
+        # missing output
+        os.unlink(os.path.join(outputdir, "t0.js"))
+        self.assertEqual(build(), ["t0.js"])
+
+        # changing the compiler options rebuilds everything
+        args[args.index("--manifest"):args.index("--manifest")] = [
+            "--codeStyle", "stringbuilder"]
+        self.assertEqual(build(), ["t0.js", "t1.js"])
+
+    def test_polling_watcher1(self):
+        files = self.write_templates(2)
+        watcher = cli.PollingWatcher([os.path.dirname(files[0])])
+        self.assertEqual(watcher.wait(0), set())
+
+        os.utime(files[0], (1, 1))
+        newfile = os.path.join(os.path.dirname(files[0]), "new.jinja2")
+        open(newfile, "w").write("")
+        self.assertEqual(watcher.wait(0), set([files[0], newfile]))
+        self.assertEqual(watcher.wait(0), set())
+
+        os.unlink(newfile)
+        self.assertEqual(watcher.wait(0), set([newfile]))
+
+    def test_watch_roots1(self):
+        files = self.write_templates(1)
+        roots = cli.watch_roots({
+            "directories": [self.tempdir],
+            "packages": ["pwt.jinja2js:test_templates"],
+            }, files)
+        self.assertEqual(roots, [
+            self.tempdir,
+            os.path.join(os.path.dirname(jscompiler.__file__),
+                         "test_templates"),
+            os.path.dirname(files[0]),
+            ])
+
+        # without a path the templates directory of the package is used
+        self.assertEqual(
+            cli.watch_roots({"packages": ["pwt.jinja2js"]}, []),
+            [os.path.join(os.path.dirname(jscompiler.__file__), "templates")])
+
+    def test_watch1(self):
+        files = self.write_templates(2)
+        outputdir = os.path.join(self.tempdir, "output")
+        os.mkdir(outputdir)
+        output_format = "%s/${INPUT_FILE_NAME_NO_EXT}.js" % outputdir
+        env = environment.create_environment(
+            directories = [os.path.dirname(files[0])])
+
+        class ScriptedWatcher(object):
+            # Run each step then report a change
+            def __init__(self, steps):
+                self.steps = steps
+                self.waits = 0
+
+            def wait(self, timeout = None):
+                self.waits += 1
+                if timeout is not None:
+                    # debouncing
+                    return set()
+                if not self.steps:
+                    raise KeyboardInterrupt()
+                self.steps.pop(0)()
+                return set(["changed"])
+
+        def edit():
+            open(files[1], "w").write("""{% namespace t1 %}
+{% macro hello() %}Changed{% endmacro %}""")
+
+        output = StringIO()
+        result = cli.watch(
+            env, files, output_format, cli.Manifest(None, {}), output,
+            ScriptedWatcher([lambda: None, edit]))
+
+        self.assertEqual(result, 0)
+        self.assertEqual(output.getvalue(), "".join([
+            "%s -> %s/t0.js\n" %(files[0], outputdir),
+            "%s -> %s/t1.js\n" %(files[1], outputdir),
+            "%s -> %s/t1.js\n" %(files[1], outputdir),
+            ]))
+        self.assert_("Changed" in open(
+            os.path.join(outputdir, "t1.js")).read())
+
+    def write_bundle_templates(self):
+        srcdir = os.path.join(self.tempdir, "src")
+        os.mkdir(srcdir)
+        page = os.path.join(srcdir, "page.jinja2")
+        open(page, "w").write("""{% namespace app.page %}
+{% import 'lib.jinja2' as lib %}
+{% macro page() %}{{ lib.hello() }}{% endmacro %}""")
+        lib = os.path.join(srcdir, "lib.jinja2")
+        open(lib, "w").write("""{% namespace app.lib %}
+{% macro hello() %}Hello{% endmacro %}""")
+        return srcdir, [page, lib]
+
+    def test_cli_bundle1(self):
+        srcdir, files = self.write_bundle_templates()
+        bundle = os.path.join(self.tempdir, "bundle.js")
+
+        result = cli.main([
+            "--bundle", bundle, "--directories", srcdir] + files, StringIO())
+        self.assertEqual(result, 0)
+
+        self.assertEqual(open(bundle).read(), """if (typeof app == 'undefined') { var app = {}; }
+if (typeof app.lib == 'undefined') { app.lib = {}; }
+if (typeof app.page == 'undefined') { app.page = {}; }
+
+app.lib.hello = function(opt_data, opt_sb, opt_caller) {
+    return 'Hello';
+};
+
+
+app.page.page = function(opt_data, opt_sb, opt_caller) {
+    return '' + app.lib.hello({});
+};""")
+
+    def test_cli_bundle_closure1(self):
+        srcdir, files = self.write_bundle_templates()
+        bundle = os.path.join(self.tempdir, "bundle.js")
+
+        result = cli.main([
+            "--bundle", bundle, "--directories", srcdir,
+            "--codeStyle", "stringbuilder"] + files, StringIO())
+        self.assertEqual(result, 0)
+
+        # the namespaces are provided at the top and not required
+        self.assertEqual(open(bundle).read(), """goog.provide('app.lib');
+goog.provide('app.page');
+goog.require('goog.string');
+goog.require('goog.string.StringBuffer');
+
+app.lib.hello = function(opt_data, opt_sb, opt_caller) {
+    var output = 'Hello';
+    if (!opt_sb) return output;
+    opt_sb.append(output);
+};
+
+
+app.page.page = function(opt_data, opt_sb, opt_caller) {
     var output = opt_sb || new goog.string.StringBuffer();
-    output.append('\\nHello, ', opt_data.name, '!\\n');
+    app.lib.hello({}, output);
     if (!opt_sb) return output.toString();
 };""")
 
+    def test_cli_bundle_error1(self):
+        srcdir, files = self.write_bundle_templates()
+        open(files[1], "w").write("{% macro broken( %}")
+        bundle = os.path.join(self.tempdir, "bundle.js")
+
+        output = StringIO()
+        errors = StringIO()
+        result = cli.main(["--bundle", bundle] + files, output, errors)
+        self.assertEqual(result, 1)
+        self.assertEqual(os.path.exists(bundle), False)
+        self.assertEqual(output.getvalue(), "")
+        self.assert_(errors.getvalue().startswith(
+            "%s: TemplateSyntaxError: " % files[1]))
+
+    def test_parse_cache1(self):
+        cache = environment.FileSystemParseCache(self.tempdir)
+        env = environment.create_environment(
+            packages = ["pwt.jinja2js:test_templates"],
+            parse_cache = cache)
+        source = """{% namespace cached %}
+{% import 'test_import.jinja2' as forms %}
+{% macro hello(name) %}{{ forms.input(name = name) }}{% endmacro %}"""
+
+        node = env._parse(source, "cached.jinja2", "cached.jinja2")
+        self.assertEqual(len(os.listdir(self.tempdir)), 1)
+
+        cached = cache.load(env, source)
+        self.assert_(cached is not node)
+        self.assert_(cached.environment is env)
+        self.assertEqual(
+            jscompiler.generate(cached, env, "cached.jinja2", "cached.jinja2"),
+            jscompiler.generate(node, env, "cached.jinja2", "cached.jinja2"))
+
+        # a different source is a cache miss
+        self.assertEqual(cache.load(env, source + " "), None)
+
+    def test_parse_cache_key1(self):
+        cache = environment.FileSystemParseCache(self.tempdir)
+        env = environment.create_environment(
+            packages = ["pwt.jinja2js:test_templates"],
+            parse_cache = cache)
+        source = """{% namespace cached %}
+{% macro hello() %}
+    {{ 1 }}
+{% endmacro %}"""
+        key = cache.get_cache_key(env, source)
+        self.assertEqual(cache.get_cache_key(env, source), key)
+
+        # settings that change the parse tree change the key
+        for settings in ({"trim_blocks": True},
+                         {"lstrip_blocks": True},
+                         {"variable_start_string": "${"},
+                         {"line_statement_prefix": "#"}):
+            self.assertNotEqual(
+                cache.get_cache_key(env.overlay(**settings), source), key)
+
+        # as does a different version of pwt.jinja2js
+        version = environment.VERSION
+        environment.VERSION = "0.0"
+        try:
+            self.assertNotEqual(cache.get_cache_key(env, source), key)
+        finally:
+            environment.VERSION = version
+
+        # settings that only change the generated code don't
+        self.assertEqual(
+            cache.get_cache_key(env.overlay(autoescape = True), source), key)
+
     # test the generation of different filenames
 
     def test_output1(self):
@@ -2192,6 +4218,62 @@ example.hello = function(opt_data, opt_sb, opt_caller) {
             "/builddir/test.soy.js")
 
 
+class BenchmarkTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tempdir)
+
+    def test_corpus1(self):
+        generator = benchmark.CorpusGenerator(
+            macros = 3, loop_depth = 3, filter_density = 1, imports = 2,
+            size = 2)
+        names = generator.write(self.tempdir, 2)
+        self.assertEqual(names, ["t0.jinja2", "t1.jinja2"])
+        self.assertEqual(sorted(os.listdir(self.tempdir)), [
+            "lib0.jinja2", "lib1.jinja2", "t0.jinja2", "t1.jinja2"])
+
+        source = open(os.path.join(self.tempdir, "t0.jinja2")).read()
+        self.assertEqual(source.count("{% macro "), 3)
+        self.assertEqual(source.count("{% for "), 9)
+        self.assertEqual(source.count("{% import "), 2)
+
+        # every generated template compiles with every writer
+        for writer in cli.writerclasses.values():
+            env = environment.create_environment(
+                directories = [self.tempdir], writer = writer)
+            for name in names:
+                jscompiler.generate(
+                    env.parse(open(os.path.join(self.tempdir, name)).read()),
+                    env, name, name)
+
+    def test_benchmark1(self):
+        results = os.path.join(self.tempdir, "results.json")
+        self.assertEqual(benchmark.main([
+            "--templates", "2", "--macros", "2", "--repeat", "1",
+            "--output", results], StringIO()), 0)
+
+        data = json.load(open(results))
+        self.assertEqual(data["parameters"]["templates"], 2)
+        self.assertEqual(sorted(data["results"]), sorted(cli.writerclasses))
+        for writer, result in data["results"].items():
+            self.assertEqual(
+                sorted(result),
+                ["codegen", "inspect", "output_bytes", "parse",
+                 "source_bytes"])
+            self.assert_(result["codegen"]["min"] > 0)
+
+        output = StringIO()
+        benchmark.main([
+            "--templates", "1", "--macros", "1", "--repeat", "1",
+            "--output", os.path.join(self.tempdir, "new.json"),
+            "--compare", results], output)
+        self.assertEqual(
+            len(output.getvalue().splitlines()), 3 * len(cli.writerclasses))
+
+
 class TestJinja2JSFunctionalTestSetup(unittest.TestCase):
     # Test that we haven't broken the application that serves the Java Script
     # test suite for pwt.jinja2js
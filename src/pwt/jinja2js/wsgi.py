@@ -1,60 +1,243 @@
+import gzip
+import hashlib
+import posixpath
+import timeit
+from cStringIO import StringIO
+
 import webob
 import webob.dec
 
 import jinja2
+import jinja2.environment
 
 import jscompiler
 import environment
+import metrics
+import sourcemap
+
+
+class CompiledResource(object):
+    # The compiled output of a template along with everything we need to
+    # know in order to tell when the output is out of date.
+
+    def __init__(self, output, uptodate, source_map = None):
+        self.output = output
+        # JSON source map of the output, if any
+        self.source_map = source_map
+        # list of `uptodate` callables for the template and all the
+        # templates it imports.
+        self.uptodate = uptodate
+        # strong entity tag for the output
+        self.etag = hashlib.sha1(output).hexdigest()
+        # and for the source map, which also changes with the whitespace
+        # and comments of the templates
+        self.source_map_etag = None
+        if source_map is not None:
+            self.source_map_etag = hashlib.sha1(source_map).hexdigest()
+        # compressed output, created the first time it is asked for
+        self._gzipped = None
+
+    @property
+    def gzipped(self):
+        if self._gzipped is None:
+            buf = StringIO()
+            # A fixed mtime so the compressed body only depends on the output
+            f = gzip.GzipFile(fileobj = buf, mode = "wb", mtime = 0)
+            f.write(self.output)
+            f.close()
+            self._gzipped = buf.getvalue()
+        return self._gzipped
+
+    def is_up_to_date(self):
+        for uptodate in self.uptodate:
+            if uptodate is not None and not uptodate():
+                return False
+        return True
 
 
 class ResourcesApp(object):
 
-    def __init__(self, env):
+    def __init__(self, env, cache_size = 50, cache_control = None,
+                 gzip = True, source_map = False, metrics_path = None):
         self.env = env
+        # `cache_size` follows the same rules as the Jinja2 environment:
+        # 0 disables the cache and a negative number never evicts anything.
+        self.cache = jinja2.environment.create_cache(cache_size)
+        # value of the Cache-Control header, if any
+        self.cache_control = cache_control
+        # compress the output for clients that accept gzip
+        self.gzip = gzip
+        # serve source maps, at the path of the template plus `.map`
+        self.source_map = source_map
+        # path to serve the metrics at, if any
+        self.metrics_path = metrics_path
+        self.metrics = metrics.ResourceMetrics()
+
+    def compiler(self, node, env, path, filename, source_map = None):
+        return jscompiler.generate(node, env, path, filename, source_map)
+
+    def compile(self, path):
+        source, filename, uptodate = self.env.loader.get_source(
+            self.env, path)
+
+        self.metrics.compiles.inc()
+        start = timeit.default_timer()
+        try:
+            resource = self.compile_source(path, source, filename, uptodate)
+        finally:
+            self.metrics.compile_duration.observe(
+                timeit.default_timer() - start)
+        self.metrics.output_bytes.inc(len(resource.output))
+        return resource
+
+    def compile_source(self, path, source, filename, uptodate):
+        node = self.env._parse(source, path, filename)
+
+        # subclasses written before source maps don't take the argument
+        kwargs = {}
+        source_map = None
+        if self.source_map:
+            source_map = kwargs["source_map"] = sourcemap.SourceMap(
+                posixpath.basename(path))
+            source_map.add_content(path, source)
+
+        output = self.compiler(node, self.env, path, filename, **kwargs)
+
+        # The output also depends on the namespaces of the imported
+        # templates so they must invalidate the cached output too.
+        index = jscompiler.get_namespace_index(self.env)
+        uptodates = [uptodate]
+        for name in jscompiler.find_imports(node):
+            uptodates.append(index.get(name).uptodate)
+
+        if source_map is not None:
+            source_map = source_map.dumps()
+        return CompiledResource(output, uptodates, source_map)
+
+    def get_resource(self, path):
+        if self.cache is not None:
+            resource = self.cache.get(path)
+            if resource is not None and resource.is_up_to_date():
+                self.metrics.cache_hits.inc()
+                return resource
 
-    def compiler(self, node, env, path, filename):
-        return jscompiler.generate(node, env, path, filename)
+        self.metrics.cache_misses.inc()
+        resource = self.compile(path)
+
+        if self.cache is not None:
+            self.cache[path] = resource
+
+        return resource
 
     @webob.dec.wsgify
     def __call__(self, request):
         path = request.path_info
 
+        if self.metrics_path is not None and path == self.metrics_path:
+            response = webob.Response(body = self.metrics.render())
+            response.headers["Content-Type"] = metrics.CONTENT_TYPE
+            return response
+
+        self.metrics.requests.inc()
+        start = timeit.default_timer()
         try:
-            source, filename, uptodate = self.env.loader.get_source(
-                self.env, path)
-        except jinja2.TemplateNotFound:
-            return webob.Response("Not found", status = 404)
+            return self.respond(request, path)
+        finally:
+            self.metrics.request_duration.observe(
+                timeit.default_timer() - start)
 
-        node = self.env._parse(source, path, filename)
+    def respond(self, request, path):
+        source_map = self.source_map and path.endswith(".map")
+        if source_map:
+            path = path[:-len(".map")]
 
-        output = self.compiler(node, self.env, path, filename)
+        try:
+            resource = self.get_resource(path)
+        except jinja2.TemplateNotFound as err:
+            if err.name != path:
+                # one of the imported templates is missing
+                raise
+            self.metrics.not_found.inc()
+            return webob.Response("Not found", status = 404)
 
-        return webob.Response(
-            body = output, content_type = "application/javascript")
+        if source_map:
+            response = webob.Response(
+                body = resource.source_map,
+                content_type = "application/json",
+                conditional_response = True)
+            response.etag = resource.source_map_etag
+            return response
+
+        response = webob.Response(
+            content_type = "application/javascript",
+            conditional_response = True)
+        # webob answers a matching If-None-Match with a 304
+        if self.gzip and accepts_gzip(request):
+            response.body = resource.gzipped
+            response.content_encoding = "gzip"
+            # each representation needs its own strong entity tag
+            response.etag = resource.etag + "-gzip"
+        else:
+            response.body = resource.output
+            response.etag = resource.etag
+        if self.gzip:
+            response.vary = ("Accept-Encoding",)
+        if self.cache_control:
+            response.headers["Cache-Control"] = self.cache_control
+        if resource.source_map is not None:
+            # relative to the URL of the script
+            response.headers["SourceMap"] = str(
+                posixpath.basename(path) + ".map")
+
+        return response
+
+
+def accepts_gzip(request):
+    if "Accept-Encoding" not in request.headers:
+        return False
+    accept = request.accept_encoding
+    if hasattr(accept, "acceptable_offers"):
+        return bool(accept.acceptable_offers(["gzip"]))
+    # WebOb < 1.8
+    return "gzip" in accept
+
+
+def parse_config(config):
+    # Options for the resource applications. The environment is configured
+    # from the same config by `environment.parse_environment`.
+    return {
+        "cache_size": int(config.get("cache_size", 50)),
+        "cache_control": config.get("cache_control", None),
+        "gzip": environment.asbool(config.get("gzip", True)),
+        "source_map": environment.asbool(config.get("source_map", False)),
+        "metrics_path": config.get("metrics_path", None),
+        }
 
 
 def Resources(*args, **kwargs):
     env = environment.parse_environment(kwargs)
-    return ResourcesApp(env)
+    return ResourcesApp(env, **parse_config(kwargs))
 
 
 class ClosureResourcesApp(ResourcesApp):
 
-    def compiler(self, node, env, path, filename):
-        return jscompiler.generateClosure(node, env, path, filename)
+    def compiler(self, node, env, path, filename, source_map = None):
+        return jscompiler.generateClosure(
+            node, env, path, filename, source_map)
 
 
 def ClosureResources(*args, **kwargs):
     env = environment.parse_environment(kwargs)
-    return ClosureResourcesApp(env)
+    return ClosureResourcesApp(env, **parse_config(kwargs))
 
 
 class ConcatResourcesApp(ResourcesApp):
 
-    def compiler(self, node, env, path, filename):
-        return jscompiler.generateConcat(node, env, path, filename)
+    def compiler(self, node, env, path, filename, source_map = None):
+        return jscompiler.generateConcat(
+            node, env, path, filename, source_map)
 
 
 def ConcatResources(*args, **kwargs):
     env = environment.parse_environment(kwargs)
-    return ConcatResourcesApp(env)
+    return ConcatResourcesApp(env, **parse_config(kwargs))